@@ -0,0 +1,162 @@
+import argparse
+import json
+import logging
+import os
+import time
+import numpy as np
+
+from PIL import Image
+from pycocotools import mask as coco_mask
+from server.segmentation import CoralSegmentation
+from typing import Dict, List
+
+
+def load_images(path: str, image_num: int) -> List[np.ndarray]:
+    image_files = [path]
+    if os.path.isdir(path):
+        image_files = [
+            os.path.join(path, image_name) for image_name in sorted(os.listdir(path))
+        ]
+
+    images = []
+    for image_file in image_files[:image_num]:
+        images.append(np.array(Image.open(image_file).convert("RGB")))
+    return images
+
+
+def detect(segmentation: CoralSegmentation, image: np.ndarray):
+    start_time = time.perf_counter()
+    masks = segmentation.generate_masks_json(image)
+    return masks, time.perf_counter() - start_time
+
+
+def compare_masks(torch_masks: List[Dict], onnx_masks: List[Dict]) -> Dict:
+    """
+    Match each torch mask to the onnx mask with the highest IoU
+    """
+    comparison = {
+        "identical_json": json.dumps(torch_masks) == json.dumps(onnx_masks),
+        "same_fields": all(
+            torch_mask.keys() == onnx_mask.keys()
+            for torch_mask, onnx_mask in zip(torch_masks, onnx_masks)
+        ),
+        "torch_masks": len(torch_masks),
+        "onnx_masks": len(onnx_masks),
+        "ious": [],
+        "predicted_iou_diffs": [],
+    }
+    if len(torch_masks) == 0 or len(onnx_masks) == 0:
+        return comparison
+
+    ious = np.asarray(
+        coco_mask.iou(
+            [mask["segmentation"] for mask in onnx_masks],
+            [mask["segmentation"] for mask in torch_masks],
+            [0] * len(torch_masks),
+        )
+    )
+    best = ious.argmax(axis=0)
+    for torch_idx, onnx_idx in enumerate(best):
+        comparison["ious"].append(ious[onnx_idx, torch_idx])
+        comparison["predicted_iou_diffs"].append(
+            abs(
+                torch_masks[torch_idx]["predicted_iou"]
+                - onnx_masks[onnx_idx]["predicted_iou"]
+            )
+        )
+    return comparison
+
+
+def main(args):
+    images = load_images(args.images, args.image_num)
+    assert len(images) > 0, f"No image found in {args.images}"
+    print(f"Detecting corals on {len(images)} images with both backends")
+
+    torch_segmentation = CoralSegmentation(
+        args.segmentation_model,
+        args.segmentation_model_type,
+        num_threads=args.threads,
+    )
+    onnx_segmentation = CoralSegmentation(
+        args.segmentation_encoder,
+        args.segmentation_model_type,
+        num_threads=args.threads,
+        backend=CoralSegmentation.ONNX_BACKEND,
+        decoder_model_path=args.segmentation_decoder,
+    )
+
+    torch_times = []
+    onnx_times = []
+    ious = []
+    predicted_iou_diffs = []
+    identical_images = 0
+    for idx, image in enumerate(images):
+        torch_masks, torch_time = detect(torch_segmentation, image)
+        onnx_masks, onnx_time = detect(onnx_segmentation, image)
+        torch_times.append(torch_time)
+        onnx_times.append(onnx_time)
+
+        comparison = compare_masks(torch_masks, onnx_masks)
+        ious.extend(comparison["ious"])
+        predicted_iou_diffs.extend(comparison["predicted_iou_diffs"])
+        identical_images += int(comparison["identical_json"])
+        print(
+            f"Image {idx}: torch {torch_time:.2f} s, {comparison['torch_masks']} masks, "
+            f"onnx {onnx_time:.2f} s, {comparison['onnx_masks']} masks, "
+            f"identical JSON: {comparison['identical_json']}, "
+            f"same fields: {comparison['same_fields']}"
+        )
+
+    print(f"Torch: {np.mean(torch_times):.2f} seconds/image")
+    print(f"ONNX: {np.mean(onnx_times):.2f} seconds/image")
+    print(f"Speedup: {np.sum(torch_times) / np.sum(onnx_times):.2f}x")
+    print(f"Identical JSON on {identical_images} of {len(images)} images")
+    if len(ious) > 0:
+        ious = np.array(ious)
+        print(
+            f"Best IoU of the torch masks with the onnx masks: "
+            f"mean {ious.mean():.4f}, min {ious.min():.4f}, "
+            f"{np.mean(ious >= args.match_iou) * 100:.1f}% above {args.match_iou}"
+        )
+        print(f"Max predicted IoU difference: {np.max(predicted_iou_diffs):.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the coral detection of the torch and onnx backends."
+    )
+    parser.add_argument(
+        "--images", type=str, required=True, help="Path to images or the image folder"
+    )
+    parser.add_argument(
+        "--image_num",
+        type=int,
+        default=5,
+        help="Number of images compared. Default is 5",
+    )
+    parser.add_argument(
+        "--segmentation_model", type=str, default="models/vit_b_coralscop.pth"
+    )
+    parser.add_argument("--segmentation_model_type", type=str, default="vit_b")
+    parser.add_argument(
+        "--segmentation_encoder", type=str, default="models/coralscop_encoder.onnx"
+    )
+    parser.add_argument(
+        "--segmentation_decoder", type=str, default="models/coralscop_decoder.onnx"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Number of inference threads of both backends. Default is all the cores",
+    )
+    parser.add_argument(
+        "--match_iou",
+        type=float,
+        default=0.95,
+        help="IoU above which a torch mask is considered reproduced by the onnx backend. Default is 0.95",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    main(args)
@@ -0,0 +1,166 @@
+import argparse
+import logging
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from server.segmentation import CoralSegmentation
+from server.util.coco import numpy_mask_to_rle_mask, decode_rle_mask
+from typing import Dict, List
+
+
+def generate_masks(width: int, height: int, mask_num: int, seed: int) -> List[Dict]:
+    """
+    Generate random overlapping elliptical masks, encoded as RLEs
+    """
+    rng = np.random.default_rng(seed)
+    masks = []
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for idx in range(mask_num):
+        mask[:] = 0
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (
+            int(rng.integers(width // 100, width // 6)),
+            int(rng.integers(height // 100, height // 6)),
+        )
+        angle = float(rng.uniform(0, 180))
+        cv2.ellipse(mask, center, axes, angle, 0, 360, 1, -1)
+
+        segmentation = numpy_mask_to_rle_mask(mask)
+        masks.append(
+            {
+                "segmentation": segmentation,
+                "area": int(mask.sum()),
+                "id": idx,
+                "predicted_iou": float(rng.uniform(0.5, 1.0)),
+            }
+        )
+    return masks
+
+
+def decode_filter(
+    segmentation: CoralSegmentation,
+    masks: List[Dict],
+    min_area: float,
+    min_confidence: float,
+    max_iou: float,
+) -> set:
+    """
+    The previous filter, which decodes every mask to compute the areas and the IoU
+    """
+    height, width = masks[0]["segmentation"]["size"]
+    min_area = height * width * min_area
+    decoded_masks = [decode_rle_mask(mask["segmentation"]) for mask in masks]
+    by_area = {
+        mask["id"]
+        for mask, decoded in zip(masks, decoded_masks)
+        if np.sum(decoded) >= min_area
+    }
+    by_confidence = segmentation.filter_by_confidence(masks, min_confidence)
+    by_iou = set(decode_suppress(segmentation, decoded_masks, max_iou))
+    return by_area & by_confidence & by_iou
+
+
+def decode_suppress(
+    segmentation: CoralSegmentation, masks: List[np.ndarray], max_iou: float
+) -> List[int]:
+    """
+    The previous suppression, with the intersections of all the pairs of masks
+    computed by a matrix product of the flattened masks
+    """
+    M = np.stack([mask.ravel() > 0 for mask in masks], axis=0).astype(np.float32)
+    areas = M.sum(axis=1, dtype=np.float64)
+    intersection_matrix = M @ M.T
+    union_matrix = areas[:, None] + areas[None, :] - intersection_matrix
+    iou_matrix = intersection_matrix / np.clip(union_matrix, a_min=1, a_max=None)
+    return segmentation.suppress_overlapping_masks(areas, iou_matrix, max_iou)
+
+
+def rle_filter(
+    segmentation: CoralSegmentation,
+    masks: List[Dict],
+    min_area: float,
+    min_confidence: float,
+    max_iou: float,
+) -> set:
+    return {
+        mask["id"]
+        for mask in segmentation.filter(masks, min_area, min_confidence, max_iou)
+    }
+
+
+def benchmark(name: str, filter, *args) -> set:
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    kept = filter(*args)
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name}: {elapsed:.2f} seconds, peak memory {peak / 1024 / 1024:.1f} MB, kept {len(kept)} masks"
+    )
+    return kept
+
+
+def main(args):
+    print(f"Generating {args.masks} masks on a {args.width}x{args.height} image ...")
+    masks = generate_masks(args.width, args.height, args.masks, args.seed)
+
+    # Only the filter is benchmarked, so the model is not loaded
+    segmentation = CoralSegmentation.__new__(CoralSegmentation)
+    segmentation.logger = logging.getLogger(CoralSegmentation.__name__)
+
+    filter_args = (args.min_area, args.min_confidence, args.max_iou)
+    benchmark(
+        f"RLE filter ({len(masks)} masks)",
+        rle_filter,
+        segmentation,
+        masks,
+        *filter_args,
+    )
+
+    # The decoded masks and their float32 rows of the intersection product must
+    # fit into memory
+    bytes_per_mask = args.width * args.height * 6
+    baseline_num = min(
+        len(masks), args.baseline_memory_mb * 1024 * 1024 // bytes_per_mask
+    )
+    if baseline_num == 0:
+        print("Skipping the decode filter, a single mask exceeds the memory budget")
+        return
+
+    baseline_masks = masks[:baseline_num]
+    print(f"Comparing with the decode filter on {baseline_num} masks")
+    new_kept = benchmark(
+        "RLE filter", rle_filter, segmentation, baseline_masks, *filter_args
+    )
+    old_kept = benchmark(
+        "Decode filter", decode_filter, segmentation, baseline_masks, *filter_args
+    )
+    print(f"Identical kept masks: {new_kept == old_kept}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the time and peak memory of the mask filters."
+    )
+    parser.add_argument("--width", type=int, default=4000, help="Image width")
+    parser.add_argument("--height", type=int, default=3000, help="Image height")
+    parser.add_argument(
+        "--masks", type=int, default=300, help="Number of candidate masks"
+    )
+    parser.add_argument("--min_area", type=float, default=0.001)
+    parser.add_argument("--min_confidence", type=float, default=0.6)
+    parser.add_argument("--max_iou", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--baseline_memory_mb",
+        type=int,
+        default=2048,
+        help="Memory budget of the decode filter, which is only run on the masks that fit into it. Default is 2048",
+    )
+
+    args = parser.parse_args()
+    main(args)
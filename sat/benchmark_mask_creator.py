@@ -0,0 +1,143 @@
+import argparse
+import logging
+import time
+import numpy as np
+
+from server.mask import MaskCreator, Prompt
+from server.util.coco import (
+    cropped_mask_to_rle_mask,
+    rle_mask_to_coco_annotation,
+    to_coco_annotation,
+)
+from typing import Dict, List
+
+
+def generate_clicks(
+    width: int, height: int, click_num: int, max_points: int, seed: int
+) -> List[List[Prompt]]:
+    """
+    Generate the prompts of each click, a positive point followed by up to
+    max_points - 1 refining points
+    """
+    rng = np.random.default_rng(seed)
+    clicks = []
+    for idx in range(click_num):
+        prompts = []
+        for point_idx in range(idx % max_points + 1):
+            prompts.append(
+                Prompt(
+                    {
+                        "imageX": float(rng.uniform(0, width)),
+                        "imageY": float(rng.uniform(0, height)),
+                        "label": 1 if point_idx == 0 else int(rng.integers(0, 2)),
+                    }
+                )
+            )
+        clicks.append(prompts)
+    return clicks
+
+
+def full_mask_annotation(mask_creator: MaskCreator, prompts: List[Prompt]) -> Dict:
+    """
+    The previous prompt decoding, with the mask upscaled to the image size by the decoder
+    """
+    return to_coco_annotation(mask_creator.create_mask(prompts))
+
+
+def cropped_mask_annotation(mask_creator: MaskCreator, prompts: List[Prompt]) -> Dict:
+    mask, x0, y0, _ = mask_creator.create_cropped_mask(prompts)
+    height, width = mask_creator.image_size
+    return rle_mask_to_coco_annotation(
+        cropped_mask_to_rle_mask(mask, x0, y0, height, width)
+    )
+
+
+def benchmark(
+    name: str,
+    mask_creator: MaskCreator,
+    create_annotation,
+    clicks: List[List[Prompt]],
+) -> List[Dict]:
+    mask_creator.reset_latencies()
+    annotations = []
+    latencies = []
+    for prompts in clicks:
+        # Each click starts a new mask, so both modes decode the same prompts
+        mask_creator.low_res_logits = None
+        start_time = time.perf_counter()
+        annotations.append(create_annotation(mask_creator, prompts))
+        latencies.append(time.perf_counter() - start_time)
+
+    decoder = mask_creator.get_latency_percentiles()
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+    print(
+        f"{name}: decoder p50 {decoder['p50']:.1f} ms, p90 {decoder['p90']:.1f} ms, "
+        f"p99 {decoder['p99']:.1f} ms, with the annotation p50 {p50:.1f} ms, "
+        f"p90 {p90:.1f} ms, p99 {p99:.1f} ms"
+    )
+    return annotations
+
+
+def main(args):
+    if args.embedding is not None:
+        embedding = np.load(args.embedding).astype(np.float32)
+    else:
+        embedding = (
+            np.random.default_rng(args.seed)
+            .standard_normal((1, 256, 64, 64))
+            .astype(np.float32)
+        )
+    embedding = embedding.reshape(1, 256, 64, 64)
+
+    mask_creator = MaskCreator(args.decoder)
+    mask_creator.set_image(embedding, [args.height, args.width])
+    clicks = generate_clicks(
+        args.width, args.height, args.clicks, args.max_points, args.seed
+    )
+
+    print(f"{args.clicks} clicks on a {args.width}x{args.height} image")
+    full_annotations = benchmark(
+        "Full mask", mask_creator, full_mask_annotation, clicks
+    )
+    cropped_annotations = benchmark(
+        "Cropped mask", mask_creator, cropped_mask_annotation, clicks
+    )
+
+    identical = 0
+    pixel_diffs = []
+    for full, cropped in zip(full_annotations, cropped_annotations):
+        identical += int(full["segmentation"] == cropped["segmentation"])
+        pixel_diffs.append(abs(full["area"] - cropped["area"]))
+    print(f"Identical masks on {identical} of {len(clicks)} clicks")
+    print(f"Max area difference: {max(pixel_diffs)} pixels")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the per-click latency of the full and cropped mask decoding."
+    )
+    parser.add_argument(
+        "--decoder", type=str, default="models/vit_b_decoder_quantized.onnx"
+    )
+    parser.add_argument(
+        "--embedding",
+        type=str,
+        default=None,
+        help="Image embedding .npy file. Default is a random embedding",
+    )
+    parser.add_argument("--width", type=int, default=4000, help="Image width")
+    parser.add_argument("--height", type=int, default=3000, help="Image height")
+    parser.add_argument(
+        "--clicks", type=int, default=200, help="Number of clicks. Default is 200"
+    )
+    parser.add_argument(
+        "--max_points",
+        type=int,
+        default=3,
+        help="Maximum number of points of a click. Default is 3",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    main(args)
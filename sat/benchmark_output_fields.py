@@ -0,0 +1,122 @@
+import argparse
+import time
+import tracemalloc
+import numpy as np
+
+from server.segment_anything.automatic_mask_generator_onnx import (
+    SamAutomaticMaskGeneratorOnnx,
+    mask_similarity,
+)
+from server.segment_anything.utils.amg_numpy import MaskData
+from typing import Dict, List
+
+# Fields kept by CoralSegmentation.generate_masks_json
+ANNOTATION_FIELDS = ["segmentation", "area", "bbox", "predicted_iou"]
+
+
+def generate_mask_data(
+    width: int, height: int, mask_num: int, feature_dim: int, seed: int
+) -> MaskData:
+    """
+    Generate random rectangular masks as uncompressed RLEs, with the outputs of
+    the decoder for each mask
+    """
+    rng = np.random.default_rng(seed)
+    rles = []
+    boxes = np.zeros((mask_num, 4), dtype=np.float32)
+    for idx in range(mask_num):
+        x0, y0 = int(rng.integers(0, width - 2)), int(rng.integers(0, height - 2))
+        x1 = int(rng.integers(x0 + 1, min(width, x0 + width // 4) + 1))
+        y1 = int(rng.integers(y0 + 1, min(height, y0 + height // 4) + 1))
+        # Column-major runs of the rectangle
+        counts = [x0 * height + y0]
+        for _ in range(x0, x1 - 1):
+            counts.extend([y1 - y0, height - (y1 - y0)])
+        counts.extend([y1 - y0, height * width - sum(counts) - (y1 - y0)])
+        rles.append({"size": [height, width], "counts": counts})
+        boxes[idx] = [x0, y0, x1 - 1, y1 - 1]
+
+    return MaskData(
+        rles=rles,
+        boxes=boxes,
+        iou_preds=rng.uniform(0.6, 1.0, mask_num).astype(np.float32),
+        cate_preds=np.ones(mask_num, dtype=np.int64),
+        fc_features=rng.standard_normal((mask_num, feature_dim)).astype(np.float32),
+        points=rng.uniform(0, width, (mask_num, 2)),
+        stability_score=rng.uniform(0.6, 1.0, mask_num).astype(np.float32),
+        crop_boxes=np.tile(np.array([0, 0, width, height]), (mask_num, 1)),
+    )
+
+
+def write_masks(mask_data: MaskData, output_fields: List[str]) -> List[Dict]:
+    """
+    The end of the automatic mask generation, from the merged masks of the crops
+    to the records of generate_masks_json
+    """
+    # Only the output stage is benchmarked, so the models are not loaded
+    generator = SamAutomaticMaskGeneratorOnnx.__new__(SamAutomaticMaskGeneratorOnnx)
+    generator.output_mode = "coco_rle"
+    generator.set_output_fields(output_fields)
+
+    if not generator.keep_fc_features:
+        del mask_data["fc_features"]
+    if "similarity" in generator.output_fields:
+        mask_data["similarity"] = mask_similarity(mask_data["fc_features"])
+    masks = generator._write_annotations(mask_data)
+
+    # Previously, the fields which are not annotated were deleted afterwards
+    for mask in masks:
+        for field in list(mask.keys()):
+            if field not in ANNOTATION_FIELDS:
+                del mask[field]
+    return masks
+
+
+def benchmark(name: str, mask_data: MaskData, output_fields: List[str]) -> List[Dict]:
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    masks = write_masks(mask_data, output_fields)
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{name}: {elapsed * 1000:.1f} ms, peak memory {peak / 1024 / 1024:.1f} MB")
+    return masks
+
+
+def main(args):
+    for mask_num in args.masks:
+        print(f"{mask_num} masks on a {args.width}x{args.height} image")
+        mask_data = generate_mask_data(
+            args.width, args.height, mask_num, args.feature_dim, args.seed
+        )
+        all_masks = benchmark("  All fields", MaskData(**mask_data._stats), None)
+        annotation_masks = benchmark(
+            "  Annotation fields", MaskData(**mask_data._stats), ANNOTATION_FIELDS
+        )
+        print(f"  Identical masks: {all_masks == annotation_masks}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the output stage of the mask generator with all the fields and with the annotation fields."
+    )
+    parser.add_argument("--width", type=int, default=4000, help="Image width")
+    parser.add_argument("--height", type=int, default=3000, help="Image height")
+    parser.add_argument(
+        "--masks",
+        type=int,
+        nargs="+",
+        default=[300, 600, 1200],
+        help="Numbers of masks. Default is 300 600 1200",
+    )
+    parser.add_argument(
+        "--feature_dim",
+        type=int,
+        default=256,
+        help="Dimension of the mask features. Default is 256",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    main(args)
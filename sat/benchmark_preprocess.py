@@ -0,0 +1,55 @@
+import argparse
+import time
+import tracemalloc
+import numpy as np
+
+from PIL import Image
+from server.util.onnx import ImagePreprocessor, preprocess_image
+
+
+def benchmark(name: str, preprocess, image: Image, repeat: int) -> np.ndarray:
+    # Warm up, so that the reused buffer is allocated before measuring
+    output = preprocess(image)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        output = preprocess(image)
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name}: {repeat / elapsed:.2f} images/s, "
+        f"{elapsed / repeat * 1000:.1f} ms/image, "
+        f"peak memory {peak / 1024 / 1024:.1f} MB"
+    )
+    return output
+
+
+def main(args):
+    image = np.random.randint(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    image = Image.fromarray(image)
+    print(f"Preprocessing a {args.width}x{args.height} image {args.repeat} times")
+
+    old_output = benchmark("preprocess_image", preprocess_image, image, args.repeat)
+    preprocessor = ImagePreprocessor()
+    new_output = benchmark(
+        "ImagePreprocessor", preprocessor.preprocess, image, args.repeat
+    )
+
+    print(f"Max absolute difference: {np.abs(old_output - new_output).max():.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput and peak memory of the image preprocessing."
+    )
+    parser.add_argument("--width", type=int, default=4000, help="Image width")
+    parser.add_argument("--height", type=int, default=3000, help="Image height")
+    parser.add_argument(
+        "--repeat", type=int, default=20, help="Number of preprocessed images"
+    )
+
+    args = parser.parse_args()
+    main(args)
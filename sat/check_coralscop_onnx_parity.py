@@ -0,0 +1,283 @@
+import argparse
+import logging
+import cv2
+import numpy as np
+import onnxruntime as ort
+import torch
+
+from torchvision.ops import batched_nms as torch_batched_nms
+from torchvision.ops import nms as torch_nms
+from server.segment_anything.automatic_mask_generator_onnx import (
+    SamAutomaticMaskGeneratorOnnx,
+    batched_nms,
+    nms,
+)
+from server.segment_anything.utils import amg
+from server.segment_anything.utils import amg_numpy
+from typing import Dict, List
+
+# Outputs of SamOnnxModel, named by gen_coral_onnx.py
+DECODER_OUTPUT_NAMES = [
+    "masks",
+    "iou_predictions",
+    "low_res_masks",
+    "cate_pred",
+    "fc_features",
+]
+
+
+def generate_boxes(rng: np.random.Generator, box_num: int, size: int):
+    """
+    Generate integer boxes and rounded scores, so that the boxes overlap and
+    the scores have ties, same as the masks of a point grid
+    """
+    x0 = rng.integers(0, size - 8, box_num)
+    y0 = rng.integers(0, size - 8, box_num)
+    x1 = np.minimum(x0 + rng.integers(4, size // 4, box_num), size)
+    y1 = np.minimum(y0 + rng.integers(4, size // 4, box_num), size)
+    boxes = np.stack([x0, y0, x1, y1], axis=1).astype(np.float32)
+    scores = np.round(rng.uniform(0.8, 1.0, box_num), 2).astype(np.float32)
+    categories = rng.integers(0, 3, box_num)
+    return boxes, scores, categories
+
+
+def check_nms(rng: np.random.Generator, trials: int, box_num: int, iou: float):
+    """
+    Compare the order of the masks kept by the numpy nms and batched_nms with torchvision
+    """
+    same_nms = 0
+    same_batched_nms = 0
+    for _ in range(trials):
+        boxes, scores, categories = generate_boxes(rng, box_num, 256)
+        keep = nms(boxes, scores, iou)
+        torch_keep = torch_nms(torch.from_numpy(boxes), torch.from_numpy(scores), iou)
+        same_nms += int(np.array_equal(keep, torch_keep.numpy()))
+
+        keep = batched_nms(boxes, scores, categories, iou)
+        torch_keep = torch_batched_nms(
+            torch.from_numpy(boxes),
+            torch.from_numpy(scores),
+            torch.from_numpy(categories),
+            iou,
+        )
+        same_batched_nms += int(np.array_equal(keep, torch_keep.numpy()))
+    return same_nms, same_batched_nms
+
+
+def check_stability_score(
+    rng: np.random.Generator, trials: int, mask_num: int, offset: float
+):
+    """
+    Compare the stability scores of random mask logits with the torch utility
+    """
+    same = 0
+    max_diff = 0.0
+    for _ in range(trials):
+        logits = rng.normal(0, 2, (mask_num, 256, 256)).astype(np.float32)
+        scores = amg_numpy.calculate_stability_score(logits, 0.0, offset)
+        torch_scores = amg.calculate_stability_score(
+            torch.from_numpy(logits), 0.0, offset
+        ).numpy()
+        same += int(np.array_equal(scores, torch_scores))
+        max_diff = max(max_diff, float(np.max(np.abs(scores - torch_scores))))
+    return same, max_diff
+
+
+def generate_masks(
+    rng: np.random.Generator, mask_num: int, height: int, width: int
+) -> np.ndarray:
+    """
+    Generate overlapping blobs with small islands and holes
+    """
+    masks = np.zeros((mask_num, height, width), dtype=np.uint8)
+    for mask in masks:
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(10, width // 3)), int(rng.integers(10, height // 3)))
+        cv2.ellipse(mask, center, axes, float(rng.uniform(0, 180)), 0, 360, 1, -1)
+        for _ in range(rng.integers(0, 4)):
+            point = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+            cv2.circle(
+                mask, point, int(rng.integers(1, 8)), int(rng.integers(0, 2)), -1
+            )
+    # Duplicates of the masks, so that NMS removes some of them
+    duplicates = rng.integers(0, mask_num, mask_num // 4)
+    masks[duplicates] = masks[rng.integers(0, mask_num, len(duplicates))]
+    return masks.astype(bool)
+
+
+def torch_postprocess_small_regions(
+    rles: List[Dict], boxes: np.ndarray, min_area: int, nms_thresh: float
+):
+    """
+    The postprocessing of the torch generator before the masks were processed
+    within their boxes, with the torch utilities
+    """
+    new_masks = []
+    scores = []
+    for rle in rles:
+        mask = amg.rle_to_mask(rle)
+        mask, changed = amg.remove_small_regions(mask, min_area, mode="holes")
+        unchanged = not changed
+        mask, changed = amg.remove_small_regions(mask, min_area, mode="islands")
+        unchanged = unchanged and not changed
+        new_masks.append(torch.as_tensor(mask).unsqueeze(0))
+        scores.append(float(unchanged))
+
+    masks = torch.cat(new_masks, dim=0)
+    new_boxes = amg.batched_mask_to_box(masks)
+    keep_by_nms = torch_batched_nms(
+        new_boxes.float(),
+        torch.as_tensor(scores),
+        torch.zeros_like(new_boxes[:, 0]),
+        iou_threshold=nms_thresh,
+    )
+
+    rles = list(rles)
+    boxes = boxes.copy()
+    for i_mask in keep_by_nms:
+        if scores[i_mask] == 0.0:
+            rles[i_mask] = amg.mask_to_rle_pytorch(masks[i_mask].unsqueeze(0))[0]
+            boxes[i_mask] = new_boxes[i_mask].numpy()
+    keep_by_nms = keep_by_nms.numpy()
+    return [rles[i] for i in keep_by_nms], boxes[keep_by_nms]
+
+
+def check_small_regions(
+    rng: np.random.Generator,
+    trials: int,
+    mask_num: int,
+    min_area: int,
+    nms_thresh: float,
+):
+    """
+    Compare the masks and boxes postprocessed by the onnx generator with the torch utilities
+    """
+    same = 0
+    for _ in range(trials):
+        masks = generate_masks(rng, mask_num, 240, 320)
+        rles = amg_numpy.mask_to_rle_numpy(masks)
+        boxes = amg_numpy.batched_mask_to_box(masks)
+
+        torch_rles, torch_boxes = torch_postprocess_small_regions(
+            rles, boxes, min_area, nms_thresh
+        )
+        mask_data = amg_numpy.MaskData(rles=list(rles), boxes=boxes.copy())
+        mask_data = SamAutomaticMaskGeneratorOnnx.postprocess_small_regions(
+            mask_data, min_area, nms_thresh
+        )
+        same += int(
+            mask_data["rles"] == torch_rles
+            and np.array_equal(mask_data["boxes"], torch_boxes)
+        )
+    return same
+
+
+def check_decoder_batch(decoder_path: str, batch_sizes: List[int]):
+    """
+    Check that every output of a dynamic batch decoder has a row per decoded prompt
+    """
+    decoder = ort.InferenceSession(decoder_path, providers=["CPUExecutionProvider"])
+    inputs = {input.name: input for input in decoder.get_inputs()}
+    assert not isinstance(
+        inputs["point_coords"].shape[0], int
+    ), f"The decoder {decoder_path} has no dynamic batch axis"
+    output_names = [output.name for output in decoder.get_outputs()]
+    assert (
+        output_names == DECODER_OUTPUT_NAMES
+    ), f"The decoder outputs are {output_names}, {DECODER_OUTPUT_NAMES} are expected"
+
+    im_size = (120, 160)
+    embedding_shape = inputs["image_embeddings"].shape
+    for batch_size in batch_sizes:
+        outputs = decoder.run(
+            None,
+            {
+                "image_embeddings": np.zeros(embedding_shape, dtype=np.float32),
+                "point_coords": np.zeros((batch_size, 2, 2), dtype=np.float32),
+                "point_labels": np.array([[1, -1]] * batch_size, dtype=np.float32),
+                "mask_input": np.zeros((1, 1, 256, 256), dtype=np.float32),
+                "has_mask_input": np.zeros(1, dtype=np.float32),
+                "orig_im_size": np.array(im_size, dtype=np.float32),
+            },
+        )
+        for name, output in zip(output_names, outputs):
+            assert output.shape[:2] == (
+                batch_size,
+                1,
+            ), f"The {name} output has the shape {output.shape} for {batch_size} prompts"
+        assert (
+            outputs[0].shape[2:] == im_size
+        ), f"The masks have the shape {outputs[0].shape}"
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+
+    same_nms, same_batched_nms = check_nms(
+        rng, args.trials, args.boxes, args.nms_thresh
+    )
+    print(f"NMS order identical to torchvision: {same_nms} of {args.trials}")
+    print(
+        f"Batched NMS order identical to torchvision: {same_batched_nms} of {args.trials}"
+    )
+
+    same_scores, max_diff = check_stability_score(
+        rng, args.trials, args.masks, args.stability_score_offset
+    )
+    print(
+        f"Stability scores identical to torch: {same_scores} of {args.trials}, "
+        f"max difference {max_diff:.2e}"
+    )
+
+    same_masks = check_small_regions(
+        rng, args.trials, args.masks, args.min_mask_region_area, args.nms_thresh
+    )
+    print(
+        f"Small region postprocessing identical to torch: {same_masks} of {args.trials}"
+    )
+
+    if args.decoder is not None:
+        batch_sizes = [1, 3, 8]
+        check_decoder_batch(args.decoder, batch_sizes)
+        print(f"Decoder outputs batched for {batch_sizes} prompts")
+
+    passed = same_nms == same_batched_nms == same_scores == same_masks == args.trials
+    print("Parity: " + ("passed" if passed else "FAILED"))
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the postprocessing of the onnx coral detection against the torch "
+        "utilities on random data. Only the optional decoder check needs a model."
+    )
+    parser.add_argument(
+        "--trials", type=int, default=20, help="Number of trials. Default is 20"
+    )
+    parser.add_argument(
+        "--boxes",
+        type=int,
+        default=500,
+        help="Number of boxes of each NMS trial. Default is 500",
+    )
+    parser.add_argument(
+        "--masks",
+        type=int,
+        default=64,
+        help="Number of masks of each trial. Default is 64",
+    )
+    parser.add_argument("--nms_thresh", type=float, default=0.7)
+    parser.add_argument("--stability_score_offset", type=float, default=1.0)
+    parser.add_argument("--min_mask_region_area", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        default=None,
+        help="Dynamic batch decoder exported by gen_coral_onnx.py, whose outputs are "
+        "checked to have a row per prompt. Default is no decoder check",
+    )
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    exit(0 if main(args) else 1)
@@ -1,11 +1,16 @@
 import argparse
 import os
 import logging
+import multiprocessing
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from PIL import Image
 from server.project import ProjectCreator
 from server.embedding import EmbeddingGenerator
 from server.segmentation import CoralSegmentation
+from server.embeddingCache import EmbeddingCache
 from typing import Dict, List, Generator
 from server.util.requests import ProjectCreateRequest
 
@@ -49,6 +54,7 @@ def main(args):
     setup_logging()
     batch_size = args.batch_size
     assert batch_size > 0, "Batch size should be greater than 0"
+    assert args.workers > 0, "Number of workers should be greater than 0"
 
     image_files = []
     if os.path.isdir(args.images):
@@ -71,6 +77,7 @@ def main(args):
 
     embedding_model_path = args.embedding_model
 
+    segmentation_backend = args.segmentation_backend
     segmentation_model_path = args.segmentation_model
     segmentation_model_type = args.segmentation_model_type
 
@@ -83,8 +90,13 @@ def main(args):
     print(f"Minimum confidence: {min_confidence}")
     print(f"Maximum IOU: {max_iou}")
     print(f"Embedding model: {embedding_model_path}")
-    print(f"Segmentation model: {segmentation_model_path}")
-    print(f"Segmentation model type: {segmentation_model_type}")
+    print(f"Segmentation backend: {segmentation_backend}")
+    if segmentation_backend == CoralSegmentation.ONNX_BACKEND:
+        print(f"Segmentation encoder: {args.segmentation_encoder}")
+        print(f"Segmentation decoder: {args.segmentation_decoder}")
+    else:
+        print(f"Segmentation model: {segmentation_model_path}")
+        print(f"Segmentation model type: {segmentation_model_type}")
 
     idx = 0
     project_requests = []
@@ -110,27 +122,183 @@ def main(args):
         request["output_file"] = os.path.join(output_dir, f"project_{idx}.coral")
         if no_segmentation:
             request["need_segmentation"] = False
+        if args.packed_embeddings:
+            request["embedding_layout"] = ProjectCreateRequest.EMBEDDING_LAYOUT_PACKED
+        if args.resume:
+            request["resume"] = True
+
+        idx += 1
+
+        # The projects created by the previous run are kept when resuming
+        if args.resume and os.path.exists(request["output_file"]):
+            print(f"Skipping {request['output_file']}, it is already created")
+            continue
 
         project_request = ProjectCreateRequest(request)
         project_requests.append(project_request)
 
-        idx += 1
+    if len(project_requests) == 0:
+        print("All the projects are already created")
+        return
+
+    if args.workers > 1:
+        create_projects_in_parallel(project_requests, args)
+        return
+
+    embedding_cache = create_embedding_cache(args)
 
     # Create embedding model
-    embedding_generator = EmbeddingGenerator(embedding_model_path)
+    embedding_generator = EmbeddingGenerator(
+        embedding_model_path, embedding_cache=embedding_cache
+    )
 
     # Create segmentation model
-    segmentation_model = CoralSegmentation(
-        model_path=segmentation_model_path, model_type=segmentation_model_type
-    )
+    segmentation_model = create_segmentation_model(args, None, embedding_cache)
 
     project_creator = ProjectCreator(embedding_generator, segmentation_model)
+    project_creator.set_embedding_batch_size(args.embedding_batch_size)
 
     for idx, request in enumerate(project_requests):
         print(f"Creating project {idx + 1} ...")
         project_creator.create_(request, frontend_enabled=False)
 
 
+def create_embedding_cache(args) -> EmbeddingCache:
+    if args.embedding_disk_cache_mb <= 0:
+        return None
+    return EmbeddingCache(
+        args.embedding_disk_cache_dir, args.embedding_disk_cache_mb * 1024 * 1024
+    )
+
+
+def create_segmentation_model(
+    args, num_threads: int, embedding_cache: EmbeddingCache
+) -> CoralSegmentation:
+    if args.segmentation_backend == CoralSegmentation.ONNX_BACKEND:
+        return CoralSegmentation(
+            model_path=args.segmentation_encoder,
+            model_type=args.segmentation_model_type,
+            num_threads=num_threads,
+            embedding_cache=embedding_cache,
+            backend=args.segmentation_backend,
+            decoder_model_path=args.segmentation_decoder,
+            crop_workers=args.crop_workers,
+        )
+    return CoralSegmentation(
+        model_path=args.segmentation_model,
+        model_type=args.segmentation_model_type,
+        num_threads=num_threads,
+        embedding_cache=embedding_cache,
+        backend=args.segmentation_backend,
+        crop_workers=args.crop_workers,
+    )
+
+
+# Project creator of the worker process, the models are loaded once per worker
+worker_project_creator: ProjectCreator = None
+worker_progress_queue = None
+
+
+def init_worker(args, num_threads: int, progress_queue):
+    global worker_project_creator, worker_progress_queue
+
+    setup_logging()
+    worker_progress_queue = progress_queue
+
+    embedding_cache = create_embedding_cache(args)
+    embedding_generator = EmbeddingGenerator(
+        args.embedding_model, num_threads=num_threads, embedding_cache=embedding_cache
+    )
+    segmentation_model = create_segmentation_model(args, num_threads, embedding_cache)
+    worker_project_creator = ProjectCreator(embedding_generator, segmentation_model)
+    worker_project_creator.set_embedding_batch_size(args.embedding_batch_size)
+
+
+def create_project_in_worker(project_idx: int, request: ProjectCreateRequest) -> Dict:
+    def report_progress(percentage: int):
+        worker_progress_queue.put((project_idx, percentage))
+
+    return worker_project_creator.create_(
+        request, frontend_enabled=False, progress_callback=report_progress
+    )
+
+
+def report_merged_progress(progress_queue, project_num: int):
+    """
+    Print the progress of all the projects whenever a worker reports progress
+    """
+    progress = [0] * project_num
+    while True:
+        item = progress_queue.get()
+        if item is None:
+            return
+        project_idx, percentage = item
+        progress[project_idx] = percentage
+        overall = sum(progress) / project_num
+        running = ", ".join(
+            f"project_{idx}: {p}%" for idx, p in enumerate(progress) if 0 < p < 100
+        )
+        print(f"Overall progress: {overall:.1f}% [{running}]")
+
+
+def create_projects_in_parallel(
+    project_requests: List[ProjectCreateRequest], args
+) -> None:
+    """
+    Create the projects across a pool of worker processes. The threads of each
+    worker are limited so that the workers do not oversubscribe the cores. A
+    failed project is reported without stopping the other projects.
+    """
+    workers = min(args.workers, len(project_requests))
+    num_threads = args.threads_per_worker
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Creating projects with {workers} workers, {num_threads} threads each")
+
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    progress_thread = threading.Thread(
+        target=report_merged_progress, args=(progress_queue, len(project_requests))
+    )
+    progress_thread.start()
+
+    failed_projects = []
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(args, num_threads, progress_queue),
+        ) as executor:
+            futures = {
+                executor.submit(create_project_in_worker, idx, request): request
+                for idx, request in enumerate(project_requests)
+            }
+            for future in as_completed(futures):
+                output_file = futures[future].get_output_file()
+                try:
+                    status = future.result()
+                except Exception as e:
+                    print(f"Failed to create {output_file}: {e}")
+                    failed_projects.append(output_file)
+                    continue
+
+                if status["finished"]:
+                    print(f"Created {status['project_path']}")
+                else:
+                    print(f"Failed to create {output_file}")
+                    failed_projects.append(output_file)
+    finally:
+        progress_queue.put(None)
+        progress_thread.join()
+        manager.shutdown()
+
+    print(
+        f"Created {len(project_requests) - len(failed_projects)} of {len(project_requests)} projects"
+    )
+    for output_file in failed_projects:
+        print(f"Failed project: {output_file}")
+
+
 if __name__ == "__main__":
     DEFAULT_BATCH_SIZE = 100
     DEFAULT_MIN_AREA = 0.001
@@ -139,6 +307,9 @@ if __name__ == "__main__":
     DEFAULT_EMBEDDING_MODEL = "models/vit_h_encoder_quantized.onnx"
     DEFAULT_SEGMENTATION_MODEL = "models/vit_b_coralscop.pth"
     DEFAULT_SEGMENTATION_MODEL_TYPE = "vit_b"
+    DEFAULT_SEGMENTATION_BACKEND = CoralSegmentation.TORCH_BACKEND
+    DEFAULT_SEGMENTATION_ENCODER = "models/coralscop_encoder.onnx"
+    DEFAULT_SEGMENTATION_DECODER = "models/coralscop_decoder.onnx"
 
     parser = argparse.ArgumentParser(description="Project Projects")
     parser.add_argument(
@@ -189,10 +360,76 @@ if __name__ == "__main__":
         default=DEFAULT_SEGMENTATION_MODEL_TYPE,
         help=f"Type of the segmentation model. Default is {DEFAULT_SEGMENTATION_MODEL_TYPE}",
     )
+    parser.add_argument(
+        "--segmentation_backend",
+        type=str,
+        default=DEFAULT_SEGMENTATION_BACKEND,
+        choices=CoralSegmentation.BACKENDS,
+        help=f"Backend of the segmentation. The torch backend runs --segmentation_model, and the onnx backend runs --segmentation_encoder and --segmentation_decoder. Default is {DEFAULT_SEGMENTATION_BACKEND}",
+    )
+    parser.add_argument(
+        "--segmentation_encoder",
+        type=str,
+        default=DEFAULT_SEGMENTATION_ENCODER,
+        help=f"Path to the segmentation encoder exported by gen_coral_onnx.py, used by the onnx backend. Default is {DEFAULT_SEGMENTATION_ENCODER}",
+    )
+    parser.add_argument(
+        "--segmentation_decoder",
+        type=str,
+        default=DEFAULT_SEGMENTATION_DECODER,
+        help=f"Path to the segmentation decoder exported by gen_coral_onnx.py, used by the onnx backend. Default is {DEFAULT_SEGMENTATION_DECODER}",
+    )
     parser.add_argument(
         "--no_segmentation",
         action="store_true",
         help="Disable segmentation",
     )
+    parser.add_argument(
+        "--packed_embeddings",
+        action="store_true",
+        help="Pack all the embeddings of a project into a single memory-mappable file",
+    )
+    parser.add_argument(
+        "--embedding_batch_size",
+        type=int,
+        default=1,
+        help="Number of images encoded together, which needs an encoder exported with --dynamic_batch. Default is 1",
+    )
+    parser.add_argument(
+        "--embedding_disk_cache_dir",
+        type=str,
+        default=EmbeddingCache.DEFAULT_CACHE_DIR,
+        help="Folder of the image embeddings cached on disk across projects",
+    )
+    parser.add_argument(
+        "--embedding_disk_cache_mb",
+        type=int,
+        default=EmbeddingCache.DEFAULT_MAX_BYTES // 1024 // 1024,
+        help="Size limit in MB of the embeddings cached on disk, 0 disables the cache. Default is 2048",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume an interrupted run. The created projects are skipped, and the images already processed are loaded from the checkpoints",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of projects created in parallel by worker processes. Default is 1",
+    )
+    parser.add_argument(
+        "--threads_per_worker",
+        type=int,
+        default=None,
+        help="Number of inference threads of each worker. Default is the number of cores divided by the number of workers",
+    )
+    parser.add_argument(
+        "--crop_workers",
+        type=int,
+        default=1,
+        help="Number of image crops processed concurrently by the coral detection of each worker, "
+        "which share its inference threads. Default is 1",
+    )
     args = parser.parse_args()
     main(args)
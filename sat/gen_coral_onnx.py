@@ -1,8 +1,10 @@
 from server.segment_anything import sam_model_registry
 from server.segment_anything.utils.onnx import SamOnnxModel
+from server.segment_anything.automatic_mask_generator_onnx import SamAutomaticMaskGeneratorOnnx
 from onnxruntime.quantization.quantize import quantize_dynamic
 from onnxruntime.quantization import QuantType
 
+import onnx
 import onnxruntime
 
 import torch
@@ -10,13 +12,19 @@ import os
 import argparse 
 import warnings
 
-def export_encoder(sam, output):
+def export_encoder(sam, output, dynamic_batch=False):
+    # A dynamic batch axis lets the encoder run a batch of images at once
+    dynamic_axes = None
+    if dynamic_batch:
+        dynamic_axes = {"images": {0: "batch"}, "embeddings": {0: "batch"}}
+
     torch.onnx.export(
         f=output,
         model=sam.image_encoder,
         args=torch.randn(1, 3, 1024, 1024),
         input_names=["images"],
         output_names=["embeddings"],
+        dynamic_axes=dynamic_axes,
         export_params=True,
     )  
 
@@ -31,10 +39,20 @@ def export_encoder(sam, output):
     )
 
 
-def export_decoder(sam, output):
+def set_decoder_export_version(output):
+    # SamAutomaticMaskGeneratorOnnx refuses the decoders without the current export version
+    model = onnx.load(output)
+    onnx.helper.set_model_props(model, {
+        SamAutomaticMaskGeneratorOnnx.DECODER_EXPORT_VERSION_KEY: SamAutomaticMaskGeneratorOnnx.DECODER_EXPORT_VERSION
+    })
+    onnx.save(model, output)
+
 
-    # Export masks decoder from SAM model to ONNX
-    onnx_model = SamOnnxModel(sam, return_single_mask=True, use_stability_score=False)
+def export_decoder(sam, output, dynamic_batch=False):
+
+    # Export masks decoder from SAM model to ONNX. The automatic mask generator uses the
+    # single-mask output, same as SamPredictor with multimask_output=False
+    onnx_model = SamOnnxModel(sam, return_single_mask=True, use_stability_score=False, single_mask_output=True)
     embed_dim = sam.prompt_encoder.embed_dim
     embed_size = sam.prompt_encoder.image_embedding_size
     mask_input_size = [4 * x for x in embed_size]
@@ -45,13 +63,27 @@ def export_decoder(sam, output):
         "point_labels": {1: "num_points"},
     }
 
-
-    output_names = ["masks", "iou_predictions", "low_res_masks"]
+    # A dynamic batch axis lets the decoder run a batch of prompts on the same image embeddings at once
+    batch_size = 1
+    if dynamic_batch:
+        batch_size = 2
+        dynamic_axes = {
+            "point_coords": {0: "batch", 1: "num_points"},
+            "point_labels": {0: "batch", 1: "num_points"},
+            "masks": {0: "batch"},
+            "iou_predictions": {0: "batch"},
+            "low_res_masks": {0: "batch"},
+            "cate_pred": {0: "batch"},
+            "fc_features": {0: "batch"},
+        }
+
+    # All the outputs of SamOnnxModel are named, so that the batch axis of each of them is dynamic
+    output_names = ["masks", "iou_predictions", "low_res_masks", "cate_pred", "fc_features"]
 
     dummy_inputs = {
         "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
-        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
-        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+        "point_coords": torch.randint(low=0, high=1024, size=(batch_size, 5, 2), dtype=torch.float),
+        "point_labels": torch.randint(low=0, high=4, size=(batch_size, 5), dtype=torch.float),
         "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
         "has_mask_input": torch.tensor([1], dtype=torch.float),
         "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
@@ -92,6 +124,8 @@ def export_decoder(sam, output):
         weight_type=QuantType.QUInt8,
         optimize_model=True
     )
+    set_decoder_export_version(output)
+    set_decoder_export_version(quantize_output)
 
     # dummy_inputs = {
     #     "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
@@ -135,11 +169,11 @@ def main(args):
 
     encoder_output = os.path.join(output_dir, f"coralscop_encoder.onnx")
     print(f"Exporting encoder to {encoder_output}")
-    export_encoder(sam, encoder_output)
+    export_encoder(sam, encoder_output, args.dynamic_batch)
 
     decoder_output = os.path.join(output_dir, f"coralscop_decoder.onnx") 
     print(f"Exporting decoder to {decoder_output}")
-    export_decoder(sam, decoder_output)
+    export_decoder(sam, decoder_output, args.dynamic_batch)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -161,5 +195,12 @@ if __name__ == '__main__':
         help="In ['default', 'vit_h', 'vit_l', 'vit_b']. Which type of SAM model to export.",
     )
 
+    parser.add_argument(
+        "--dynamic_batch",
+        action="store_true",
+        help="Export the encoder and the decoder with a dynamic batch axis, so that images can be encoded "
+        "and point prompts can be decoded in batches.",
+    )
+
     args = parser.parse_args()
     main(args)
\ No newline at end of file
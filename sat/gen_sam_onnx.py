@@ -8,13 +8,19 @@ from onnxruntime.quantization.quantize import quantize_dynamic
 from onnxruntime.quantization import QuantType
 
 
-def export_encoder(sam, output):
+def export_encoder(sam, output, dynamic_batch=False):
+    # A dynamic batch axis lets the encoder run a batch of images at once
+    dynamic_axes = None
+    if dynamic_batch:
+        dynamic_axes = {"images": {0: "batch"}, "embeddings": {0: "batch"}}
+
     torch.onnx.export(
         f=output,
         model=sam.image_encoder,
         args=torch.randn(1, 3, 1024, 1024),
         input_names=["images"],
         output_names=["embeddings"],
+        dynamic_axes=dynamic_axes,
         export_params=True,
     )
     quantize_output = output.replace(".onnx", "_quantized.onnx")
@@ -27,19 +33,39 @@ def export_encoder(sam, output):
     )
 
 
-def export_decoder(sam, output):
+def export_decoder(sam, output, dynamic_batch=False):
 
     # Export masks decoder from SAM model to ONNX
     onnx_model = SamOnnxModel(sam, return_single_mask=True)
     embed_dim = sam.prompt_encoder.embed_dim
     embed_size = sam.prompt_encoder.image_embedding_size
     mask_input_size = [4 * x for x in embed_size]
+
+    dynamic_axes = {
+        "point_coords": {1: "num_points"},
+        "point_labels": {1: "num_points"},
+    }
+
+    # A dynamic batch axis lets the decoder run the prompts of several objects at once
+    batch_size = 1
+    if dynamic_batch:
+        batch_size = 2
+        dynamic_axes = {
+            "point_coords": {0: "batch", 1: "num_points"},
+            "point_labels": {0: "batch", 1: "num_points"},
+            "masks": {0: "batch"},
+            "iou_predictions": {0: "batch"},
+            "low_res_masks": {0: "batch"},
+        }
+
     dummy_inputs = {
         "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
         "point_coords": torch.randint(
-            low=0, high=1024, size=(1, 5, 2), dtype=torch.float
+            low=0, high=1024, size=(batch_size, 5, 2), dtype=torch.float
+        ),
+        "point_labels": torch.randint(
+            low=0, high=4, size=(batch_size, 5), dtype=torch.float
         ),
-        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
         "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
         "has_mask_input": torch.tensor([1], dtype=torch.float),
         "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float),
@@ -52,10 +78,7 @@ def export_decoder(sam, output):
         args=tuple(dummy_inputs.values()),
         input_names=list(dummy_inputs.keys()),
         output_names=output_names,
-        dynamic_axes={
-            "point_coords": {1: "num_points"},
-            "point_labels": {1: "num_points"},
-        },
+        dynamic_axes=dynamic_axes,
         export_params=True,
         opset_version=17,
         do_constant_folding=True,
@@ -83,11 +106,11 @@ def main(args):
 
     encoder_output = os.path.join(output_dir, f"{model_type}_encoder.onnx")
     print(f"Exporting encoder to {encoder_output}")
-    export_encoder(sam, encoder_output)
+    export_encoder(sam, encoder_output, args.dynamic_batch)
 
     decoder_output = os.path.join(output_dir, f"{model_type}_decoder.onnx")
     print(f"Exporting decoder to {decoder_output}")
-    export_decoder(sam, decoder_output)
+    export_decoder(sam, decoder_output, args.dynamic_batch)
 
 
 if __name__ == "__main__":
@@ -116,5 +139,12 @@ if __name__ == "__main__":
         help="In ['default', 'vit_h', 'vit_l', 'vit_b']. Which type of SAM model to export.",
     )
 
+    parser.add_argument(
+        "--dynamic_batch",
+        action="store_true",
+        help="Export the encoder and the decoder with a dynamic batch axis, so that images can be encoded "
+        "in batches and the prompts of several objects can be decoded at once.",
+    )
+
     args = parser.parse_args()
     main(args)
@@ -3,6 +3,10 @@ import eel
 import argparse
 
 from server.server import Server
+from server.embeddingCache import EmbeddingCache
+from server.detectionCache import DetectionCache
+from server.dataPrefetcher import DataPrefetcher
+from server.segmentation import CoralSegmentation
 from typing import List, Dict, Tuple
 from server.util.requests import FileDialogRequest
 
@@ -89,7 +93,7 @@ def get_data_by_idx(idx: int) -> Dict:
 @eel.expose
 def get_data_list() -> List[Dict]:
     data_list = server.get_data_list()
-    return [data.to_json() for data in data_list]
+    return [data.to_json(server.base64_rle) for data in data_list]
 
 
 @eel.expose
@@ -107,6 +111,16 @@ def create_mask(prompts: List[Dict]) -> Dict:
     return server.create_mask(prompts)
 
 
+@eel.expose
+def create_masks(objects: List[List[Dict]]) -> List[Dict]:
+    return server.create_masks(objects)
+
+
+@eel.expose
+def get_gallery_image(idx: int) -> str:
+    return server.get_gallery_image(idx)
+
+
 @eel.expose
 def get_data_ids_by_category_id(category_id: int) -> List[int]:
     return server.get_data_ids_by_category_id(category_id)
@@ -139,7 +153,7 @@ def export_charts(output_dir: str, requests: List[Dict]):
 
 @eel.expose
 def detect_coral(request: Dict) -> Dict:
-    return server.detect_coral(request).to_json()
+    return server.detect_coral(request).to_json(server.base64_rle)
 
 
 if __name__ == "__main__":
@@ -150,6 +164,58 @@ if __name__ == "__main__":
         default="vit_b",
         choices=["vit_h", "vit_l", "vit_b"],
     )
+    parser.add_argument(
+        "--embedding_cache_mb",
+        type=int,
+        default=512,
+        help="Memory budget in MB for the image embeddings kept in memory. Default is 512",
+    )
+    parser.add_argument(
+        "--embedding_disk_cache_dir",
+        type=str,
+        default=EmbeddingCache.DEFAULT_CACHE_DIR,
+        help="Folder of the image embeddings cached on disk across projects",
+    )
+    parser.add_argument(
+        "--embedding_disk_cache_mb",
+        type=int,
+        default=EmbeddingCache.DEFAULT_MAX_BYTES // 1024 // 1024,
+        help="Size limit in MB of the embeddings cached on disk, 0 disables the cache. Default is 2048",
+    )
+    parser.add_argument(
+        "--coralscop_backend",
+        type=str,
+        default=CoralSegmentation.TORCH_BACKEND,
+        choices=CoralSegmentation.BACKENDS,
+        help="Backend of the coral detection. The onnx backend runs the models exported by gen_coral_onnx.py "
+        "in the models folder without torch. Default is torch",
+    )
+
+    parser.add_argument(
+        "--coralscop_reuse_embedding",
+        action="store_true",
+        help="Reuse the embedding of the project image for the uncropped layer of the coral detection, "
+        "only valid if the embeddings of the projects are computed by an encoder compatible with CoralSCOP",
+    )
+
+    parser.add_argument(
+        "--detection_disk_cache_dir",
+        type=str,
+        default=DetectionCache.DEFAULT_CACHE_DIR,
+        help="Folder of the unfiltered coral detection results cached on disk across projects",
+    )
+    parser.add_argument(
+        "--detection_disk_cache_mb",
+        type=int,
+        default=DetectionCache.DEFAULT_MAX_BYTES // 1024 // 1024,
+        help="Size limit in MB of the detection results cached on disk, 0 disables the cache. Default is 256",
+    )
+    parser.add_argument(
+        "--prefetch_radius",
+        type=int,
+        default=DataPrefetcher.DEFAULT_RADIUS,
+        help="Number of images before and after the current image warmed in the background, 0 disables the prefetch. Default is 2",
+    )
 
     args = parser.parse_args()
 
@@ -157,7 +223,17 @@ if __name__ == "__main__":
     print("Please wait for the tool to be ready ...")
     eel.init("web")
     print(f"About to start the server ...")
-    server = Server(args.model_type)
+    server = Server(
+        args.model_type,
+        args.embedding_cache_mb * 1024 * 1024,
+        args.embedding_disk_cache_dir,
+        args.embedding_disk_cache_mb * 1024 * 1024,
+        args.coralscop_backend,
+        args.coralscop_reuse_embedding,
+        args.detection_disk_cache_dir,
+        args.detection_disk_cache_mb * 1024 * 1024,
+        prefetch_radius=args.prefetch_radius,
+    )
     print(f"Server initialized ...")
     eel.start("main_page.html", size=(1200, 800), port=0)
     print(f"Server started ...")
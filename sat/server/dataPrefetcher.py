@@ -0,0 +1,106 @@
+import logging
+import threading
+
+from .dataset import Dataset, Data
+from .project import ProjectLoader
+from typing import List, Tuple
+
+
+class DataPrefetcher:
+    """
+    Warm the neighbouring images of the image being labeled in a background thread.
+
+    After image i is served, images i+1, i-1, ..., i+radius, i-radius are warmed one
+    by one: the image is copied to the asset folder, the embedding is read into the
+    embedding store and the visual encodings of the annotations are computed, so
+    moving to the next or previous image does not wait for the project file.
+
+    A new request supersedes the images of the previous request which are not
+    warmed yet.
+    """
+
+    DEFAULT_RADIUS = 2
+
+    def __init__(
+        self,
+        project_loader: ProjectLoader,
+        radius: int = DEFAULT_RADIUS,
+        base64_rle: bool = True,
+    ):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.project_loader = project_loader
+        self.radius = radius
+        self.base64_rle = base64_rle
+
+        # Latest request which is not taken by the prefetch thread yet
+        self.request: Tuple[Dataset, int] = None
+        # Incremented by each request, so that the prefetch thread stops
+        # warming the images of a superseded request
+        self.generation = 0
+        self.condition = threading.Condition()
+        # Held while an image is warmed
+        self.warm_lock = threading.Lock()
+        self.thread: threading.Thread = None
+
+    def prefetch(self, dataset: Dataset, image_idx: int):
+        """
+        Warm the neighbours of the image idx in the background
+        """
+        if self.radius <= 0 or dataset is None:
+            return
+
+        with self.condition:
+            self.request = (dataset, image_idx)
+            self.generation += 1
+            self.condition.notify()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def cancel(self):
+        """
+        Drop the pending images and wait for the image being warmed, e.g. before
+        the project file is replaced or another project is loaded
+        """
+        with self.condition:
+            self.request = None
+            self.generation += 1
+        with self.warm_lock:
+            pass
+
+    def get_prefetch_order(self, image_idx: int, size: int) -> List[int]:
+        """
+        Neighbours of the image idx, nearest first and the next image before the previous one
+        """
+        order = []
+        for offset in range(1, self.radius + 1):
+            for neighbour_idx in (image_idx + offset, image_idx - offset):
+                if 0 <= neighbour_idx < size:
+                    order.append(neighbour_idx)
+        return order
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                dataset, image_idx = self.request
+                generation = self.generation
+                self.request = None
+
+            for neighbour_idx in self.get_prefetch_order(image_idx, dataset.get_size()):
+                with self.warm_lock:
+                    if generation != self.generation:
+                        break
+                    self.warm(dataset.get_data(neighbour_idx))
+
+    def warm(self, data: Data):
+        try:
+            self.project_loader.store_data_image(data)
+            data.get_embedding()
+            for annotation in data.get_segmentation()["annotations"]:
+                data.get_vis_encoding(annotation["segmentation"], self.base64_rle)
+            self.logger.debug(f"Prefetched {data.get_image_name()}")
+        except Exception as e:
+            self.logger.warning(f"Error prefetching {data.get_image_name()}: {e}")
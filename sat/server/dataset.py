@@ -1,8 +1,9 @@
+import threading
 import numpy as np
-import copy
 
-from typing import Dict, List
+from typing import Dict, List, Set, Tuple, Union
 from .util.coco import rle_mask_to_rle_vis_encoding
+from .embeddingStore import EmbeddingStore
 
 
 class Data:
@@ -19,6 +20,17 @@ class Data:
         self.embedding = None
         self.segmentation = None
 
+        # Project archive that the segmentation is lazily read from
+        self.archive = None
+        # Store that the embedding is read from when it is not set explicitly
+        self.embedding_store: EmbeddingStore = None
+        # The segmentation is lazily read by the prefetch thread as well
+        self.segmentation_lock = threading.Lock()
+
+        # Visual encodings of the annotations for the front end, keyed by the
+        # counts string of their segmentation and whether they are base64 encoded
+        self.vis_encodings: Dict[Tuple[str, bool], Union[List[int], str]] = {}
+
     def set_image_name(self, image_name: str):
         self.image_name = image_name
 
@@ -37,25 +49,93 @@ class Data:
     def get_idx(self) -> int:
         return self.idx
 
+    def set_archive(self, archive):
+        """
+        Set the project archive that the segmentation is read from
+        when it is first requested.
+        """
+        self.archive = archive
+
+    def get_archive(self):
+        return self.archive
+
     def set_embedding(self, embedding: np.ndarray):
         self.embedding = embedding
 
+    def set_embedding_store(self, embedding_store: EmbeddingStore):
+        """
+        Set the store that the embedding is loaded from on demand.
+        The embedding is not kept on the data, so that the store
+        can evict it once its memory budget is exceeded.
+        """
+        self.embedding_store = embedding_store
+
+    def get_embedding_store(self) -> EmbeddingStore:
+        return self.embedding_store
+
     def get_embedding(self) -> np.ndarray:
+        if self.embedding is None and self.embedding_store is not None:
+            return self.embedding_store.get(self.image_name)
         return self.embedding
 
+    def has_embedding(self) -> bool:
+        return self.embedding is not None or self.embedding_store is not None
+
     def set_segmentation(self, segmentation: Dict):
-        self.segmentation = segmentation
+        with self.segmentation_lock:
+            self.segmentation = segmentation
 
     def get_segmentation(self) -> Dict:
-        return self.segmentation
+        with self.segmentation_lock:
+            if self.segmentation is None and self.archive is not None:
+                self.segmentation = self.archive.read_annotation(self.image_name)
+            return self.segmentation
+
+    def has_segmentation(self) -> bool:
+        return self.segmentation is not None or self.archive is not None
 
     def get_image_width(self) -> int:
-        return self.segmentation["images"][0]["width"]
+        return self.get_segmentation()["images"][0]["width"]
 
     def get_image_height(self) -> int:
-        return self.segmentation["images"][0]["height"]
+        return self.get_segmentation()["images"][0]["height"]
+
+    def get_vis_encoding(
+        self, segmentation: Dict, base64_rle: bool = False
+    ) -> Union[List[int], str]:
+        """
+        Get the visual encoding of the segmentation of an annotation, which is
+        only computed once for the same compressed counts
+        """
+        if not isinstance(segmentation["counts"], str):
+            return rle_mask_to_rle_vis_encoding(segmentation, base64_rle)
+
+        key = (segmentation["counts"], base64_rle)
+        vis_encoding = self.vis_encodings.get(key)
+        if vis_encoding is None:
+            vis_encoding = rle_mask_to_rle_vis_encoding(segmentation, base64_rle)
+            self.vis_encodings[key] = vis_encoding
+        return vis_encoding
 
-    def to_json(self) -> Dict:
+    def invalidate_vis_encodings(self):
+        """
+        Remove the visual encodings of the annotations which are not in the segmentation anymore
+        """
+        if self.segmentation is None:
+            self.vis_encodings = {}
+            return
+        counts = {
+            annotation["segmentation"]["counts"]
+            for annotation in self.segmentation["annotations"]
+            if isinstance(annotation["segmentation"]["counts"], str)
+        }
+        self.vis_encodings = {
+            key: vis_encoding
+            for key, vis_encoding in self.vis_encodings.items()
+            if key[0] in counts
+        }
+
+    def to_json(self, base64_rle: bool = False) -> Dict:
         """
         Convert the data to json format:
         {
@@ -64,12 +144,20 @@ class Data:
             "idx": 0,
             "segmentation": Coral segmentation following the coco format.
         }
+        If base64_rle is set, the RLE of the front end visualization of each
+        annotation is a base64 string, see rle_mask_to_rle_vis_encoding.
         """
 
-        # Convert the segmentation mask encoding to RLE for front end visualization
-        segmentation = copy.deepcopy(self.segmentation)
-        for annotation in segmentation["annotations"]:
-            annotation["rle"] = rle_mask_to_rle_vis_encoding(annotation["segmentation"])
+        # Convert the segmentation mask encoding to RLE for front end visualization.
+        # Only the annotations are copied, as the rest of the segmentation is unchanged
+        segmentation = dict(self.get_segmentation())
+        segmentation["annotations"] = [
+            {
+                **annotation,
+                "rle": self.get_vis_encoding(annotation["segmentation"], base64_rle),
+            }
+            for annotation in segmentation["annotations"]
+        ]
 
         return {
             "image_name": self.image_name,
@@ -95,19 +183,22 @@ class Dataset:
         self.category_info: List[Dict] = None
         self.status_info: List[Dict] = None
         self.last_saved_id = 0
+        self.embedding_store: EmbeddingStore = None
+
+        # Index of the data updated since the project is last saved
+        self.dirty_data_ids: Set[int] = set()
 
     def add_data(self, data: Data):
         """
         Add data to the dataset.
-        Need to verify the data is valid
+        Need to verify the data is valid. The embedding does not need to be
+        loaded, as long as the data can load it from an embedding store.
         """
         assert data.get_image_name() is not None, "Data has no image name"
         assert data.get_image_path() is not None, "Data has no image path"
+        assert data.has_embedding(), f"Data {data.get_image_name()} has no embedding"
         assert (
-            data.get_embedding() is not None
-        ), f"Data {data.get_image_name()} has no embedding"
-        assert (
-            data.get_segmentation() is not None
+            data.has_segmentation()
         ), f"Data {data.get_image_name()} has no segmentation"
         assert data.get_idx() != -1, f"Data {data.get_image_name()} has no index"
         assert (
@@ -123,7 +214,24 @@ class Dataset:
         assert data_idx in self.data, f"Data at index {data_idx} not found"
         data = self.data[data_idx]
         data.set_segmentation(segmentation)
+        data.invalidate_vis_encodings()
         self.last_saved_id = data_idx
+        self.dirty_data_ids.add(data_idx)
+
+    def get_dirty_data_ids(self) -> List[int]:
+        """
+        Get the sorted index of the data updated since the last save
+        """
+        return sorted(self.dirty_data_ids)
+
+    def clear_dirty_data_ids(self):
+        self.dirty_data_ids = set()
+
+    def set_embedding_store(self, embedding_store: EmbeddingStore):
+        self.embedding_store = embedding_store
+
+    def get_embedding_store(self) -> EmbeddingStore:
+        return self.embedding_store
 
     def get_last_saved_id(self) -> int:
         return self.last_saved_id
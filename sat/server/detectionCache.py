@@ -0,0 +1,59 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+from .diskCache import DiskCache
+from .embeddingCache import EmbeddingCache
+from typing import Dict, List
+
+
+class DetectionCache(DiskCache):
+    """
+    Persistent content-addressed cache of the coral detection results, shared by all the projects.
+
+    The candidate masks of an image are cached before they are filtered by area,
+    confidence and IoU, so detecting corals again on the same image with other
+    thresholds is only a filter pass. The masks are keyed by the hash of the image
+    content and the identity of the segmentation model and its configuration,
+    and by the embedding of the whole image when it is given in place of encoding
+    the image. Each entry is stored as <key>.json in the cache folder.
+    """
+
+    DEFAULT_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), "CoralSCOP-LAT", "detection_cache"
+    )
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    FILE_EXTENSION = ".json"
+
+    def __init__(
+        self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        super().__init__(cache_dir, max_bytes)
+
+    @staticmethod
+    def get_detector_identity(model_identity: str, config: Dict) -> str:
+        """
+        Identify the segmentation model together with the configuration of the
+        mask generator, which changes the candidate masks
+        """
+        sha256 = hashlib.sha256(model_identity.encode("utf-8"))
+        sha256.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def get_key(
+        image: np.ndarray, detector_identity: str, embedding: np.ndarray = None
+    ) -> str:
+        if embedding is not None:
+            detector_identity = EmbeddingCache.get_key(embedding, detector_identity)
+        return EmbeddingCache.get_key(image, detector_identity)
+
+    def read(self, path: str) -> List[Dict]:
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def write(self, f, masks: List[Dict]):
+        f.write(json.dumps(masks).encode("utf-8"))
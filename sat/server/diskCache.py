@@ -0,0 +1,124 @@
+import logging
+import os
+import tempfile
+import threading
+
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+
+class DiskCache(ABC):
+    """
+    Persistent least recently used cache of files, shared by all the projects.
+
+    Each entry is stored as <key><FILE_EXTENSION> in the cache folder, and is read and
+    written by the read and write methods of the subclass. The least recently used
+    entries are removed once the total size of the cache exceeds max_bytes.
+
+    The size of the cache is tracked by each process, so the cap is approximate
+    when several processes share the same cache folder.
+    """
+
+    FILE_EXTENSION = ""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Key is the cache key, and the value is the file size, from least to most recently used
+        self.entries: OrderedDict = OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+        self.load_entries()
+
+    def load_entries(self):
+        """
+        Index the cached entries, ordered by their last use
+        """
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(filename)
+            if ext != self.FILE_EXTENSION:
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, filename))
+            entries.append((stat.st_mtime, key, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self.entries[key] = size
+            self.cache_bytes += size
+        self.logger.info(
+            f"Indexed {len(self.entries)} cached entries ({self.cache_bytes / 1024 / 1024:.1f} MB) in {self.cache_dir}"
+        )
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}{self.FILE_EXTENSION}")
+
+    def get(self, key: str) -> Any:
+        """
+        Get the cached value, or None if it is not cached
+        """
+        path = self.get_path(key)
+        try:
+            value = self.read(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            with self.lock:
+                if key in self.entries:
+                    self.cache_bytes -= self.entries.pop(key)
+            return None
+
+        with self.lock:
+            if key not in self.entries:
+                # Added by another process sharing the cache folder
+                self.entries[key] = os.path.getsize(path)
+                self.cache_bytes += self.entries[key]
+            self.entries.move_to_end(key)
+        # The modification time orders the entries by their last use across runs
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key: str, value: Any):
+        path = self.get_path(key)
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            self.write(f, value)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if key in self.entries:
+                self.cache_bytes -= self.entries.pop(key)
+            self.entries[key] = os.path.getsize(path)
+            self.cache_bytes += self.entries[key]
+            self.evict()
+
+    @abstractmethod
+    def read(self, path: str) -> Any:
+        """
+        Read the value of an entry, raising FileNotFoundError, ValueError or EOFError
+        if the entry is missing or unreadable
+        """
+
+    @abstractmethod
+    def write(self, f, value: Any):
+        """
+        Write the value of an entry to the binary file f
+        """
+
+    def evict(self):
+        while self.cache_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.cache_bytes -= size
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+            self.logger.debug(f"Evicted cached entry {key}")
+
+    def get_cache_bytes(self) -> int:
+        return self.cache_bytes
@@ -1,27 +1,111 @@
 import numpy as np
-import torch
 import logging
 import onnxruntime as ort
+import threading
 import time
 from PIL import Image
-from segment_anything import sam_model_registry, SamPredictor
-from .util.onnx import preprocess_image
+from typing import List
+from .util.onnx import ImagePreprocessor
+from .embeddingCache import EmbeddingCache
 
 
 class EmbeddingGenerator:
-    def __init__(self, model_path):
+    def __init__(
+        self,
+        model_path,
+        num_threads: int = None,
+        embedding_cache: EmbeddingCache = None,
+    ):
+        """
+        num_threads limits the intra-op threads of ONNX Runtime,
+        all the cores are used by default.
+        If the embedding cache is given, it is consulted before running the encoder.
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info(f"Initializing {self.__class__.__name__} ...")
         self.logger.info(f"Loading model from {model_path}")
 
+        session_options = ort.SessionOptions()
+        if num_threads is not None:
+            self.logger.info(f"Using {num_threads} threads")
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = 1
+
         execution_providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
-        self.encoder = ort.InferenceSession(model_path, providers=execution_providers)
+        self.encoder = ort.InferenceSession(
+            model_path, sess_options=session_options, providers=execution_providers
+        )
+
+        self.embedding_cache = embedding_cache
+        self.model_identity = EmbeddingCache.get_model_identity(model_path)
+
+        # The input buffer is reused across the calls, which are serialized by the lock
+        self.preprocessor = ImagePreprocessor()
+        self.lock = threading.Lock()
+
+        # The batch axis of a model exported with a dynamic batch size is symbolic
+        batch_dim = self.encoder.get_inputs()[0].shape[0]
+        self.dynamic_batch = not isinstance(batch_dim, int)
+        self.logger.info(f"Dynamic batch encoder: {self.dynamic_batch}")
 
     def generate_embedding(self, image: np.ndarray) -> np.ndarray:
         start_time = time.time()
-        input_tensor = preprocess_image(Image.fromarray(image))
-        outputs = self.encoder.run(None, {"images": input_tensor})
+
+        key = None
+        if self.embedding_cache is not None:
+            key = EmbeddingCache.get_key(image, self.model_identity)
+            embedding = self.embedding_cache.get(key)
+            if embedding is not None:
+                self.logger.info(
+                    f"Loaded cached embedding in {time.time() - start_time:.2f} seconds"
+                )
+                return embedding
+
+        with self.lock:
+            input_tensor = self.preprocessor.preprocess(Image.fromarray(image))
+            outputs = self.encoder.run(None, {"images": input_tensor})
         self.logger.info(
             f"Generate embedding time: {time.time() - start_time:.2f} seconds"
         )
+
+        if key is not None:
+            self.embedding_cache.put(key, outputs[0])
         return outputs[0]
+
+    def generate_embeddings(self, images: List[np.ndarray]) -> List[np.ndarray]:
+        """
+        Generate the embeddings of a list of images. The images are preprocessed
+        into one batch, which is encoded by a single run of the encoder if the
+        model has a dynamic batch axis, otherwise the images are encoded one by one.
+        Each embedding has the same shape as the output of generate_embedding.
+        """
+        if not self.dynamic_batch:
+            return [self.generate_embedding(image) for image in images]
+
+        start_time = time.time()
+        embeddings = [None] * len(images)
+
+        keys = [None] * len(images)
+        if self.embedding_cache is not None:
+            for i, image in enumerate(images):
+                keys[i] = EmbeddingCache.get_key(image, self.model_identity)
+                embeddings[i] = self.embedding_cache.get(keys[i])
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            with self.lock:
+                input_tensor = self.preprocessor.preprocess_batch(
+                    [Image.fromarray(images[i]) for i in missing]
+                )
+                outputs = self.encoder.run(None, {"images": input_tensor})
+            for batch_idx, i in enumerate(missing):
+                # A copy of the row, so that the whole batch output is not kept
+                # alive by the cached embeddings
+                embeddings[i] = outputs[0][batch_idx : batch_idx + 1].copy()
+                if keys[i] is not None:
+                    self.embedding_cache.put(keys[i], embeddings[i])
+
+        self.logger.info(
+            f"Generate {len(images)} embeddings ({len(missing)} encoded) time: {time.time() - start_time:.2f} seconds"
+        )
+        return embeddings
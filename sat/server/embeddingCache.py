@@ -0,0 +1,64 @@
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+from .diskCache import DiskCache
+
+
+class EmbeddingCache(DiskCache):
+    """
+    Persistent content-addressed cache of image embeddings, shared by all the projects.
+
+    An embedding is keyed by the hash of the image content and the identity of the
+    encoder model, so the same image encoded by the same model is only encoded once,
+    whichever project it belongs to. Each embedding is stored as <key>.npy in the
+    cache folder. The least recently used embeddings are removed once the total size
+    of the cache exceeds max_bytes.
+    """
+
+    DEFAULT_CACHE_DIR = os.path.join(
+        tempfile.gettempdir(), "CoralSCOP-LAT", "embedding_cache"
+    )
+    DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+    # Bytes of the model file hashed from the beginning and the end of the file
+    MODEL_CHECKSUM_BYTES = 1024 * 1024
+
+    FILE_EXTENSION = ".npy"
+
+    def __init__(
+        self, cache_dir: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        super().__init__(cache_dir, max_bytes)
+
+    @staticmethod
+    def get_model_identity(model_path: str) -> str:
+        """
+        Identify the model by its path, its size and the checksum of its first
+        and last MODEL_CHECKSUM_BYTES bytes, so that large models are identified
+        without reading the whole file.
+        """
+        size = os.path.getsize(model_path)
+        sha256 = hashlib.sha256()
+        sha256.update(os.path.abspath(model_path).encode("utf-8"))
+        sha256.update(str(size).encode("utf-8"))
+        with open(model_path, "rb") as f:
+            sha256.update(f.read(EmbeddingCache.MODEL_CHECKSUM_BYTES))
+            f.seek(max(0, size - EmbeddingCache.MODEL_CHECKSUM_BYTES))
+            sha256.update(f.read(EmbeddingCache.MODEL_CHECKSUM_BYTES))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def get_key(image: np.ndarray, model_identity: str) -> str:
+        image = np.ascontiguousarray(image)
+        sha256 = hashlib.sha256(model_identity.encode("utf-8"))
+        sha256.update(f"{image.shape}{image.dtype}".encode("utf-8"))
+        sha256.update(memoryview(image).cast("B"))
+        return sha256.hexdigest()
+
+    def read(self, path: str) -> np.ndarray:
+        return np.load(path)
+
+    def write(self, f, embedding: np.ndarray):
+        np.save(f, embedding)
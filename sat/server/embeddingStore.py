@@ -0,0 +1,81 @@
+import logging
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+# Optional packed embedding layout: all the embeddings are stacked, in the order
+# of the image names listed in the index file, into a single uncompressed .npy
+# file, which can be memory-mapped directly, even from inside the project file.
+PACKED_EMBEDDING_FILE = "packed_embeddings.npy"
+PACKED_EMBEDDING_INDEX_FILE = "packed_embeddings.json"
+
+
+class EmbeddingStore:
+    """
+    Bounded LRU cache of image embeddings.
+
+    Embeddings are read from the source on a cache miss. The source can be any
+    object providing read_embedding(image_name) and is_memory_mapped(), e.g. a
+    ProjectArchive. The least recently used embeddings are evicted once the
+    total size of the cached embeddings exceeds max_bytes. The most recently
+    used embedding is always kept, even if it alone exceeds the budget.
+
+    Memory-mapped embeddings are zero-copy slices of the mapped file,
+    so they are returned directly without being cached.
+    """
+
+    DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+    def __init__(self, source, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.source = source
+        self.max_bytes = max_bytes
+
+        self.cache: OrderedDict = OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, image_name: str) -> np.ndarray:
+        if self.source.is_memory_mapped():
+            return self.source.read_embedding(image_name)
+
+        with self.lock:
+            if image_name in self.cache:
+                self.cache.move_to_end(image_name)
+                return self.cache[image_name]
+
+        embedding = self.source.read_embedding(image_name)
+        self.put(image_name, embedding)
+        return embedding
+
+    def put(self, image_name: str, embedding: np.ndarray):
+        with self.lock:
+            if image_name in self.cache:
+                self.cache_bytes -= self.cache.pop(image_name).nbytes
+            self.cache[image_name] = embedding
+            self.cache_bytes += embedding.nbytes
+            self.evict()
+
+    def contains(self, image_name: str) -> bool:
+        with self.lock:
+            return image_name in self.cache
+
+    def evict(self):
+        while self.cache_bytes > self.max_bytes and len(self.cache) > 1:
+            image_name, embedding = self.cache.popitem(last=False)
+            self.cache_bytes -= embedding.nbytes
+            self.logger.debug(f"Evicted embedding of {image_name}")
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.cache_bytes = 0
+
+    def set_max_bytes(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def get_cache_bytes(self) -> int:
+        return self.cache_bytes
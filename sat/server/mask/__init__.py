@@ -1,2 +1,3 @@
 from .maskCreator import MaskCreator
 from .prompt import Prompt
+from .packedMask import PackedMask
@@ -1,14 +1,64 @@
 import logging
+import time
 
 import numpy as np
 import onnxruntime as ort
 
-from typing import List
+from collections import deque
+from typing import Dict, List, Tuple
 from ..transforms import ResizeLongestSide
 from .prompt import Prompt
 
 
+def bilinear_source_indices(
+    in_size: int, out_size: int, start: int, stop: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Source indices and weights of the output pixels [start, stop) of a bilinear
+    resize from in_size to out_size along an axis, with align_corners=False
+    """
+    scale = in_size / out_size
+    source = np.arange(start, stop, dtype=np.float32) + 0.5
+    source = np.maximum(source * np.float32(scale) - 0.5, 0)
+    idx0 = np.minimum(source.astype(np.int64), in_size - 1)
+    idx1 = np.minimum(idx0 + 1, in_size - 1)
+    return idx0, idx1, source - idx0
+
+
+def bilinear_interpolate(
+    x: np.ndarray,
+    rows: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    cols: Tuple[np.ndarray, np.ndarray, np.ndarray],
+) -> np.ndarray:
+    row0, row1, row_weight = rows
+    col0, col1, col_weight = cols
+    x = x[row0] * (1 - row_weight)[:, None] + x[row1] * row_weight[:, None]
+    return x[:, col0] * (1 - col_weight) + x[:, col1] * col_weight
+
+
 class MaskCreator:
+    """
+    Decode the masks of the prompts on the image being labeled.
+
+    The prompt-independent inputs of the decoder are prepared once per image. The
+    embedding is bound to the device of the session with an IOBinding, so it is
+    not copied on every click, and the size of the image is only converted once.
+
+    create_mask returns the full resolution mask upscaled by the decoder.
+    create_cropped_mask runs the decoder at the resolution of the encoder input
+    and only upscales the low resolution logits within the box of the mask,
+    which is how the interactive prompts are decoded. create_cropped_masks decodes
+    many independent objects the same way, in batches.
+    """
+
+    # Threshold of the mask logits
+    MASK_THRESHOLD = 0.5
+
+    # Maximum number of objects decoded in one run of the decoder
+    MAX_BATCH_SIZE = 64
+
+    # Number of the latest clicks whose latency is kept
+    LATENCY_WINDOW = 1000
 
     def __init__(self, onnx_path: str):
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -17,64 +67,270 @@ class MaskCreator:
         self.ort_session = ort.InferenceSession(
             onnx_path, providers=["CUDAExecutionProvider", "CPUExecutionProvider"]
         )
+        self.device = "cpu"
+        if "CUDAExecutionProvider" in self.ort_session.get_providers():
+            self.device = "cuda"
+        self.output_names = [output.name for output in self.ort_session.get_outputs()]
+        # Decoders exported with a dynamic batch axis decode several objects at once
+        point_coords_shape = [
+            input.shape
+            for input in self.ort_session.get_inputs()
+            if input.name == "point_coords"
+        ][0]
+        self.dynamic_batch = not isinstance(point_coords_shape[0], int)
+
         self.image: np.ndarray = None
         self.image_embedding: np.ndarray = None
         self.image_size = None
         self.inputs: List = None
 
+        # Prompt-independent inputs of the image, see set_image
+        self.io_binding: ort.IOBinding = None
+        self.image_embedding_value: ort.OrtValue = None
+        self.orig_im_size: np.ndarray = None
+        self.input_size: Tuple[int, int] = None
+        self.input_im_size: np.ndarray = None
+        self.coord_scale: np.ndarray = None
+
         self.default_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
         self.default_has_mask_input = np.zeros(1, dtype=np.float32)
+        self.has_mask_input = np.ones(1, dtype=np.float32)
         self.transforms = ResizeLongestSide(1024)
 
         self.low_res_logits = None
 
+        # Seconds of the latest clicks
+        self.latencies: deque = deque(maxlen=MaskCreator.LATENCY_WINDOW)
+
     def set_image(self, image_embedding: np.ndarray, image_size: List[int]):
         self.image_embedding = image_embedding
         self.image_size = image_size
         self.low_res_logits = None
 
-    def create_mask(self, prompts: List[Prompt]) -> np.ndarray:
-        self.logger.info(f"Creating mask with {len(prompts)} prompts ...")
-        if len(prompts) == 0:
-            return np.zeros(self.image_size, dtype=np.uint8)
-
-        input_points = []
-        for prompt in prompts:
-            input_points.append([prompt.get_x(), prompt.get_y()])
+        self.orig_im_size = np.array(image_size, dtype=np.float32)
+        self.input_size = self.transforms.get_preprocess_shape(
+            image_size[0], image_size[1], self.transforms.target_length
+        )
+        self.input_im_size = np.array(self.input_size, dtype=np.float32)
+        # Same as ResizeLongestSide.apply_coords, (x, y) from the image to the input
+        self.coord_scale = np.array(
+            [
+                self.input_size[1] / image_size[1],
+                self.input_size[0] / image_size[0],
+            ]
+        )
 
-        input_labels = []
-        for prompt in prompts:
-            input_labels.append(prompt.get_label())
+        self.image_embedding_value = ort.OrtValue.ortvalue_from_numpy(
+            np.ascontiguousarray(image_embedding, dtype=np.float32), self.device, 0
+        )
+        self.io_binding = self.ort_session.io_binding()
+        self.io_binding.bind_ortvalue_input(
+            "image_embeddings", self.image_embedding_value
+        )
+        for output_name in self.output_names:
+            self.io_binding.bind_output(output_name, "cpu")
 
-        onnx_coord = np.array(input_points, dtype=np.float32)[None, :, :]
-        onnx_coord = self.transforms.apply_coords(onnx_coord, self.image_size).astype(
-            np.float32
+    def run_decoder(
+        self,
+        objects: List[List[Prompt]],
+        orig_im_size: np.ndarray,
+        mask_input: np.ndarray,
+        has_mask_input: np.ndarray,
+    ) -> List[np.ndarray]:
+        """
+        Run the decoder with the bound embedding of the image on a batch of objects,
+        which all have the same number of prompts
+        """
+        onnx_coord = np.array(
+            [
+                [[prompt.get_x(), prompt.get_y()] for prompt in prompts]
+                for prompts in objects
+            ],
+            dtype=np.float32,
         )
+        onnx_coord = (onnx_coord * self.coord_scale).astype(np.float32)
 
-        onnx_label = np.array(input_labels, dtype=np.float32)[None, :].astype(
-            np.float32
+        onnx_label = np.array(
+            [[prompt.get_label() for prompt in prompts] for prompts in objects],
+            dtype=np.float32,
         )
 
+        self.io_binding.bind_cpu_input("point_coords", onnx_coord)
+        self.io_binding.bind_cpu_input("point_labels", onnx_label)
+        self.io_binding.bind_cpu_input("mask_input", mask_input)
+        self.io_binding.bind_cpu_input("has_mask_input", has_mask_input)
+        self.io_binding.bind_cpu_input("orig_im_size", orig_im_size)
+
+        self.ort_session.run_with_iobinding(self.io_binding)
+        return self.io_binding.copy_outputs_to_cpu()
+
+    def refine_mask(
+        self, prompts: List[Prompt], orig_im_size: np.ndarray
+    ) -> List[np.ndarray]:
+        """
+        Run the decoder on the prompts, refining the previous mask if any
+        """
         if self.low_res_logits is not None:
             mask_input = self.low_res_logits
-            has_mask_input = np.ones(1, dtype=np.float32)
+            has_mask_input = self.has_mask_input
         else:
             mask_input = self.default_mask_input
             has_mask_input = self.default_has_mask_input
 
-        ort_inputs = {
-            "image_embeddings": self.image_embedding,
-            "point_coords": onnx_coord,
-            "point_labels": onnx_label,
-            "mask_input": mask_input,
-            "has_mask_input": has_mask_input,
-            "orig_im_size": np.array(self.image_size, dtype=np.float32),
-        }
-
-        mask, _, low_res_logits = self.ort_session.run(None, ort_inputs)
-        mask = mask > 0.5
-        mask = mask.squeeze()
+        outputs = self.run_decoder([prompts], orig_im_size, mask_input, has_mask_input)
+        self.low_res_logits = outputs[2]
+        return outputs
+
+    def create_mask(self, prompts: List[Prompt]) -> np.ndarray:
+        self.logger.info(f"Creating mask with {len(prompts)} prompts ...")
+        if len(prompts) == 0:
+            return np.zeros(self.image_size, dtype=np.uint8)
 
-        self.low_res_logits = low_res_logits
+        start_time = time.perf_counter()
+        mask, _, _ = self.refine_mask(prompts, self.orig_im_size)
+        mask = mask > MaskCreator.MASK_THRESHOLD
+        mask = mask.squeeze()
+        self.add_latency(time.perf_counter() - start_time)
 
         return mask
+
+    def create_cropped_mask(
+        self, prompts: List[Prompt]
+    ) -> Tuple[np.ndarray, int, int, np.ndarray]:
+        """
+        Create the mask of the prompts, cropped to the box of the mask.
+
+        Returns:
+        - np.ndarray: The full resolution mask within the box
+        - int: x of the top left corner of the box
+        - int: y of the top left corner of the box
+        - np.ndarray: The low resolution logits of the decoder, (1, 1, 256, 256)
+        """
+        self.logger.info(f"Creating cropped mask with {len(prompts)} prompts ...")
+        if len(prompts) == 0:
+            return np.zeros((0, 0), dtype=bool), 0, 0, None
+
+        start_time = time.perf_counter()
+        # The decoder output is not upscaled to the image size, only the logits are used
+        self.refine_mask(prompts, self.input_im_size)
+        mask, x0, y0 = self.upscale_low_res_logits(self.low_res_logits[0, 0])
+        self.add_latency(time.perf_counter() - start_time)
+
+        return mask, x0, y0, self.low_res_logits
+
+    def create_cropped_masks(
+        self, objects: List[List[Prompt]]
+    ) -> List[Tuple[np.ndarray, int, int]]:
+        """
+        Create the masks of independent objects, each from its own prompts, cropped
+        to the box of each mask, see create_cropped_mask. The previous mask is
+        neither refined nor replaced.
+
+        The objects with the same number of prompts are decoded in one run of the
+        decoder if it has a dynamic batch axis, otherwise one by one.
+        """
+        self.logger.info(f"Creating cropped masks of {len(objects)} objects ...")
+        start_time = time.perf_counter()
+
+        empty_mask = (np.zeros((0, 0), dtype=bool), 0, 0)
+        masks = [empty_mask] * len(objects)
+
+        # The prompts of a batch are stacked, so they must have the same number of points
+        batches: Dict[int, List[int]] = {}
+        for idx, prompts in enumerate(objects):
+            if len(prompts) > 0:
+                batches.setdefault(len(prompts), []).append(idx)
+
+        batch_size = MaskCreator.MAX_BATCH_SIZE if self.dynamic_batch else 1
+        run_num = 0
+        for indices in batches.values():
+            for i in range(0, len(indices), batch_size):
+                batch = indices[i : i + batch_size]
+                _, _, low_res_logits = self.run_decoder(
+                    [objects[idx] for idx in batch],
+                    self.input_im_size,
+                    self.default_mask_input,
+                    self.default_has_mask_input,
+                )
+                for idx, logits in zip(batch, low_res_logits):
+                    masks[idx] = self.upscale_low_res_logits(logits[0])
+                run_num += 1
+
+        self.logger.info(
+            f"Created {len(objects)} masks with {run_num} decoder runs in "
+            f"{(time.perf_counter() - start_time) * 1000:.1f} ms"
+        )
+        return masks
+
+    def upscale_low_res_logits(self, logits: np.ndarray) -> Tuple[np.ndarray, int, int]:
+        """
+        Threshold the low resolution logits upscaled to the image size within the
+        box of the mask, same as the postprocessing of the decoder: the logits are
+        upscaled to the padded input size, cropped to the input size, and upscaled
+        to the image size.
+
+        An upscaled pixel is above the threshold only if one of the pixels it is
+        interpolated from is above the threshold, so the rows and columns of the box are found by following
+        the interpolation of each row and column from the low resolution rows and
+        columns above the threshold.
+        """
+        height, width = self.image_size
+        input_height, input_width = self.input_size
+        padded_size = self.transforms.target_length
+        low_res_height, low_res_width = logits.shape
+        positive = logits > MaskCreator.MASK_THRESHOLD
+
+        def get_range(positive_lines, low_res_size, input_size, size):
+            low_res = bilinear_source_indices(low_res_size, padded_size, 0, input_size)
+            padded_positive = positive_lines[low_res[0]] | positive_lines[low_res[1]]
+            full_res = bilinear_source_indices(input_size, size, 0, size)
+            lines = np.flatnonzero(
+                padded_positive[full_res[0]] | padded_positive[full_res[1]]
+            )
+            if len(lines) == 0:
+                return 0, 0
+            return int(lines[0]), int(lines[-1]) + 1
+
+        y0, y1 = get_range(positive.any(axis=1), low_res_height, input_height, height)
+        x0, x1 = get_range(positive.any(axis=0), low_res_width, input_width, width)
+        if y0 == y1 or x0 == x1:
+            return np.zeros((0, 0), dtype=bool), 0, 0
+
+        # Rows and columns of the input size logits which the box is interpolated from
+        rows = bilinear_source_indices(input_height, height, y0, y1)
+        cols = bilinear_source_indices(input_width, width, x0, x1)
+        input_y0, input_y1 = int(rows[0][0]), int(rows[1][-1]) + 1
+        input_x0, input_x1 = int(cols[0][0]), int(cols[1][-1]) + 1
+
+        input_logits = bilinear_interpolate(
+            logits,
+            bilinear_source_indices(low_res_height, padded_size, input_y0, input_y1),
+            bilinear_source_indices(low_res_width, padded_size, input_x0, input_x1),
+        )
+        mask_logits = bilinear_interpolate(
+            input_logits,
+            (rows[0] - input_y0, rows[1] - input_y0, rows[2]),
+            (cols[0] - input_x0, cols[1] - input_x0, cols[2]),
+        )
+        return mask_logits > MaskCreator.MASK_THRESHOLD, x0, y0
+
+    def add_latency(self, latency: float):
+        self.latencies.append(latency)
+        percentiles = self.get_latency_percentiles()
+        self.logger.info(
+            f"Mask created in {latency * 1000:.1f} ms, "
+            f"p50 {percentiles['p50']:.1f} ms, p90 {percentiles['p90']:.1f} ms, "
+            f"p99 {percentiles['p99']:.1f} ms over {len(self.latencies)} clicks"
+        )
+
+    def get_latency_percentiles(self) -> Dict[str, float]:
+        """
+        Percentiles of the latency in milliseconds of the latest clicks
+        """
+        if len(self.latencies) == 0:
+            return {"p50": 0.0, "p90": 0.0, "p99": 0.0}
+        p50, p90, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 90, 99])
+        return {"p50": float(p50), "p90": float(p90), "p99": float(p99)}
+
+    def reset_latencies(self):
+        self.latencies.clear()
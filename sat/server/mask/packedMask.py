@@ -0,0 +1,200 @@
+import numpy as np
+
+from pycocotools import mask as coco_mask
+from typing import Dict, List, Tuple
+from ..segment_anything.utils.amg_numpy import rle_to_cropped_mask
+from ..util.coco import decode_rle_counts
+
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+class PackedMask:
+    """
+    Binary mask stored with one bit per pixel, cropped to the bounding box of the mask.
+
+    The rows of the bounding box are packed with np.packbits from a column aligned
+    to a multiple of 8, so the bytes of any two masks of the same image cover the
+    same image columns, and their intersection is a bitwise AND of the overlapping bytes.
+    The box (x0, y0, x1, y1) excludes x1 and y1. An empty mask has an empty box.
+    """
+
+    def __init__(
+        self,
+        bits: np.ndarray,
+        height: int,
+        width: int,
+        box: Tuple[int, int, int, int],
+        area: int,
+    ):
+        self.bits = bits
+        self.height = height
+        self.width = width
+        self.box = box
+        self.area = area
+
+    @staticmethod
+    def from_numpy(mask: np.ndarray) -> "PackedMask":
+        height, width = mask.shape
+        return PackedMask.from_crop(mask, 0, 0, height, width)
+
+    @staticmethod
+    def from_crop(
+        mask: np.ndarray, crop_x0: int, crop_y0: int, height: int, width: int
+    ) -> "PackedMask":
+        """
+        Pack the crop of a mask of the given image size, whose top left corner is
+        (crop_x0, crop_y0), knowing that the mask is empty outside of the crop
+        """
+        mask = mask > 0
+        rows = np.flatnonzero(mask.any(axis=1))
+        if len(rows) == 0:
+            return PackedMask(
+                np.zeros((0, 0), dtype=np.uint8), height, width, (0, 0, 0, 0), 0
+            )
+        cols = np.flatnonzero(mask.any(axis=0))
+
+        y0, y1 = crop_y0 + int(rows[0]), crop_y0 + int(rows[-1]) + 1
+        x0, x1 = crop_x0 + int(cols[0]), crop_x0 + int(cols[-1]) + 1
+        aligned_x0 = x0 // 8 * 8
+        box_mask = mask[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1]
+        if aligned_x0 < x0:
+            box_mask = np.pad(box_mask, ((0, 0), (x0 - aligned_x0, 0)))
+        bits = np.packbits(box_mask, axis=1)
+        area = int(POPCOUNT[bits].sum(dtype=np.int64))
+        return PackedMask(bits, height, width, (x0, y0, x1, y1), area)
+
+    @staticmethod
+    def from_rle(segmentation: Dict) -> "PackedMask":
+        """
+        Pack a COCO RLE mask, with either compressed or uncompressed counts.
+        Only the columns of the box of the mask are decoded.
+        """
+        height, width = segmentation["size"]
+        counts = segmentation["counts"]
+        if not isinstance(counts, list):
+            counts = decode_rle_counts(counts)
+        mask, x0, y0 = rle_to_cropped_mask({"size": [height, width], "counts": counts})
+        return PackedMask.from_crop(mask, x0, y0, height, width)
+
+    def is_empty(self) -> bool:
+        return self.area == 0
+
+    def get_area(self) -> int:
+        return self.area
+
+    def get_size(self) -> Tuple[int, int]:
+        return self.height, self.width
+
+    def get_box(self) -> Tuple[int, int, int, int]:
+        """
+        Bounding box in (x0, y0, x1, y1) format, excluding x1 and y1
+        """
+        return self.box
+
+    def get_bbox(self) -> List[int]:
+        """
+        Bounding box in COCO (x, y, width, height) format
+        """
+        x0, y0, x1, y1 = self.box
+        return [x0, y0, x1 - x0, y1 - y0]
+
+    def get_nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def get_aligned_x0(self) -> int:
+        return self.box[0] // 8 * 8
+
+    def unpack(self) -> np.ndarray:
+        """
+        Unpack the mask within its bounding box
+        """
+        x0, y0, x1, y1 = self.box
+        aligned_x0 = self.get_aligned_x0()
+        bits = np.unpackbits(self.bits, axis=1, count=x1 - aligned_x0)
+        return bits[:, x0 - aligned_x0 :].astype(bool)
+
+    def to_numpy(self) -> np.ndarray:
+        mask = np.zeros((self.height, self.width), dtype=bool)
+        if not self.is_empty():
+            x0, y0, x1, y1 = self.box
+            mask[y0:y1, x0:x1] = self.unpack()
+        return mask
+
+    def to_uncompressed_rle(self) -> Dict:
+        """
+        Encode the mask into an uncompressed RLE in column-major order,
+        same as mask_to_rle_pytorch of the automatic mask generator.
+        """
+        size = self.height * self.width
+        if self.is_empty():
+            return {"size": [self.height, self.width], "counts": [size]}
+
+        x0, y0, x1, y1 = self.box
+        # Pad each column of the box with zeros, so that every run starts and ends within its column
+        padded = np.zeros((y1 - y0 + 2, x1 - x0), dtype=np.int8)
+        padded[1:-1] = self.unpack()
+        cols, rows = np.nonzero(np.diff(padded, axis=0).T)
+        changes = (x0 + cols) * self.height + y0 + rows
+
+        # A run which ends at the bottom of a column and continues at the top of the
+        # next column gives the same change twice, which cancel each other
+        changes, counts = np.unique(changes, return_counts=True)
+        changes = changes[(counts == 1) & (changes < size)]
+
+        run_lengths = np.diff(np.concatenate(([0], changes, [size])))
+        return {"size": [self.height, self.width], "counts": run_lengths.tolist()}
+
+    def to_rle(self) -> Dict:
+        """
+        Encode the mask into a COCO RLE, with the counts as a string
+        """
+        rle = coco_mask.frPyObjects(self.to_uncompressed_rle(), self.height, self.width)
+        rle["counts"] = rle["counts"].decode("utf-8")
+        return rle
+
+    def intersection(self, other: "PackedMask") -> int:
+        if self.is_empty() or other.is_empty():
+            return 0
+
+        y0 = max(self.box[1], other.box[1])
+        y1 = min(self.box[3], other.box[3])
+        x0 = max(self.box[0], other.box[0])
+        x1 = min(self.box[2], other.box[2])
+        if x0 >= x1 or y0 >= y1:
+            return 0
+
+        # The overlapping bytes, relative to the packed columns of each mask
+        byte0 = x0 // 8
+        byte1 = (x1 + 7) // 8
+        self_byte0 = self.get_aligned_x0() // 8
+        other_byte0 = other.get_aligned_x0() // 8
+
+        self_bits = self.bits[
+            y0 - self.box[1] : y1 - self.box[1],
+            byte0 - self_byte0 : byte1 - self_byte0,
+        ]
+        other_bits = other.bits[
+            y0 - other.box[1] : y1 - other.box[1],
+            byte0 - other_byte0 : byte1 - other_byte0,
+        ]
+        return int(POPCOUNT[self_bits & other_bits].sum(dtype=np.int64))
+
+    def union(self, other: "PackedMask") -> int:
+        return self.area + other.area - self.intersection(other)
+
+    def iou(self, other: "PackedMask") -> float:
+        intersection = self.intersection(other)
+        union = self.area + other.area - intersection
+        return intersection / max(union, 1)
+
+
+def packed_mask_boxes(masks: List[PackedMask]) -> np.ndarray:
+    """
+    Get the boxes of the masks as a (N, 4) array in (x0, y0, x1, y1) format
+    """
+    return np.array([mask.get_box() for mask in masks], dtype=np.int64).reshape(-1, 4)
+
+
+def packed_mask_areas(masks: List[PackedMask]) -> np.ndarray:
+    return np.array([mask.get_area() for mask in masks], dtype=np.int64)
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+import numpy as np
+
+from typing import Dict, List
+from ..embeddingStore import PACKED_EMBEDDING_FILE, PACKED_EMBEDDING_INDEX_FILE
+from ..util.data import seek_zip_member_data
+
+IMAGE_FOLDER = "images"
+EMBEDDING_FOLDER = "embeddings"
+ANNOTATION_FOLDER = "annotations"
+PROJECT_INFO_FILE = "project_info.json"
+
+
+class ProjectArchive:
+    """
+    Random access reader of a .coral project file.
+
+    Only the central directory of the zip file is read when the archive is opened.
+    The members of an image (image file, embedding and annotation json) are indexed
+    by the image file name and are read from the archive only when they are requested.
+    """
+
+    def __init__(self, project_path: str):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.project_path = project_path
+
+        self.archive: zipfile.ZipFile = None
+        # Key is the image file name, and the value is the member names of the image
+        self.index: Dict[str, Dict[str, str]] = {}
+        self.lock = threading.RLock()
+
+        # Packed embeddings, and the row of each image in the packed embeddings
+        self.packed_embeddings: np.ndarray = None
+        self.packed_rows: Dict[str, int] = None
+        # Temporary file of the decompressed packed embeddings, if the member is compressed
+        self.packed_embeddings_path: str = None
+
+        self.open()
+
+    def open(self):
+        """
+        Open the archive and build the member index from the central directory.
+        """
+        with self.lock:
+            if self.archive is not None:
+                return
+
+            self.archive = zipfile.ZipFile(self.project_path, "r")
+            self.index = self.build_index(self.archive.namelist())
+            self.logger.info(
+                f"Indexed {len(self.index)} images from {self.project_path}"
+            )
+
+            packed_index_member = f"{EMBEDDING_FOLDER}/{PACKED_EMBEDDING_INDEX_FILE}"
+            if packed_index_member in self.archive.NameToInfo:
+                with self.archive.open(packed_index_member) as f:
+                    image_names = json.load(f)["image_names"]
+                self.packed_rows = {name: row for row, name in enumerate(image_names)}
+
+    def close(self):
+        """
+        Close the archive. The archive is re-opened on the next read, so that it
+        can be closed while the project file is being overwritten.
+        """
+        with self.lock:
+            if self.archive is None:
+                return
+            self.archive.close()
+            self.archive = None
+            self.packed_embeddings = None
+            self.packed_rows = None
+            self.remove_packed_embeddings_file()
+
+    def remove_packed_embeddings_file(self):
+        if self.packed_embeddings_path is None:
+            return
+        try:
+            os.remove(self.packed_embeddings_path)
+        except OSError as e:
+            # The file is still mapped by an embedding in use on Windows
+            self.logger.warning(f"Error removing {self.packed_embeddings_path}: {e}")
+        self.packed_embeddings_path = None
+
+    def build_index(self, member_names: List[str]) -> Dict[str, Dict[str, str]]:
+        image_members = {}
+        stem_to_image_name = {}
+        for member_name in member_names:
+            folder, _, filename = member_name.partition("/")
+            if folder == IMAGE_FOLDER and filename:
+                image_members[filename] = {"image": member_name}
+                stem_to_image_name[os.path.splitext(filename)[0]] = filename
+
+        for member_name in member_names:
+            folder, _, filename = member_name.partition("/")
+            stem, ext = os.path.splitext(filename)
+            if stem not in stem_to_image_name:
+                continue
+
+            members = image_members[stem_to_image_name[stem]]
+            if folder == EMBEDDING_FOLDER and ext == ".npy":
+                members["embedding"] = member_name
+            elif folder == ANNOTATION_FOLDER and ext == ".json":
+                members["annotation"] = member_name
+
+        return image_members
+
+    def get_image_names(self) -> List[str]:
+        """
+        Get the image file names in the archive, sorted by name.
+        """
+        self.open()
+        return sorted(self.index.keys())
+
+    def get_member_name(self, image_name: str, member_type: str) -> str:
+        self.open()
+        assert image_name in self.index, f"Image {image_name} not found in project"
+        members = self.index[image_name]
+        assert (
+            member_type in members
+        ), f"Image {image_name} has no {member_type} in project"
+        return members[member_type]
+
+    def read_project_info(self) -> Dict:
+        with self.lock:
+            self.open()
+            with self.archive.open(PROJECT_INFO_FILE) as f:
+                return json.load(f)
+
+    def read_annotation(self, image_name: str) -> Dict:
+        member_name = self.get_member_name(image_name, "annotation")
+        with self.lock:
+            self.open()
+            with self.archive.open(member_name) as f:
+                return json.load(f)
+
+    def is_memory_mapped(self) -> bool:
+        """
+        Whether the embeddings are sliced from a memory-mapped packed member,
+        in which case they do not need to be cached in memory.
+        """
+        self.open()
+        return self.packed_rows is not None
+
+    def get_packed_embeddings(self) -> np.ndarray:
+        """
+        Memory-map the packed embeddings member. A compressed member is decompressed
+        to a temporary file, which is memory-mapped and removed when the archive is closed.
+        """
+        with self.lock:
+            self.open()
+            if self.packed_embeddings is not None:
+                return self.packed_embeddings
+
+            member_name = f"{EMBEDDING_FOLDER}/{PACKED_EMBEDDING_FILE}"
+            info = self.archive.getinfo(member_name)
+            if info.compress_type != zipfile.ZIP_STORED:
+                # Decompressed once to a temporary file, which is memory-mapped
+                # in place of the member
+                self.logger.warning(
+                    f"{member_name} is compressed, it is decompressed to a temporary file"
+                )
+                fd, self.packed_embeddings_path = tempfile.mkstemp(suffix=".npy")
+                with self.archive.open(member_name) as src, os.fdopen(fd, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                self.packed_embeddings = np.load(
+                    self.packed_embeddings_path, mmap_mode="r"
+                )
+                return self.packed_embeddings
+
+            with open(self.project_path, "rb") as f:
+                seek_zip_member_data(f, info)
+
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                else:
+                    header = np.lib.format.read_array_header_2_0(f)
+                shape, fortran_order, dtype = header
+                offset = f.tell()
+
+            self.packed_embeddings = np.memmap(
+                self.project_path,
+                dtype=dtype,
+                mode="r",
+                offset=offset,
+                shape=shape,
+                order="F" if fortran_order else "C",
+            )
+            return self.packed_embeddings
+
+    def read_embedding(self, image_name: str) -> np.ndarray:
+        self.open()
+        if self.packed_rows is not None:
+            assert (
+                image_name in self.packed_rows
+            ), f"Image {image_name} has no packed embedding in project"
+            return self.get_packed_embeddings()[self.packed_rows[image_name]]
+
+        member_name = self.get_member_name(image_name, "embedding")
+        with self.lock:
+            self.open()
+            with self.archive.open(member_name) as f:
+                return np.lib.format.read_array(f)
+
+    def read_image(self, image_name: str) -> bytes:
+        member_name = self.get_member_name(image_name, "image")
+        with self.lock:
+            self.open()
+            return self.archive.read(member_name)
+
+    def extract_image(self, image_name: str, output_path: str):
+        """
+        Copy the encoded image file to the output path without decoding it.
+        """
+        member_name = self.get_member_name(image_name, "image")
+        with self.lock:
+            self.open()
+            with self.archive.open(member_name) as src, open(output_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import numpy as np
+
+from ..util.requests import ProjectCreateRequest
+from typing import Dict, List, Tuple
+
+
+class ProjectCheckpoint:
+    """
+    Per-image outputs of a project creation, kept next to the output file
+    so that a terminated or crashed creation can be resumed.
+
+    The outputs of an image are keyed by the hash of the image content, the
+    request config and the identity of the models, so an image is only skipped on
+    resume if it is unchanged and it would be processed with the same config by
+    the same models. The embedding is stored as <key>.npy and the filtered masks
+    as <key>.json.
+    """
+
+    CHECKPOINT_SUFFIX = ".checkpoint"
+
+    def __init__(
+        self, output_file: str, request: ProjectCreateRequest, model_identity: str
+    ):
+        """
+        model_identity identifies the embedding and segmentation models and the backend,
+        see EmbeddingCache.get_model_identity and CoralSegmentation.detector_identity.
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.checkpoint_dir = output_file + ProjectCheckpoint.CHECKPOINT_SUFFIX
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        config = {
+            "minArea": request.get_min_area(),
+            "minConfidence": request.get_min_confidence(),
+            "maxIOU": request.get_max_iou(),
+            "need_segmentation": request.need_segmentation(),
+            "model": model_identity,
+        }
+        self.config_hash = hashlib.sha256(
+            json.dumps(config, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def get_image_key(self, image: np.ndarray) -> str:
+        image = np.ascontiguousarray(image)
+        sha256 = hashlib.sha256(self.config_hash.encode("utf-8"))
+        sha256.update(str(image.shape).encode("utf-8"))
+        sha256.update(memoryview(image).cast("B"))
+        return sha256.hexdigest()
+
+    def get_embedding_path(self, key: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{key}.npy")
+
+    def get_masks_path(self, key: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{key}.json")
+
+    def contains(self, key: str) -> bool:
+        # The embedding is saved last, so it marks the outputs as complete
+        return os.path.exists(self.get_embedding_path(key))
+
+    def load(self, key: str) -> Tuple[np.ndarray, List[Dict]]:
+        with open(self.get_masks_path(key)) as f:
+            masks = json.load(f)
+        embedding = np.load(self.get_embedding_path(key))
+        return embedding, masks
+
+    def save(self, key: str, embedding: np.ndarray, masks: List[Dict]):
+        """
+        Save the outputs of an image. Each file is written to a temporary file
+        first, so that an interrupted save never leaves a truncated checkpoint.
+        """
+        masks_path = self.get_masks_path(key)
+        with open(masks_path + ".tmp", "w") as f:
+            json.dump(masks, f)
+        os.replace(masks_path + ".tmp", masks_path)
+
+        embedding_path = self.get_embedding_path(key)
+        with open(embedding_path + ".tmp", "wb") as f:
+            np.save(f, embedding)
+        os.replace(embedding_path + ".tmp", embedding_path)
+
+    def remove(self):
+        """
+        Remove the checkpoint once the project is created
+        """
+        if os.path.exists(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+            self.logger.info(f"Removed checkpoint {self.checkpoint_dir}")
@@ -1,20 +1,24 @@
+import io
+import json
 import logging
 import os
+import queue
 import threading
 import time
 import eel
 import numpy as np
 import zipfile
-import shutil
 import tempfile
 
 from ..util.general import decode_image_url
-from ..util.json import save_json
 from ..embedding import EmbeddingGenerator
+from ..embeddingStore import PACKED_EMBEDDING_FILE, PACKED_EMBEDDING_INDEX_FILE
 from ..segmentation import CoralSegmentation
 from ..dataset import Data
+from .projectCheckpoint import ProjectCheckpoint
 from PIL import Image
 from ..util.requests import ProjectCreateRequest
+from typing import Callable, Dict, List
 from ..jsonFormat import (
     ImageJson,
     AnnotationFileJson,
@@ -25,7 +29,7 @@ from ..jsonFormat import (
 )
 
 
-TEMP_CREATE_NAME = "__coralscop_lat_temp"
+PARTIAL_PROJECT_SUFFIX = ".part"
 
 
 class ProjectCreator:
@@ -38,6 +42,14 @@ class ProjectCreator:
         tempfile.gettempdir(), "CoralSCOP-LAT", "temp_project.coral"
     )
 
+    # Number of images buffered between the stages of the creation pipeline
+    DECODE_QUEUE_SIZE = 2
+    WRITE_QUEUE_SIZE = 2
+    QUEUE_TIMEOUT = 0.1
+
+    # Number of images encoded together by the embedding model
+    DEFAULT_EMBEDDING_BATCH_SIZE = 1
+
     # Singleton
     _instance = None
 
@@ -59,162 +71,317 @@ class ProjectCreator:
         self.embeddings_generator = embedding_generator
         self.segmentation = segmentation
 
+        self.embedding_batch_size = ProjectCreator.DEFAULT_EMBEDDING_BATCH_SIZE
+
         # Threading
         self.stop_event = threading.Event()
         self.worker_thread = None
 
+    def get_model_identity(self) -> str:
+        """
+        Identity of the embedding and segmentation models, and of the segmentation backend
+        """
+        return (
+            self.embeddings_generator.model_identity
+            + self.segmentation.detector_identity
+        )
+
+    def set_embedding_batch_size(self, embedding_batch_size: int):
+        """
+        Set the number of images encoded together. Batches larger than one only
+        run the encoder once per batch if the model has a dynamic batch axis.
+        """
+        assert embedding_batch_size > 0, "Embedding batch size should be greater than 0"
+        self.embedding_batch_size = embedding_batch_size
+
     def create_(
         self,
         request: ProjectCreateRequest,
         frontend_enabled: bool = True,
-    ):
+        progress_callback: Callable[[int], None] = None,
+    ) -> Dict:
         """
         Create a proejct from the request. The project data will be stored in a zip file with .coral extension.
+        The progress percentage is reported to the frontend and to the progress callback, if they are given.
+
+        Returns the creation status:
+        {
+            "finished": bool,
+            "project_path": str, only if finished
+        }
+
+        The images are processed by a pipeline of three stages connected by bounded queues:
+        - A decode thread reads and decodes the input images ahead of the inference.
+        - The inference stage generates the embedding and detects the coral of each image.
+        - A writer thread encodes the outputs and streams them into the project file.
+
+        If the request enables resume, the outputs of each image are also kept in a
+        checkpoint next to the output file, and the images found in the checkpoint
+        are not processed again. The checkpoint is removed once the project is created.
         """
         inputs = request.get_inputs()
         inputs = sorted(inputs, key=lambda x: x["image_file_name"])
 
-        need_segmentation = request.need_segmentation()
-
         output_file = request.get_output_file()
 
         if output_file is None:
             output_file = ProjectCreator.TEMP_PROJECT_FILE
         self.logger.info(f"Creating project at {output_file}")
 
-        if os.path.exists(output_file):
-            os.remove(output_file)
-
         output_dir = os.path.dirname(output_file)
+        os.makedirs(output_dir, exist_ok=True)
 
-        # Temporary folders for storing images, embeddings, annotations, and project info
-        output_temp_dir = os.path.join(output_dir, TEMP_CREATE_NAME)
-        if os.path.exists(output_temp_dir):
-            shutil.rmtree(output_temp_dir)
-        os.makedirs(output_temp_dir, exist_ok=True)
+        # The project is written to a partial file, which replaces the output file when it is completed
+        partial_output_file = output_file + PARTIAL_PROJECT_SUFFIX
+        if os.path.exists(partial_output_file):
+            os.remove(partial_output_file)
 
-        image_folder = os.path.join(output_temp_dir, "images")
-        os.makedirs(image_folder, exist_ok=True)
-
-        embedding_folder = os.path.join(output_temp_dir, "embeddings")
-        os.makedirs(embedding_folder, exist_ok=True)
+        # Update process in the frontend
+        if frontend_enabled:
+            eel.updateProgressPercentage(0)
 
-        annotation_folder = os.path.join(output_temp_dir, "annotations")
-        os.makedirs(annotation_folder, exist_ok=True)
+        checkpoint = None
+        if request.need_resume():
+            checkpoint = ProjectCheckpoint(
+                output_file, request, self.get_model_identity()
+            )
 
-        project_info_path = os.path.join(output_temp_dir, "project_info.json")
+        # Set when the project creation is terminated or any stage fails
+        abort_event = threading.Event()
 
-        # Update process in the frontend
+        decode_queue = queue.Queue(maxsize=ProjectCreator.DECODE_QUEUE_SIZE)
+        write_queue = queue.Queue(maxsize=ProjectCreator.WRITE_QUEUE_SIZE)
 
-        if frontend_enabled:
-            eel.updateProgressPercentage(0)
+        archive = zipfile.ZipFile(partial_output_file, "w")
+        writer = ProjectWriter(
+            archive,
+            output_dir,
+            len(inputs),
+            request.get_embedding_layout(),
+        )
 
-        terminated = False
-        for idx, input in enumerate(inputs):
-            image_filename = input["image_file_name"]
-            filename = os.path.splitext(image_filename)[0]
-
-            self.logger.info(f"Processing input {idx + 1} of {len(inputs)}")
-            self.logger.info(f"Processing image: {image_filename}")
-
-            start_time = time.time()
-            self.logger.info(f"Processing image {image_filename} ...")
-
-            # Create image
-            if "image_path" in input:
-                image_path = input["image_path"]
-                image = Image.open(image_path)
-                image = image.convert("RGB")
-                image = np.array(image)
-            else:
-                image_url = input["image_url"]
-                image = decode_image_url(image_url)
-
-            if self.stop_event.is_set():
-                self.logger.info("Project creation stopped.")
-                terminated = True
-                break
-
-            # Generate embedding
-            embedding = self.embeddings_generator.generate_embedding(image)
-            if self.stop_event.is_set():
-                self.logger.info("Project creation stopped.")
-                terminated = True
-                break
-
-            # Detect coral
-            annotation_file_json = AnnotationFileJson()
-            if need_segmentation:
-                masks = self.segmentation.generate_masks_json(image)
-            else:
-                masks = []
-
-            image_json = ImageJson()
-            image_json.set_id(idx)
-            image_json.set_filename(image_filename)
-            image_json.set_width(image.shape[1])
-            image_json.set_height(image.shape[0])
-            annotation_file_json.add_image(image_json)
-
-            if len(masks) == 0:
-                pass
-            else:
-                min_area = request.get_min_area()
-                min_confidence = request.get_min_confidence()
-                max_iou = request.get_max_iou()
-
-                masks = self.segmentation.filter(
-                    masks, min_area, min_confidence, max_iou
+        def run_stage(target, *args):
+            try:
+                target(*args)
+            except Exception as e:
+                self.logger.exception(f"Project creation failed: {e}")
+                abort_event.set()
+
+        def decode_stage():
+            for idx, input in enumerate(inputs):
+                if self.is_aborted(abort_event):
+                    return
+                image = self.decode_input(input)
+                key = None
+                if checkpoint is not None:
+                    key = checkpoint.get_image_key(image)
+                if not self.put(decode_queue, (idx, input, image, key), abort_event):
+                    return
+            self.put(decode_queue, None, abort_event)
+
+        def write_stage():
+            while True:
+                item = self.get(write_queue, abort_event)
+                if item is None:
+                    return
+
+                idx, image_filename, image, embedding, annotation_file_json = item
+                writer.write(
+                    idx, image_filename, image, embedding, annotation_file_json
                 )
-                self.logger.info(f"Finalized masks: {len(masks)}")
-                for mask in masks:
-                    mask["image_id"] = idx
-
-                for mask in masks:
-                    annotation_json = AnnotationJson()
-                    annotation_json.set_segmentation(mask["segmentation"])
-                    annotation_json.set_bbox(mask["bbox"])
-                    annotation_json.set_area(mask["area"])
-                    annotation_json.set_category_id(mask["category_id"])
-                    annotation_json.set_id(mask["id"])
-                    annotation_json.set_image_id(idx)
-                    annotation_json.set_iscrowd(mask["iscrowd"])
-                    annotation_json.set_predicted_iou(mask["predicted_iou"])
-                    annotation_file_json.add_annotation(annotation_json)
-
-            end_time = time.time()
-            self.logger.info(f"Processed image in {end_time - start_time:.2f} seconds")
-
-            # Check if the stop event is set
-            if image is None or embedding is None or masks is None:
-                terminated = True
-                break
-
-            image_path = os.path.join(image_folder, image_filename)
-            embedding_path = os.path.join(embedding_folder, f"{filename}.npy")
-            annotation_path = os.path.join(annotation_folder, f"{filename}.json")
-
-            np.save(embedding_path, embedding)
-            save_json(annotation_file_json.to_json(), annotation_path)
-            Image.fromarray(image).save(image_path)
-
-            process_percentage = (idx + 1) / len(inputs) * 100
-            process_percentage = int(process_percentage)
 
-            if frontend_enabled:
-                eel.updateProgressPercentage(process_percentage)
+                process_percentage = (idx + 1) / len(inputs) * 100
+                process_percentage = int(process_percentage)
+                if frontend_enabled:
+                    eel.updateProgressPercentage(process_percentage)
+                if progress_callback is not None:
+                    progress_callback(process_percentage)
+
+        decode_thread = threading.Thread(target=run_stage, args=(decode_stage,))
+        write_thread = threading.Thread(target=run_stage, args=(write_stage,))
+        decode_thread.start()
+        write_thread.start()
+
+        run_stage(
+            self.inference_stage,
+            request,
+            len(inputs),
+            decode_queue,
+            write_queue,
+            abort_event,
+            checkpoint,
+        )
+
+        decode_thread.join()
+        write_thread.join()
+
+        terminated = self.is_aborted(abort_event)
+        try:
+            if not terminated:
+                writer.finish(self.create_project_info_json())
+        finally:
+            archive.close()
+            writer.close()
 
         if terminated:
-            # If the process is terminated, clear the temporary folder and return
-            # self.clear_temp_folder(output_dir)
-            shutil.rmtree(output_temp_dir)
+            # If the process is terminated, remove the partial project and return
+            if os.path.exists(partial_output_file):
+                os.remove(partial_output_file)
             status = {}
             status["finished"] = False
 
             if frontend_enabled:
                 eel.afterProjectCreation(status)
-            return
+            return status
+
+        project_path = output_file
+        os.replace(partial_output_file, project_path)
+        if checkpoint is not None:
+            checkpoint.remove()
+
+        status = {}
+        status["finished"] = True
+        status["project_path"] = project_path
+
+        if frontend_enabled:
+            eel.afterProjectCreation(status)
+        return status
 
+    def inference_stage(
+        self,
+        request: ProjectCreateRequest,
+        input_num: int,
+        decode_queue: queue.Queue,
+        write_queue: queue.Queue,
+        abort_event: threading.Event,
+        checkpoint: ProjectCheckpoint = None,
+    ):
+        """
+        Generate the embedding and the annotations of the decoded images,
+        or load them from the checkpoint if the image is already processed.
+        The images are encoded in batches of embedding_batch_size images.
+        """
+        finished = False
+        while not finished:
+            # Collect a batch of decoded images, so that the images are encoded together
+            items = []
+            while len(items) < self.embedding_batch_size:
+                item = self.get(decode_queue, abort_event)
+                if item is None:
+                    finished = True
+                    break
+                items.append(item)
+
+            if self.is_aborted(abort_event):
+                return
+
+            # Encode the images not found in the checkpoint
+            embeddings = {}
+            checkpointed = {}
+            for idx, input, image, key in items:
+                if checkpoint is not None and checkpoint.contains(key):
+                    checkpointed[idx] = checkpoint.load(key)
+            images = [item[2] for item in items if item[0] not in checkpointed]
+            if len(images) > 0:
+                start_time = time.time()
+                outputs = self.embeddings_generator.generate_embeddings(images)
+                self.logger.info(
+                    f"Encoded {len(images)} images in {time.time() - start_time:.2f} seconds"
+                )
+                idxs = [item[0] for item in items if item[0] not in checkpointed]
+                embeddings = dict(zip(idxs, outputs))
+
+            for idx, input, image, key in items:
+                if self.is_aborted(abort_event):
+                    self.logger.info("Project creation stopped.")
+                    return
+
+                image_filename = input["image_file_name"]
+                self.logger.info(f"Processing input {idx + 1} of {input_num}")
+                self.logger.info(f"Processing image: {image_filename}")
+
+                if idx in checkpointed:
+                    self.logger.info(f"Loaded image {image_filename} from checkpoint")
+                    embedding, masks = checkpointed[idx]
+                else:
+                    start_time = time.time()
+                    embedding = embeddings[idx]
+                    masks = self.detect_masks(image, request)
+                    self.logger.info(
+                        f"Processed image in {time.time() - start_time:.2f} seconds"
+                    )
+
+                    if checkpoint is not None:
+                        checkpoint.save(key, embedding, masks)
+
+                annotation_file_json = self.create_annotation_file_json(
+                    idx, image_filename, image, masks
+                )
+
+                item = (idx, image_filename, image, embedding, annotation_file_json)
+                if not self.put(write_queue, item, abort_event):
+                    return
+
+        self.put(write_queue, None, abort_event)
+
+    def decode_input(self, input: Dict) -> np.ndarray:
+        if "image_path" in input:
+            image_path = input["image_path"]
+            image = Image.open(image_path)
+            image = image.convert("RGB")
+            image = np.array(image)
+        else:
+            image_url = input["image_url"]
+            image = decode_image_url(image_url)
+        return image
+
+    def detect_masks(
+        self, image: np.ndarray, request: ProjectCreateRequest
+    ) -> List[Dict]:
+        """
+        Detect the coral of the image, and filter the masks by the request config
+        """
+        if not request.need_segmentation():
+            return []
+
+        masks = self.segmentation.generate_masks_json(image)
+        if len(masks) != 0:
+            min_area = request.get_min_area()
+            min_confidence = request.get_min_confidence()
+            max_iou = request.get_max_iou()
+
+            masks = self.segmentation.filter(masks, min_area, min_confidence, max_iou)
+            self.logger.info(f"Finalized masks: {len(masks)}")
+
+        return masks
+
+    def create_annotation_file_json(
+        self, idx: int, image_filename: str, image: np.ndarray, masks: List[Dict]
+    ) -> AnnotationFileJson:
+        annotation_file_json = AnnotationFileJson()
+
+        image_json = ImageJson()
+        image_json.set_id(idx)
+        image_json.set_filename(image_filename)
+        image_json.set_width(image.shape[1])
+        image_json.set_height(image.shape[0])
+        annotation_file_json.add_image(image_json)
+
+        for mask in masks:
+            annotation_json = AnnotationJson()
+            annotation_json.set_segmentation(mask["segmentation"])
+            annotation_json.set_bbox(mask["bbox"])
+            annotation_json.set_area(mask["area"])
+            annotation_json.set_category_id(mask["category_id"])
+            annotation_json.set_id(mask["id"])
+            annotation_json.set_image_id(idx)
+            annotation_json.set_iscrowd(mask["iscrowd"])
+            annotation_json.set_predicted_iou(mask["predicted_iou"])
+            annotation_file_json.add_annotation(annotation_json)
+
+        return annotation_file_json
+
+    def create_project_info_json(self) -> ProjectInfoJson:
         project_info_json = ProjectInfoJson()
         project_info_json.set_last_image_idx(0)
 
@@ -256,28 +423,35 @@ class ProjectCreator:
         undefined_status.set_name("Undefined")
         project_info_json.add_status_info(undefined_status)
 
-        save_json(project_info_json.to_json(), project_info_path)
-
-        # project_name = self.find_available_project_name(output_dir)
-        # project_path = os.path.join(output_dir, project_name)
-        project_path = output_file
-        with zipfile.ZipFile(project_path, "w") as archive:
-            for root, _, files in os.walk(output_temp_dir):
-                for file in files:
-                    archive.write(
-                        os.path.join(root, file),
-                        os.path.relpath(os.path.join(root, file), output_temp_dir),
-                    )
-
-        if os.path.exists(output_temp_dir):
-            shutil.rmtree(output_temp_dir)
+        return project_info_json
 
-        status = {}
-        status["finished"] = True
-        status["project_path"] = project_path
+    def is_aborted(self, abort_event: threading.Event) -> bool:
+        return self.stop_event.is_set() or abort_event.is_set()
 
-        if frontend_enabled:
-            eel.afterProjectCreation(status)
+    def put(self, q: queue.Queue, item, abort_event: threading.Event) -> bool:
+        """
+        Put the item into the bounded queue, waiting until there is space.
+        Returns False if the project creation is aborted while waiting.
+        """
+        while not self.is_aborted(abort_event):
+            try:
+                q.put(item, timeout=ProjectCreator.QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q: queue.Queue, abort_event: threading.Event):
+        """
+        Get an item from the queue, waiting until there is one.
+        Returns None if the project creation is aborted while waiting.
+        """
+        while not self.is_aborted(abort_event):
+            try:
+                return q.get(timeout=ProjectCreator.QUEUE_TIMEOUT)
+            except queue.Empty:
+                continue
+        return None
 
     def create(
         self,
@@ -316,3 +490,101 @@ class ProjectCreator:
             if i > 1000:
                 raise Exception("Too many project files in the output directory")
         return project_name
+
+
+class ProjectWriter:
+    """
+    Stream the outputs of the project creation into the project zip file,
+    so that no temporary project folder is needed.
+    """
+
+    def __init__(
+        self,
+        archive: zipfile.ZipFile,
+        output_dir: str,
+        image_num: int,
+        embedding_layout: str,
+    ):
+        self.archive = archive
+        self.output_dir = output_dir
+        self.image_num = image_num
+        self.packed = embedding_layout == ProjectCreateRequest.EMBEDDING_LAYOUT_PACKED
+
+        # The packed embeddings are spooled into a temporary file,
+        # which is added to the project once all the embeddings are generated
+        self.packed_embeddings: np.ndarray = None
+        self.packed_embedding_path: str = None
+        self.image_names = [None] * image_num
+
+    def write(
+        self,
+        idx: int,
+        image_filename: str,
+        image: np.ndarray,
+        embedding: np.ndarray,
+        annotation_file_json: AnnotationFileJson,
+    ):
+        filename = os.path.splitext(image_filename)[0]
+        self.image_names[idx] = image_filename
+
+        # Encode the image in the format of its file extension
+        image_format = Image.registered_extensions()[
+            os.path.splitext(image_filename)[1].lower()
+        ]
+        buffer = io.BytesIO()
+        Image.fromarray(image).save(buffer, format=image_format)
+        self.archive.writestr(f"images/{image_filename}", buffer.getvalue())
+
+        if self.packed:
+            if self.packed_embeddings is None:
+                fd, self.packed_embedding_path = tempfile.mkstemp(
+                    suffix=".npy", dir=self.output_dir
+                )
+                os.close(fd)
+                self.packed_embeddings = np.lib.format.open_memmap(
+                    self.packed_embedding_path,
+                    mode="w+",
+                    dtype=embedding.dtype,
+                    shape=(self.image_num,) + embedding.shape,
+                )
+            self.packed_embeddings[idx] = embedding
+        else:
+            with self.archive.open(f"embeddings/{filename}.npy", "w") as f:
+                np.lib.format.write_array(f, embedding)
+
+        self.archive.writestr(
+            f"annotations/{filename}.json",
+            json.dumps(annotation_file_json.to_json(), indent=4),
+        )
+
+    def finish(self, project_info_json: ProjectInfoJson):
+        """
+        Write the members that are only complete after all the images are written
+        """
+        if self.packed and self.packed_embeddings is not None:
+            # Flush and release the memory-mapped file before it is archived
+            self.packed_embeddings.flush()
+            self.packed_embeddings = None
+            self.archive.write(
+                self.packed_embedding_path,
+                f"embeddings/{PACKED_EMBEDDING_FILE}",
+            )
+            self.archive.writestr(
+                f"embeddings/{PACKED_EMBEDDING_INDEX_FILE}",
+                json.dumps({"image_names": self.image_names}, indent=4),
+            )
+
+        self.archive.writestr(
+            "project_info.json", json.dumps(project_info_json.to_json(), indent=4)
+        )
+
+    def close(self):
+        """
+        Remove the spooled packed embeddings
+        """
+        self.packed_embeddings = None
+        if self.packed_embedding_path is not None and os.path.exists(
+            self.packed_embedding_path
+        ):
+            os.remove(self.packed_embedding_path)
+        self.packed_embedding_path = None
@@ -1,24 +1,22 @@
+import io
 import logging
 import os
 import threading
 import time
 import eel
 import numpy as np
-import zipfile
-import shutil
 
 from .projectCreator import ProjectCreator
+from .projectArchive import ProjectArchive
 from ..file import WEB_FOLDER_NAME, ASSET_FOLDER_NAME, IMAGE_FOLDER_NAME
 
-from ..util.json import load_json
 from ..dataset import Dataset, Data
+from ..embeddingStore import EmbeddingStore
 from ..util.general import get_resource_path
 from PIL import Image
 
 
-from typing import List, Union
-
-TEMP_LOAD_NAME = "__coralscop_lat_temp_load"
+from typing import Dict, Set, Union
 
 
 class ProjectLoader:
@@ -26,12 +24,33 @@ class ProjectLoader:
     WEB_FOLDER_NAME = WEB_FOLDER_NAME
     ASSET_FOLDER = os.path.join(WEB_FOLDER_NAME, ASSET_FOLDER_NAME)
 
-    def __init__(self):
+    # Longest side of the gallery thumbnails
+    THUMBNAIL_SIZE = 256
+
+    def __init__(self, embedding_cache_bytes: int = EmbeddingStore.DEFAULT_MAX_BYTES):
         self.logger = logging.getLogger(self.__class__.__name__)
 
-    def load(self, project_path: str) -> Union[Dataset, int]:
+        # Memory budget of the embeddings kept in memory
+        self.embedding_cache_bytes = embedding_cache_bytes
+
+        # Archive of the lazily loaded project
+        self.archive: ProjectArchive = None
+        # Image names that have been copied to the asset folder
+        self.stored_images: Set[str] = set()
+        # Images are stored by the prefetch thread as well
+        self.store_lock = threading.Lock()
+        # JPEG thumbnails of the gallery, keyed by the image name
+        self.thumbnails: Dict[str, bytes] = {}
+        self.thumbnail_lock = threading.Lock()
+
+    def load_lazy(self, project_path: str) -> Union[Dataset, int]:
         """
-        Load a project from the given project path.
+        Load a project from the given project path without extracting it.
+
+        Only the zip central directory and the project info are read. The image,
+        embedding and annotation of each data are read from the archive when they
+        are first needed. The index of each data is its position in the sorted
+        image names, which is how the project creator assigns image ids.
 
         Returns:
         - Dataset: The loaded dataset
@@ -44,102 +63,109 @@ class ProjectLoader:
             project_path
         ), f"Project file {project_path} does not exist"
 
-        self.logger.info(f"Loading project from {project_path}")
-
-        # Unzip the project file
-        start_time = time.time()
-        temp_output_dir = os.path.join(os.path.dirname(project_path), TEMP_LOAD_NAME)
-        with zipfile.ZipFile(project_path, "r") as archive:
-            archive.extractall(temp_output_dir)
-        self.logger.info(f"Unzipped project in {time.time() - start_time} seconds")
+        self.logger.info(f"Lazily loading project from {project_path}")
 
-        # Load data from the project folder
         start_time = time.time()
-        dataset = Dataset()
+        if self.archive is not None:
+            self.archive.close()
+        self.archive = ProjectArchive(project_path)
 
-        image_folder = os.path.join(temp_output_dir, "images")
-        embedding_folder = os.path.join(temp_output_dir, "embeddings")
-        annotation_folder = os.path.join(temp_output_dir, "annotations")
-        project_info_path = os.path.join(temp_output_dir, "project_info.json")
-
-        image_filenames = os.listdir(image_folder)
-        image_filenames = sorted(image_filenames)
-        filenames = [os.path.splitext(filename)[0] for filename in image_filenames]
+        self.clear_asset_folder()
+        self.stored_images = set()
+        self.thumbnails = {}
 
-        # Move the images files to the assets folder
-        image_files = [
-            os.path.join(image_folder, filename)
-            for filename in os.listdir(image_folder)
-        ]
-        asset_image_paths = self.store_image(image_files)
-        asset_image_paths = sorted(asset_image_paths)
+        embedding_store = EmbeddingStore(self.archive, self.embedding_cache_bytes)
 
-        # Construct dataset
         dataset = Dataset()
-        for idx, filename in enumerate(filenames):
-            embedding_path = os.path.join(embedding_folder, f"{filename}.npy")
-            annotation_path = os.path.join(annotation_folder, f"{filename}.json")
-
+        dataset.set_embedding_store(embedding_store)
+        for idx, image_name in enumerate(self.archive.get_image_names()):
             data = Data()
-            data.set_image_name(image_filenames[idx])
-            data.set_image_path(asset_image_paths[idx])
-
-            embedding = np.load(embedding_path)
-            data.set_embedding(embedding)
-
-            annotations = load_json(annotation_path)
-            data.set_segmentation(annotations)
-
-            # Data index is the image idx
-            image_id = annotations["images"][0]["id"]
-            data.set_idx(image_id)
-
+            data.set_image_name(image_name)
+            data.set_image_path(
+                os.path.join(ASSET_FOLDER_NAME, IMAGE_FOLDER_NAME, image_name)
+            )
+            data.set_archive(self.archive)
+            data.set_embedding_store(embedding_store)
+            data.set_idx(idx)
             dataset.add_data(data)
 
-        # Load project info
-        project_info = load_json(project_info_path)
+        project_info = self.archive.read_project_info()
         last_image_idx = project_info["last_image_idx"]
-        category_info = project_info["category_info"]
-        status_info = project_info["status_info"]
-        dataset.set_category_info(category_info)
-        dataset.set_status_info(status_info)
-
-        # Delete the temporary folder
-        shutil.rmtree(temp_output_dir)
+        dataset.set_category_info(project_info["category_info"])
+        dataset.set_status_info(project_info["status_info"])
 
-        self.logger.info(f"Project loaded in {time.time() - start_time} seconds")
+        self.logger.info(f"Project indexed in {time.time() - start_time} seconds")
 
         return dataset, last_image_idx
 
-    def store_image(self, image_paths: List[str]) -> List[str]:
+    def store_data_image(self, data: Data):
         """
-        Store images to the assest folder for front end to access.
+        Copy the image of a lazily loaded data from the archive to the
+        asset folder, if it is not stored yet.
+        """
+        if self.archive is None or data.get_archive() is None:
+            return
 
-        Returns:
-        - List[str]: List of relative image paths in the asset folder
+        image_name = data.get_image_name()
+        with self.store_lock:
+            if image_name in self.stored_images:
+                return
+
+            image_folder = os.path.join(ProjectLoader.ASSET_FOLDER, IMAGE_FOLDER_NAME)
+            image_folder = get_resource_path(image_folder)
+            os.makedirs(image_folder, exist_ok=True)
+
+            save_path = os.path.join(image_folder, image_name)
+            self.logger.debug(f"Extracting image to {save_path}")
+            self.archive.extract_image(image_name, save_path)
+            self.stored_images.add(image_name)
+
+    def open_data_image(self, data: Data) -> Image.Image:
         """
-        self.clear_asset_folder()
-        image_folder = os.path.join(ProjectLoader.ASSET_FOLDER, IMAGE_FOLDER_NAME)
-        image_folder = get_resource_path(image_folder)
-        os.makedirs(image_folder, exist_ok=True)
-
-        assset_image_paths = []
-        for image_path in image_paths:
-            image = Image.open(image_path)
-
-            save_path = os.path.join(image_folder, os.path.basename(image_path))
-            save_path = get_resource_path(save_path)
-            self.logger.debug(f"Saving image to {save_path}")
-            image.save(save_path)
-
-            asset_image_path = os.path.join(
-                ASSET_FOLDER_NAME,
-                IMAGE_FOLDER_NAME,
-                os.path.basename(image_path),
+        Open the image of a data, from the archive if it is loaded lazily,
+        otherwise from the asset folder.
+        """
+        if data.get_archive() is not None:
+            return Image.open(
+                io.BytesIO(data.get_archive().read_image(data.get_image_name()))
             )
-            assset_image_paths.append(asset_image_path)
+        image_path = os.path.join(ProjectLoader.WEB_FOLDER_NAME, data.get_image_path())
+        return Image.open(get_resource_path(image_path))
 
-        return assset_image_paths
+    def load_data_image(self, data: Data) -> np.ndarray:
+        """
+        Decode the image of a data, see open_data_image
+        """
+        return np.array(self.open_data_image(data))
+
+    def load_data_thumbnail(self, data: Data) -> bytes:
+        """
+        Encode a JPEG thumbnail of the image of a data for the gallery, without
+        copying the image to the asset folder. The thumbnails are kept until
+        another project is loaded.
+        """
+        image_name = data.get_image_name()
+        with self.thumbnail_lock:
+            if image_name in self.thumbnails:
+                return self.thumbnails[image_name]
+
+        image = self.open_data_image(data)
+        size = (ProjectLoader.THUMBNAIL_SIZE, ProjectLoader.THUMBNAIL_SIZE)
+        # JPEG images are decoded at a reduced scale close to the thumbnail size
+        image.draft("RGB", size)
+        image = image.convert("RGB")
+        image.thumbnail(size)
+
+        f = io.BytesIO()
+        image.save(f, format="JPEG", quality=85)
+        thumbnail = f.getvalue()
+        with self.thumbnail_lock:
+            self.thumbnails[image_name] = thumbnail
+        return thumbnail
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
 
     def clear_asset_folder(self):
         """
@@ -1,10 +1,12 @@
+import json
 import logging
 import os
 import zipfile
 import shutil
 
 from ..util.json import save_json
-from ..dataset import Dataset
+from ..util.data import copy_zip_members
+from ..dataset import Dataset, Data
 from ..jsonFormat import (
     ImageJson,
     AnnotationFileJson,
@@ -17,6 +19,7 @@ from ..jsonFormat import (
 
 TEMP_CREATE_NAME = "__coralscop_lat_temp"
 TEMP_CREATE_NAME_2 = "__coralscop_lat_temp_2"
+TEMP_SAVE_SUFFIX = ".saving"
 
 
 class ProjectSaver:
@@ -71,52 +74,12 @@ class ProjectSaver:
         for data in dataset.get_data_list():
             filename = os.path.splitext(data.get_image_name())[0]
             annotation_path = os.path.join(annotation_folder_new, f"{filename}.json")
-
-            annotation_file_json = AnnotationFileJson()
-
-            image_json = ImageJson()
-            image_json.set_id(data.get_idx())
-            image_json.set_filename(data.get_image_name())
-            image_json.set_width(data.get_image_width())
-            image_json.set_height(data.get_image_height())
-            annotation_file_json.add_image(image_json)
-
-            for mask in data.get_segmentation()["annotations"]:
-                annotation_json = AnnotationJson()
-                annotation_json.set_segmentation(mask["segmentation"])
-                annotation_json.set_bbox(mask["bbox"])
-                annotation_json.set_area(mask["area"])
-                annotation_json.set_category_id(mask["category_id"])
-                annotation_json.set_id(mask["id"])
-                annotation_json.set_image_id(data.get_idx())
-                annotation_json.set_iscrowd(mask["iscrowd"])
-                annotation_json.set_predicted_iou(mask["predicted_iou"])
-                annotation_file_json.add_annotation(annotation_json)
-
+            annotation_file_json = self.to_annotation_file_json(data)
             save_json(annotation_file_json.to_json(), annotation_path)
 
         # Generate the project info file to the new project folder
         project_info_path = os.path.join(temp_folder_new, "project_info.json")
-
-        project_info_json = ProjectInfoJson()
-        project_info_json.set_last_image_idx(dataset.get_last_saved_id())
-        for category in dataset.get_category_info():
-            category_json = CategoryJson()
-            category_json.set_id(category["id"])
-            category_json.set_name(category["name"])
-            category_json.set_super_category(category["supercategory"])
-            category_json.set_super_category_id(category["supercategory_id"])
-            category_json.set_is_coral(category["is_coral"])
-            category_json.set_status(category["status"])
-            project_info_json.add_category_info(category_json)
-
-        for status in dataset.get_status_info():
-            status_json = StatusJson()
-            status_json.set_id(status["id"])
-            status_json.set_name(status["name"])
-            project_info_json.add_status_info(status_json)
-        project_info_json.set_last_image_idx(dataset.get_last_saved_id())
-
+        project_info_json = self.to_project_info_json(dataset)
         save_json(project_info_json.to_json(), project_info_path)
 
         # Remove the temp folder for original project
@@ -136,3 +99,102 @@ class ProjectSaver:
 
         # Remove the temp folder for the new project
         shutil.rmtree(temp_folder_new)
+
+    def save_dataset_incremental(
+        self, dataset: Dataset, project_path_origin: str, project_path_new: str
+    ):
+        """
+        Save the dataset by rewriting only the annotations of the data updated
+        since the last save, and the project info. All the other members are
+        copied from the original project as they are, without being extracted.
+
+        The new project is written next to the target and then moved in place,
+        so the original project can also be the target.
+        """
+        dirty_data_list = [
+            dataset.get_data(data_idx) for data_idx in dataset.get_dirty_data_ids()
+        ]
+        rewritten_members = {"project_info.json"}
+        for data in dirty_data_list:
+            rewritten_members.add(self.get_annotation_member_name(data))
+
+        temp_project_path = project_path_new + TEMP_SAVE_SUFFIX
+        if os.path.exists(temp_project_path):
+            os.remove(temp_project_path)
+
+        try:
+            with zipfile.ZipFile(temp_project_path, "w") as archive:
+                copied_members = copy_zip_members(
+                    project_path_origin, archive, rewritten_members
+                )
+                self.logger.info(
+                    f"Copied {len(copied_members)} members from {project_path_origin}"
+                )
+
+                for data in dirty_data_list:
+                    annotation_file_json = self.to_annotation_file_json(data)
+                    archive.writestr(
+                        self.get_annotation_member_name(data),
+                        json.dumps(annotation_file_json.to_json(), indent=4),
+                    )
+                self.logger.info(f"Rewrote {len(dirty_data_list)} annotations")
+
+                project_info_json = self.to_project_info_json(dataset)
+                archive.writestr(
+                    "project_info.json",
+                    json.dumps(project_info_json.to_json(), indent=4),
+                )
+
+            os.replace(temp_project_path, project_path_new)
+        finally:
+            if os.path.exists(temp_project_path):
+                os.remove(temp_project_path)
+
+    def get_annotation_member_name(self, data: Data) -> str:
+        filename = os.path.splitext(data.get_image_name())[0]
+        return f"annotations/{filename}.json"
+
+    def to_annotation_file_json(self, data: Data) -> AnnotationFileJson:
+        annotation_file_json = AnnotationFileJson()
+
+        image_json = ImageJson()
+        image_json.set_id(data.get_idx())
+        image_json.set_filename(data.get_image_name())
+        image_json.set_width(data.get_image_width())
+        image_json.set_height(data.get_image_height())
+        annotation_file_json.add_image(image_json)
+
+        for mask in data.get_segmentation()["annotations"]:
+            annotation_json = AnnotationJson()
+            annotation_json.set_segmentation(mask["segmentation"])
+            annotation_json.set_bbox(mask["bbox"])
+            annotation_json.set_area(mask["area"])
+            annotation_json.set_category_id(mask["category_id"])
+            annotation_json.set_id(mask["id"])
+            annotation_json.set_image_id(data.get_idx())
+            annotation_json.set_iscrowd(mask["iscrowd"])
+            annotation_json.set_predicted_iou(mask["predicted_iou"])
+            annotation_file_json.add_annotation(annotation_json)
+
+        return annotation_file_json
+
+    def to_project_info_json(self, dataset: Dataset) -> ProjectInfoJson:
+        project_info_json = ProjectInfoJson()
+        project_info_json.set_last_image_idx(dataset.get_last_saved_id())
+        for category in dataset.get_category_info():
+            category_json = CategoryJson()
+            category_json.set_id(category["id"])
+            category_json.set_name(category["name"])
+            category_json.set_super_category(category["supercategory"])
+            category_json.set_super_category_id(category["supercategory_id"])
+            category_json.set_is_coral(category["is_coral"])
+            category_json.set_status(category["status"])
+            project_info_json.add_category_info(category_json)
+
+        for status in dataset.get_status_info():
+            status_json = StatusJson()
+            status_json.set_id(status["id"])
+            status_json.set_name(status["name"])
+            project_info_json.add_status_info(status_json)
+
+        return project_info_json
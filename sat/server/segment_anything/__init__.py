@@ -4,12 +4,29 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
-from .build_sam import (
-    build_sam,
-    build_sam_vit_h,
-    build_sam_vit_l,
-    build_sam_vit_b,
-    sam_model_registry,
-)
-from .predictor import SamPredictor
-from .automatic_mask_generator import SamAutomaticMaskGenerator
+import importlib
+
+# The torch modules are only imported on first use, so that the ONNX automatic
+# mask generator and the numpy utilities can be used without importing torch
+_LAZY_ATTRIBUTES = {
+    "build_sam": ".build_sam",
+    "build_sam_vit_h": ".build_sam",
+    "build_sam_vit_l": ".build_sam",
+    "build_sam_vit_b": ".build_sam",
+    "sam_model_registry": ".build_sam",
+    "SamPredictor": ".predictor",
+    "SamAutomaticMaskGenerator": ".automatic_mask_generator",
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module(module_name, __name__)
+    # Bind all the attributes of the module at once. Importing the build_sam submodule
+    # binds the module to the package, so the build_sam function is bound back over it.
+    for attribute, attribute_module_name in _LAZY_ATTRIBUTES.items():
+        if attribute_module_name == module_name:
+            globals()[attribute] = getattr(module, attribute)
+    return globals()[name]
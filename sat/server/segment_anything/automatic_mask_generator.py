@@ -4,14 +4,18 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import queue
 import numpy as np
 import torch
 from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple
 
+from ..mask.packedMask import PackedMask, packed_mask_boxes
 from .modeling import Sam
 from .predictor import SamPredictor
+from .utils.amg_numpy import remove_small_regions_rle
 from .utils.amg import (
     MaskData,
     area_from_rle,
@@ -24,7 +28,6 @@ from .utils.amg import (
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_pytorch,
-    remove_small_regions,
     rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
@@ -33,6 +36,20 @@ from .utils.amg import (
 
 
 class SamAutomaticMaskGenerator:
+    # Fields of the generated mask records
+    OUTPUT_FIELDS = [
+        "segmentation",
+        "area",
+        "bbox",
+        "predicted_iou",
+        "cate_preds",
+        "fc_features",
+        "similarity",
+        "point_coords",
+        "stability_score",
+        "crop_box",
+    ]
+
     def __init__(
         self,
         model: Sam,
@@ -49,6 +66,8 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        crop_workers: int = 1,
+        output_fields: Optional[List[str]] = None,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,7 +112,17 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          crop_workers (int): The number of crops processed concurrently by a
+            thread pool. Each worker holds the embedding of its crop in its own
+            predictor, and the predictors share the model. The masks are also
+            postprocessed by as many threads.
+          output_fields (list(str) or None): The fields of the mask records,
+            among OUTPUT_FIELDS, all of them if None. The features of the masks
+            are only kept if the fc_features or the similarity field is selected.
         """
+        assert (
+            crop_workers >= 1
+        ), f"crop_workers should be at least 1, got {crop_workers}"
 
         assert (points_per_side is None) != (
             point_grids is None
@@ -121,6 +150,13 @@ class SamAutomaticMaskGenerator:
             import cv2  # type: ignore # noqa: F401
 
         self.predictor = SamPredictor(model)
+        self.crop_predictors = [self.predictor] + [
+            SamPredictor(model) for _ in range(crop_workers - 1)
+        ]
+        # Predictors which are not holding the embedding of a crop
+        self.idle_predictors = queue.Queue()
+        for predictor in self.crop_predictors:
+            self.idle_predictors.put(predictor)
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
@@ -132,18 +168,51 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.crop_workers = crop_workers
+        self.set_output_fields(output_fields)
+
+    def set_output_fields(self, output_fields: Optional[List[str]]) -> None:
+        if output_fields is None:
+            output_fields = SamAutomaticMaskGenerator.OUTPUT_FIELDS
+        for field in output_fields:
+            assert (
+                field in SamAutomaticMaskGenerator.OUTPUT_FIELDS
+            ), f"Unknown output field {field}, should be one of {SamAutomaticMaskGenerator.OUTPUT_FIELDS}"
+        # Same order as OUTPUT_FIELDS
+        self.output_fields = [
+            field
+            for field in SamAutomaticMaskGenerator.OUTPUT_FIELDS
+            if field in output_fields
+        ]
+        self.keep_fc_features = (
+            "fc_features" in output_fields or "similarity" in output_fields
+        )
+
+    def set_embedding_cache(self, embedding_cache, model_identity: str) -> None:
+        """
+        Consult the embedding cache before encoding the whole image, see
+        SamPredictor.set_embedding_cache. The crops of the other layers are
+        not cached, so that they do not evict the embeddings of whole images.
+        """
+        for predictor in self.crop_predictors:
+            predictor.set_embedding_cache(embedding_cache, model_identity)
 
     @torch.no_grad()
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
+    def generate(
+        self, image: np.ndarray, embedding: Optional[np.ndarray] = None
+    ) -> List[Dict[str, Any]]:
         """
         Generates masks for the given image.
 
         Arguments:
           image (np.ndarray): The image to generate masks for, in HWC uint8 format.
+          embedding (np.ndarray or None): A precomputed embedding of the whole
+            image, used for the uncropped layer in place of running the image
+            encoder. It must be computed by the image encoder of the model.
 
         Returns:
            list(dict(str, any)): A list over records for masks. Each record is
-             a dict containing the following keys:
+             a dict containing the following keys, if they are output fields:
                segmentation (dict(str, any) or np.ndarray): The mask. If
                  output_mode='binary_mask', is an array of shape HW. Otherwise,
                  is a dictionary containing the RLE.
@@ -160,7 +229,7 @@ class SamAutomaticMaskGenerator:
         """
 
         # Generate masks
-        mask_data = self._generate_masks(image)
+        mask_data = self._generate_masks(image, embedding)
 
         # Filter small disconnected regions and holes in masks
         if self.min_mask_region_area > 0:
@@ -168,48 +237,74 @@ class SamAutomaticMaskGenerator:
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                self.crop_workers,
             )
 
+        return self._write_annotations(mask_data)
+
+    def _write_annotations(self, mask_data: MaskData) -> List[Dict[str, Any]]:
         # Encode masks
-        if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [
-                coco_encode_rle(rle) for rle in mask_data["rles"]
-            ]
-        elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-        else:
-            mask_data["segmentations"] = mask_data["rles"]
+        if "segmentation" in self.output_fields:
+            if self.output_mode == "coco_rle":
+                mask_data["segmentations"] = [
+                    coco_encode_rle(rle) for rle in mask_data["rles"]
+                ]
+            elif self.output_mode == "binary_mask":
+                mask_data["segmentations"] = [
+                    rle_to_mask(rle) for rle in mask_data["rles"]
+                ]
+            else:
+                mask_data["segmentations"] = mask_data["rles"]
+
+        # Write mask records, with only the output fields
+        field_getters = {
+            "segmentation": lambda idx: mask_data["segmentations"][idx],
+            "area": lambda idx: area_from_rle(mask_data["rles"][idx]),
+            "bbox": lambda idx: box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
+            "predicted_iou": lambda idx: mask_data["iou_preds"][idx].item(),
+            "cate_preds": lambda idx: mask_data["cate_preds"][idx].item(),
+            "fc_features": lambda idx: mask_data["fc_features"][idx].tolist(),
+            "similarity": lambda idx: mask_data["similarity"][idx].tolist(),
+            "point_coords": lambda idx: [mask_data["points"][idx].tolist()],
+            "stability_score": lambda idx: mask_data["stability_score"][idx].item(),
+            "crop_box": lambda idx: box_xyxy_to_xywh(
+                mask_data["crop_boxes"][idx]
+            ).tolist(),
+        }
+        getters = [(field, field_getters[field]) for field in self.output_fields]
 
-        # Write mask records
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-                "predicted_iou": mask_data["iou_preds"][idx].item(),
-                "cate_preds": mask_data["cate_preds"][idx].item(),
-                "fc_features": mask_data["fc_features"][idx].tolist(),
-                "similarity": mask_data["similarity"][idx].tolist(),
-                "point_coords": [mask_data["points"][idx].tolist()],
-                "stability_score": mask_data["stability_score"][idx].item(),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-            }
-            curr_anns.append(ann)
+        for idx in range(len(mask_data["rles"])):
+            curr_anns.append({field: getter(idx) for field, getter in getters})
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(
+        self, image: np.ndarray, embedding: Optional[np.ndarray] = None
+    ) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
-        data = MaskData()
+        crops = []
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+            # Only the first layer covers the whole image
+            crop_embedding = embedding if layer_idx == 0 else None
+            crops.append((image, crop_box, layer_idx, orig_size, crop_embedding))
+
+        # Iterate over image crops, which are merged in their order,
+        # so the masks are the same as the serial run
+        data = MaskData()
+        if self.crop_workers > 1 and len(crops) > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(self.crop_workers, len(crops))
+            ) as executor:
+                for crop_data in executor.map(self._process_crop_in_worker, crops):
+                    data.cat(crop_data)
+        else:
+            for crop in crops:
+                data.cat(self._process_crop(*crop))
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1 and not data["crop_boxes"].numel() == 0:
@@ -223,25 +318,42 @@ class SamAutomaticMaskGenerator:
                 iou_threshold=self.crop_nms_thresh,
             )
             data.filter(keep_by_nms)
-        fc_features = F.normalize(data["fc_features"], dim=-1)
-        similarity = fc_features.mm(fc_features.t())
-        similarity.fill_diagonal_(-np.inf)
-        data["similarity"] = similarity
+        if "similarity" in self.output_fields:
+            fc_features = F.normalize(data["fc_features"], dim=-1)
+            similarity = fc_features.mm(fc_features.t())
+            similarity.fill_diagonal_(-np.inf)
+            data["similarity"] = similarity
         data.to_numpy()
         return data
 
+    def _process_crop_in_worker(self, crop: Tuple) -> MaskData:
+        # The grad mode is local to each thread
+        with torch.no_grad():
+            predictor = self.idle_predictors.get()
+            try:
+                return self._process_crop(*crop, predictor=predictor)
+            finally:
+                self.idle_predictors.put(predictor)
+
     def _process_crop(
         self,
         image: np.ndarray,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        embedding: Optional[np.ndarray] = None,
+        predictor: Optional[SamPredictor] = None,
     ) -> MaskData:
+        if predictor is None:
+            predictor = self.predictor
         # Crop the image and calculate embeddings
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        if embedding is not None:
+            predictor.set_image_embedding(embedding, cropped_im_size)
+        else:
+            predictor.set_image(cropped_im, cache_embedding=crop_layer_idx == 0)
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
@@ -249,11 +361,11 @@ class SamAutomaticMaskGenerator:
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
             batch_data = self._process_batch(
-                points, cropped_im_size, crop_box, orig_size
+                points, cropped_im_size, crop_box, orig_size, predictor
             )
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_image()
+        predictor.reset_image()
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
             data["boxes"].float(),
@@ -274,15 +386,18 @@ class SamAutomaticMaskGenerator:
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
+        predictor: Optional[SamPredictor] = None,
     ) -> MaskData:
+        if predictor is None:
+            predictor = self.predictor
         orig_h, orig_w = orig_size
         # Run model on this batch
-        transformed_points = self.predictor.transform.apply_coords(points, im_size)
-        in_points = torch.as_tensor(transformed_points, device=self.predictor.device)
+        transformed_points = predictor.transform.apply_coords(points, im_size)
+        in_points = torch.as_tensor(transformed_points, device=predictor.device)
         in_labels = torch.ones(
             in_points.shape[0], dtype=torch.int, device=in_points.device
         )
-        masks, iou_preds, _, fc_features, cate_preds = self.predictor.predict_torch(
+        masks, iou_preds, _, fc_features, cate_preds = predictor.predict_torch(
             in_points[:, None, :],
             in_labels[:, None],
             multimask_output=False,
@@ -294,9 +409,11 @@ class SamAutomaticMaskGenerator:
             masks=masks.flatten(0, 1),
             iou_preds=iou_preds.flatten(0, 1),
             cate_preds=cate_preds.flatten(0, 1),
-            fc_features=fc_features.flatten(0, 1),
             points=torch.as_tensor(points.repeat(masks.shape[1], axis=0)),
         )
+        # The features are only kept alive for the output fields which need them
+        if self.keep_fc_features:
+            data["fc_features"] = fc_features.flatten(0, 1)
 
         del masks
         del fc_features
@@ -340,7 +457,7 @@ class SamAutomaticMaskGenerator:
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData, min_area: int, nms_thresh: float, workers: int = 1
     ) -> MaskData:
         """
         Removes small disconnected regions and holes in masks, then reruns
@@ -353,25 +470,28 @@ class SamAutomaticMaskGenerator:
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        # Filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(torch.as_tensor(mask).unsqueeze(0))
-            # Give score=0 to changed masks and score=1 to unchanged masks
-            # so NMS will prefer ones that didn't need postprocessing
-            scores.append(float(unchanged))
-
-        # Recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks)
+        def remove_small_regions(rle: Dict[str, Any]) -> Tuple[PackedMask, bool]:
+            # Each mask is only decoded and processed within its box
+            mask, x0, y0, changed = remove_small_regions_rle(rle, min_area)
+            height, width = rle["size"]
+            return PackedMask.from_crop(mask, x0, y0, height, width), changed
+
+        # Filter small disconnected regions and holes, the masks are processed
+        # concurrently and kept bit-packed within their boxes
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(remove_small_regions, mask_data["rles"]))
+        new_masks = [mask for mask, _ in results]
+        # Give score=0 to changed masks and score=1 to unchanged masks
+        # so NMS will prefer ones that didn't need postprocessing
+        scores = [float(not changed) for _, changed in results]
+
+        # Recalculate boxes and remove any new duplicates.
+        # Same as batched_mask_to_box: the right and bottom edges are inclusive,
+        # and the box of an empty mask is [0, 0, 0, 0]
+        boxes = packed_mask_boxes(new_masks)
+        boxes[:, 2:] -= 1
+        boxes[[mask.is_empty() for mask in new_masks]] = 0
+        boxes = torch.as_tensor(boxes)
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores),
@@ -382,8 +502,7 @@ class SamAutomaticMaskGenerator:
         # Only recalculate RLEs for masks that have changed
         for i_mask in keep_by_nms:
             if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+                mask_data["rles"][i_mask] = new_masks[i_mask].to_uncompressed_rle()
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
@@ -1,18 +1,15 @@
+import logging
+import queue
 import numpy as np
 from typing import Tuple
 from PIL import Image
 
-import multiprocessing
-
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple
-from copy import deepcopy
-from ..util.onnx import preprocess_image, preprocess_point, preprocess_labels
+from ..embeddingCache import EmbeddingCache
+from ..mask.packedMask import PackedMask, packed_mask_boxes
+from ..util.onnx import ImagePreprocessor, determine_sam_input_shape, preprocess_point, preprocess_labels
 import onnxruntime as ort
-import torch
-
-from .build_sam import sam_model_registry
-from .predictor import SamPredictor
-from .utils.onnx import SamOnnxModel
 
 from .utils.amg_numpy import (
     MaskData,
@@ -26,7 +23,7 @@ from .utils.amg_numpy import (
     generate_crop_boxes,
     is_box_near_crop_edge,
     mask_to_rle_numpy,
-    remove_small_regions,
+    remove_small_regions_rle,
     rle_to_mask,
     uncrop_boxes_xyxy,
     uncrop_masks,
@@ -56,6 +53,15 @@ def normalize(input: np.ndarray, p: float = 2.0, dim: int = 1, eps: float = 1e-1
         np.divide(input, norm, out=out)
         return out
 
+def mask_similarity(fc_features: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity between the features of the masks, excluding each mask itself
+    """
+    fc_features = normalize(fc_features, dim=-1)
+    similarity = np.dot(fc_features, fc_features.T)
+    np.fill_diagonal(similarity, -np.inf)
+    return similarity
+
 def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarray:
     x1 = boxes[:, 0]
     y1 = boxes[:, 1]
@@ -63,7 +69,8 @@ def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarr
     y2 = boxes[:, 3]
 
     areas = (x2 - x1) * (y2 - y1)
-    order = scores.argsort()[::-1]
+    # Stable sort in descending order, same as torchvision, so that ties keep their order
+    order = np.argsort(-scores, kind="stable")
 
     keep = []
     while order.size > 0:
@@ -82,7 +89,7 @@ def nms(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float) -> np.ndarr
         inds = np.where(iou <= iou_threshold)[0]
         order = order[inds + 1]
 
-    return np.array(keep)
+    return np.array(keep, dtype=np.int64)
 
 def batched_nms(
     boxes: np.ndarray,
@@ -99,12 +106,31 @@ def batched_nms(
         keep_mask[cls_indices[cls_keep_indices]] = True
 
     keep_indices = np.where(keep_mask)[0]
-    return keep_indices[scores[keep_indices].argsort()[::-1]]
+    return keep_indices[np.argsort(-scores[keep_indices], kind="stable")]
 
 def box_area(boxes: np.ndarray) -> np.ndarray:
     return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
 
 class SamAutomaticMaskGeneratorOnnx:
+    # Fields of the generated mask records
+    OUTPUT_FIELDS = [
+        "segmentation",
+        "area",
+        "bbox",
+        "predicted_iou",
+        "cate_preds",
+        "fc_features",
+        "similarity",
+        "point_coords",
+        "stability_score",
+        "crop_box",
+    ]
+
+    # Version of the decoder export by gen_coral_onnx.py, stored in the metadata of the decoder.
+    # Version 2 decodes with the single-mask output token, same as SamPredictor with multimask_output=False
+    DECODER_EXPORT_VERSION_KEY = "coralscop_decoder_export_version"
+    DECODER_EXPORT_VERSION = "2"
+
     def __init__(
         self,
         encoder_onnx: ort.InferenceSession,
@@ -122,7 +148,19 @@ class SamAutomaticMaskGeneratorOnnx:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        crop_workers: int = 1,
+        output_fields: Optional[List[str]] = None,
     ) -> None:
+        """
+        crop_workers is the number of crops processed concurrently by a thread pool,
+        which share the encoder and decoder sessions. The crops are processed one
+        by one if it is 1. The masks are also postprocessed by as many threads.
+
+        output_fields selects the fields of the mask records among OUTPUT_FIELDS, all
+        of them by default. The features of the masks are only kept if the fc_features
+        or the similarity field is selected.
+        """
+        assert crop_workers >= 1, f"crop_workers should be at least 1, got {crop_workers}"
         assert (points_per_side is None) != (point_grids is None), \
             "Exactly one of points_per_side or point_grid must be provided."
         if points_per_side is not None:
@@ -150,67 +188,140 @@ class SamAutomaticMaskGeneratorOnnx:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.crop_workers = crop_workers
+        self.set_output_fields(output_fields)
 
+        self.logger = logging.getLogger(self.__class__.__name__)
         self.encoder_onnx = encoder_onnx    
         self.decoder_onnx = decoder_onnx
         self.mask_threshold = 0.0
 
-    def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
-        mask_data = self._generate_masks(image)
+        # The input buffers of the encoder are reused across the crops,
+        # each crop being encoded concurrently takes its own buffer
+        self.preprocessors = queue.Queue()
+        for _ in range(crop_workers):
+            self.preprocessors.put(ImagePreprocessor())
+
+        # An older decoder selects another output token, and gives other masks than the torch generator
+        export_version = decoder_onnx.get_modelmeta().custom_metadata_map.get(
+            SamAutomaticMaskGeneratorOnnx.DECODER_EXPORT_VERSION_KEY)
+        if export_version != SamAutomaticMaskGeneratorOnnx.DECODER_EXPORT_VERSION:
+            raise ValueError(
+                f"The decoder export version is {export_version}, version "
+                f"{SamAutomaticMaskGeneratorOnnx.DECODER_EXPORT_VERSION} is required. "
+                f"Export the decoder again with gen_coral_onnx.py")
+
+        # A decoder exported with a dynamic batch axis decodes a whole batch of points
+        # in one run, each point being a separate prompt. Otherwise the points are decoded one by one.
+        batch_dim = [input.shape[0] for input in decoder_onnx.get_inputs() if input.name == "point_coords"][0]
+        self.dynamic_batch = not isinstance(batch_dim, int)
+        self.logger.info(f"Dynamic batch decoder: {self.dynamic_batch}")
+
+        self.embedding_cache = None
+        self.model_identity = None
+
+    def set_embedding_cache(self, embedding_cache: EmbeddingCache, model_identity: str):
+        """
+        Consult the embedding cache before encoding the whole image. The crops of the other
+        layers are not cached, so that they do not evict the embeddings of whole images.
+        model_identity identifies the encoder, see EmbeddingCache.get_model_identity.
+        """
+        self.embedding_cache = embedding_cache
+        self.model_identity = model_identity
+
+    def set_output_fields(self, output_fields: Optional[List[str]]):
+        if output_fields is None:
+            output_fields = SamAutomaticMaskGeneratorOnnx.OUTPUT_FIELDS
+        for field in output_fields:
+            assert field in SamAutomaticMaskGeneratorOnnx.OUTPUT_FIELDS, \
+                f"Unknown output field {field}, should be one of {SamAutomaticMaskGeneratorOnnx.OUTPUT_FIELDS}"
+        # Same order as OUTPUT_FIELDS
+        self.output_fields = [field for field in SamAutomaticMaskGeneratorOnnx.OUTPUT_FIELDS if field in output_fields]
+        self.keep_fc_features = "fc_features" in output_fields or "similarity" in output_fields
+
+    def generate(self, image: np.ndarray, embedding: Optional[np.ndarray] = None) -> List[Dict[str, Any]]:
+        """
+        embedding is a precomputed embedding of the whole image by the encoder,
+        used for the uncropped layer in place of running the encoder.
+        """
+        mask_data = self._generate_masks(image, embedding)
 
         if self.min_mask_region_area > 0:
             mask_data = self.postprocess_small_regions(
                 mask_data,
                 self.min_mask_region_area,
                 max(self.box_nms_thresh, self.crop_nms_thresh),
+                self.crop_workers,
             )
 
-        if self.output_mode == "coco_rle":
-            mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
-        elif self.output_mode == "binary_mask":
-            mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
-        else:
-            mask_data["segmentations"] = mask_data["rles"]
+        return self._write_annotations(mask_data)
+
+    def _write_annotations(self, mask_data: MaskData) -> List[Dict[str, Any]]:
+        """
+        Write the mask records, with only the output fields
+        """
+        if "segmentation" in self.output_fields:
+            if self.output_mode == "coco_rle":
+                mask_data["segmentations"] = [coco_encode_rle(rle) for rle in mask_data["rles"]]
+            elif self.output_mode == "binary_mask":
+                mask_data["segmentations"] = [rle_to_mask(rle) for rle in mask_data["rles"]]
+            else:
+                mask_data["segmentations"] = mask_data["rles"]
+
+        field_getters = {
+            "segmentation": lambda idx: mask_data["segmentations"][idx],
+            "area": lambda idx: area_from_rle(mask_data["rles"][idx]),
+            "bbox": lambda idx: box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
+            "predicted_iou": lambda idx: float(mask_data["iou_preds"][idx]),
+            "cate_preds": lambda idx: int(mask_data["cate_preds"][idx]),
+            "fc_features": lambda idx: mask_data["fc_features"][idx].tolist(),
+            "similarity": lambda idx: mask_data["similarity"][idx].tolist(),
+            "point_coords": lambda idx: [mask_data["points"][idx].tolist()],
+            "stability_score": lambda idx: float(mask_data["stability_score"][idx]),
+            "crop_box": lambda idx: box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
+        }
+        getters = [(field, field_getters[field]) for field in self.output_fields]
 
         curr_anns = []
-        for idx in range(len(mask_data["segmentations"])):
-            ann = {
-                "segmentation": mask_data["segmentations"][idx],
-                "area": area_from_rle(mask_data["rles"][idx]),
-                "bbox": box_xyxy_to_xywh(mask_data["boxes"][idx]).tolist(),
-                "predicted_iou": float(mask_data["iou_preds"][idx]),
-                "point_coords": [mask_data["points"][idx].tolist()],
-                "stability_score": float(mask_data["stability_score"][idx]),
-                "crop_box": box_xyxy_to_xywh(mask_data["crop_boxes"][idx]).tolist(),
-            }
-            curr_anns.append(ann)
+        for idx in range(len(mask_data["rles"])):
+            curr_anns.append({field: getter(idx) for field, getter in getters})
 
         return curr_anns
 
-    def _generate_masks(self, image: np.ndarray) -> MaskData:
+    def _generate_masks(self, image: np.ndarray, embedding: Optional[np.ndarray] = None) -> MaskData:
         orig_size = image.shape[:2]
         crop_boxes, layer_idxs = generate_crop_boxes(
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        data = MaskData()
+        crops = []
         for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+            # Only the first layer covers the whole image
+            crop_embedding = embedding if layer_idx == 0 else None
+            crops.append((image, crop_box, layer_idx, orig_size, crop_embedding))
+
+        # The crops are merged in their order, so the masks are the same as the serial run
+        data = MaskData()
+        if self.crop_workers > 1 and len(crops) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.crop_workers, len(crops))) as executor:
+                for crop_data in executor.map(lambda crop: self._process_crop(*crop), crops):
+                    data.cat(crop_data)
+        else:
+            for crop in crops:
+                data.cat(self._process_crop(*crop))
 
-        if len(crop_boxes) > 1:
-            scores = 1 / box_area(data["crop_boxes"])
+        if len(crop_boxes) > 1 and not data["crop_boxes"].size == 0:
+            # Prefer masks from smaller crops
+            scores = (1 / box_area(data["crop_boxes"])).astype(np.float32)
             keep_by_nms = nms(
-                data["boxes"].astype(float),
+                data["boxes"].astype(np.float32),
                 scores,
                 iou_threshold=self.crop_nms_thresh,
             )
             data.filter(keep_by_nms)
 
-        fc_features = normalize(data["fc_features"], dim=-1)
-        similarity = np.dot(fc_features, fc_features.T)
-        np.fill_diagonal(similarity, -np.inf)
-        data["similarity"] = similarity
+        if "similarity" in self.output_fields:
+            data["similarity"] = mask_similarity(data["fc_features"])
         data.to_numpy()
         return data
 
@@ -220,23 +331,30 @@ class SamAutomaticMaskGeneratorOnnx:
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
+        embedding: Optional[np.ndarray] = None,
     ) -> MaskData:
         x0, y0, x1, y1 = crop_box
         cropped_im = image[y0:y1, x0:x1, :]
         cropped_im_size = cropped_im.shape[:2]
 
+        # Encode the crop once, the embeddings are shared by all the batches of points
+        cropped_image = Image.fromarray(cropped_im)
+        resized_size = determine_sam_input_shape(cropped_image)
+        embeddings = embedding
+        if embeddings is None:
+            embeddings = self._encode(cropped_im, cropped_image, cache_embedding=crop_layer_idx == 0)
+
         points_scale = np.array(cropped_im_size)[None, ::-1]
         points_for_image = self.point_grids[crop_layer_idx] * points_scale
 
-
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(cropped_im, points, cropped_im_size, crop_box, orig_size)
+            batch_data = self._process_batch(embeddings, points, cropped_im_size, resized_size, crop_box, orig_size)
             data.cat(batch_data)
             del batch_data
 
         keep_by_nms = nms(
-            data["boxes"].astype(float),
+            data["boxes"].astype(np.float32),
             data["iou_preds"],
             iou_threshold=self.box_nms_thresh,
         )
@@ -244,78 +362,107 @@ class SamAutomaticMaskGeneratorOnnx:
 
         data["boxes"] = uncrop_boxes_xyxy(data["boxes"], crop_box)
         data["points"] = uncrop_points(data["points"], crop_box)
-        data["crop_boxes"] = np.array([crop_box for _ in range(len(data["rles"]))])
+        data["crop_boxes"] = np.array([crop_box for _ in range(len(data["rles"]))]).reshape(-1, 4)
         return data
 
+    def _encode(self, cropped_im: np.ndarray, cropped_image: Image, cache_embedding: bool = True) -> np.ndarray:
+        key = None
+        if self.embedding_cache is not None and cache_embedding:
+            key = EmbeddingCache.get_key(cropped_im, self.model_identity)
+            embeddings = self.embedding_cache.get(key)
+            if embeddings is not None:
+                return embeddings
+
+        preprocessor = self.preprocessors.get()
+        try:
+            input_tensor = preprocessor.preprocess(cropped_image)
+            embeddings = self.encoder_onnx.run(None, {"images": input_tensor})[0]
+        finally:
+            self.preprocessors.put(preprocessor)
+        if key is not None:
+            self.embedding_cache.put(key, embeddings)
+        return embeddings
+
+    def _decode(
+        self,
+        embeddings: np.ndarray,
+        point_coords: np.ndarray,
+        point_labels: np.ndarray,
+        im_size: Tuple[int, ...],
+    ) -> List[np.ndarray]:
+        """
+        Decode each row of points as a separate prompt.
+        point_coords: (N, P, 2), point_labels: (N, P)
+        Returns the decoder outputs with a batch axis of size N.
+        """
+        inputs = {
+            "image_embeddings": embeddings,
+            "mask_input": np.zeros((1, 1, 256, 256), dtype=np.float32),
+            "has_mask_input": np.zeros(1, dtype=np.float32),
+            "orig_im_size": np.array(im_size, dtype=np.float32),
+        }
+
+        if self.dynamic_batch:
+            return self.decoder_onnx.run(None, {**inputs, "point_coords": point_coords, "point_labels": point_labels})
+
+        outputs = []
+        for i in range(len(point_coords)):
+            outputs.append(self.decoder_onnx.run(None, {
+                **inputs,
+                "point_coords": point_coords[i:i + 1],
+                "point_labels": point_labels[i:i + 1],
+            }))
+        return [np.concatenate(output, axis=0) for output in zip(*outputs)]
+
     def _process_batch(
         self,
-        image: np.ndarray,
+        embeddings: np.ndarray,
         points: np.ndarray,
         im_size: Tuple[int, ...],
+        resized_size: Tuple[int, int],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
     ) -> MaskData:
         orig_h, orig_w = orig_size
+        im_h, im_w = im_size
+        resized_width, resized_height = resized_size
 
-        image = Image.fromarray(image)
-        input_image_width, input_image_height = image.size
-        input_tensor = preprocess_image(image)
-        resized_width, resized_height = input_tensor.shape[3], input_tensor.shape[2]
-
-        outputs = self.encoder_onnx.run(None, {"images": input_tensor})
-        embeddings = outputs[0]
-
-        bs = points.shape[0]
-        onnx_coord_batch = preprocess_point(points, input_image_width, input_image_height, resized_width, resized_height)
-        onnx_label_batch = np.ones(len(points), dtype=np.int32)
-        onnx_label_batch = preprocess_labels(onnx_label_batch)
-
-        onnx_mask_input = np.zeros((1, 1, 256, 256), dtype=np.float32)
-        onnx_has_mask_input = np.zeros(1, dtype=np.float32)
-
-        masks = np.zeros((bs, input_image_height, input_image_width), dtype=np.float32)
-        iou_preds = np.zeros((bs), dtype=np.float32)
-        cate_preds = np.zeros((bs), dtype=np.float32)
-        fc_features = np.zeros((bs, 256), dtype=np.float32)
-
-        # Process the point one by one
-        for i in range(bs):
-            onnx_coord = onnx_coord_batch[:, i, :][:, None, :]
-            onnx_label = onnx_label_batch[:, i][None, :]
-
-            mask, iou_pred, _, cate_pred, fc_feature = self.decoder_onnx.run(None, {
-                "image_embeddings": embeddings,
-                "point_coords": onnx_coord,
-                "point_labels": onnx_label,
-                "mask_input": onnx_mask_input,
-                "has_mask_input": onnx_has_mask_input,
-                "orig_im_size": np.array([input_image_height, input_image_width], dtype=np.float32)
-            })
-
-            cate_pred = np.argmax(cate_pred, axis=2)[0]
-            masks[i] = mask
-            iou_preds[i] = iou_pred
-            cate_preds[i] = cate_pred
-            fc_features[i] = fc_feature
+        # One prompt for each point of the batch. Same as the prompt encoder of SamPredictor,
+        # the point is followed by a padding point labelled -1, as there is no box.
+        point_coords = np.zeros((len(points), 2, 2), dtype=np.float32)
+        point_coords[:, 0] = preprocess_point(points, im_w, im_h, resized_width, resized_height)[0]
+        point_labels = np.zeros((len(points), 2), dtype=np.float32)
+        point_labels[:, 0] = preprocess_labels(np.ones(len(points), dtype=np.int32))[0]
+        point_labels[:, 1] = -1
+
+        masks, iou_preds, _, cate_preds, fc_features = self._decode(embeddings, point_coords, point_labels, im_size)
+
+        # The decoder returns a single mask per prompt
+        masks = masks[:, 0]
+        iou_preds = iou_preds[:, 0]
+        cate_preds = np.argmax(cate_preds, axis=2)[:, 0]
+        fc_features = fc_features[:, 0]
 
         data = MaskData(
             masks=masks,
             iou_preds=iou_preds,
             cate_preds=cate_preds,
-            fc_features=fc_features,
             points=points,
         )
+        # The features are only kept alive for the output fields which need them
+        if self.keep_fc_features:
+            data["fc_features"] = fc_features
 
         del masks
         del fc_features
 
         keep_mask = data["cate_preds"] > 0
-        print(f"number of masks filtered by cate_preds: {np.sum(~keep_mask)}")
+        self.logger.debug(f"Number of masks filtered by cate_preds: {np.sum(~keep_mask)}")
         data.filter(keep_mask)
 
         if self.pred_iou_thresh > 0.0:
             keep_mask = data["iou_preds"] > self.pred_iou_thresh
-            print(f"number of masks filtered by iou_preds: {np.sum(~keep_mask)}")
+            self.logger.debug(f"Number of masks filtered by iou_preds: {np.sum(~keep_mask)}")
             data.filter(keep_mask)
 
         data["stability_score"] = calculate_stability_score(
@@ -323,7 +470,7 @@ class SamAutomaticMaskGeneratorOnnx:
         )
         if self.stability_score_thresh > 0.0:
             keep_mask = data["stability_score"] >= self.stability_score_thresh
-            print(f"number of masks filtered by stability_score: {np.sum(~keep_mask)}")
+            self.logger.debug(f"Number of masks filtered by stability_score: {np.sum(~keep_mask)}")
             data.filter(keep_mask)
 
         data["masks"] = data["masks"] > self.mask_threshold
@@ -331,48 +478,50 @@ class SamAutomaticMaskGeneratorOnnx:
 
         keep_mask = ~is_box_near_crop_edge(data["boxes"], crop_box, [0, 0, orig_w, orig_h])
         if not np.all(keep_mask):
-            print(f"number of masks filtered by crop edge: {np.sum(~keep_mask)}")
+            self.logger.debug(f"Number of masks filtered by crop edge: {np.sum(~keep_mask)}")
             data.filter(keep_mask)
 
         data["masks"] = uncrop_masks(data["masks"], crop_box, orig_h, orig_w)
         data["rles"] = mask_to_rle_numpy(data["masks"])
 
-        print(f"num of masks: {data['masks'].shape[0]}")
+        self.logger.debug(f"Number of masks: {data['masks'].shape[0]}")
         del data["masks"]
 
         return data
 
     @staticmethod
     def postprocess_small_regions(
-        mask_data: MaskData, min_area: int, nms_thresh: float
+        mask_data: MaskData, min_area: int, nms_thresh: float, workers: int = 1
     ) -> MaskData:
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = rle_to_mask(rle)
-
-            mask, changed = remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
-
-            new_masks.append(mask[np.newaxis, ...])
-            scores.append(float(unchanged))
-
-        masks = np.concatenate(new_masks, axis=0)
-        boxes = batched_mask_to_box(masks)
+        def remove_small_regions(rle: Dict[str, Any]) -> Tuple[PackedMask, bool]:
+            # Each mask is only decoded and processed within its box
+            mask, x0, y0, changed = remove_small_regions_rle(rle, min_area)
+            height, width = rle["size"]
+            return PackedMask.from_crop(mask, x0, y0, height, width), changed
+
+        # The masks are processed concurrently and kept bit-packed within their boxes
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(remove_small_regions, mask_data["rles"]))
+        new_masks = [mask for mask, _ in results]
+        scores = [float(not changed) for _, changed in results]
+
+        # Same as batched_mask_to_box: the right and bottom edges are inclusive,
+        # and the box of an empty mask is [0, 0, 0, 0]
+        boxes = packed_mask_boxes(new_masks)
+        boxes[:, 2:] -= 1
+        boxes[[mask.is_empty() for mask in new_masks]] = 0
         keep_by_nms = nms(
-            boxes.astype(float),
-            np.array(scores),
+            boxes.astype(np.float32),
+            np.array(scores, dtype=np.float32),
             iou_threshold=nms_thresh,
         )
 
         for i_mask in keep_by_nms:
             if scores[i_mask] == 0.0:
-                mask_data["rles"][i_mask] = mask_to_rle_numpy(masks[i_mask:i_mask + 1])[0]
+                mask_data["rles"][i_mask] = new_masks[i_mask].to_uncompressed_rle()
                 mask_data["boxes"][i_mask] = boxes[i_mask]
         mask_data.filter(keep_by_nms)
 
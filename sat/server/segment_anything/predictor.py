@@ -31,10 +31,26 @@ class SamPredictor:
         self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
         self.reset_image()
 
+        # Optional cache of the image embeddings, see set_embedding_cache
+        self.embedding_cache = None
+        self.model_identity = None
+
+    def set_embedding_cache(self, embedding_cache, model_identity: str) -> None:
+        """
+        Consult the embedding cache before running the image encoder in set_image.
+
+        Arguments:
+          embedding_cache (EmbeddingCache): The cache of the image embeddings.
+          model_identity (str): The identity of the model, which is part of the cache key.
+        """
+        self.embedding_cache = embedding_cache
+        self.model_identity = model_identity
+
     def set_image(
         self,
         image: np.ndarray,
         image_format: str = "RGB",
+        cache_embedding: bool = True,
     ) -> None:
         """
         Calculates the image embeddings for the provided image, allowing
@@ -44,6 +60,8 @@ class SamPredictor:
           image (np.ndarray): The image for calculating masks. Expects an
             image in HWC uint8 format, with pixel values in [0, 255].
           image_format (str): The color format of the image, in ['RGB', 'BGR'].
+          cache_embedding (bool): Whether the embedding cache is consulted,
+            if it is set.
         """
         assert image_format in [
             "RGB",
@@ -52,6 +70,14 @@ class SamPredictor:
         if image_format != self.model.image_format:
             image = image[..., ::-1]
 
+        key = None
+        if self.embedding_cache is not None and cache_embedding:
+            key = self.embedding_cache.get_key(image, self.model_identity)
+            features = self.embedding_cache.get(key)
+            if features is not None:
+                self.set_image_embedding(features, image.shape[:2])
+                return
+
         # Transform the image to the form expected by the model
         input_image = self.transform.apply_image(image)
         input_image_torch = torch.as_tensor(input_image, device=self.device)
@@ -61,6 +87,34 @@ class SamPredictor:
 
         self.set_torch_image(input_image_torch, image.shape[:2])
 
+        if key is not None:
+            self.embedding_cache.put(key, self.features.cpu().numpy())
+
+    def set_image_embedding(
+        self,
+        image_embedding: np.ndarray,
+        original_image_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Sets a precomputed image embedding in place of running the image encoder,
+        allowing masks to be predicted with the 'predict' method.
+
+        Arguments:
+          image_embedding (np.ndarray): The image embedding with shape 1xCxHxW,
+            computed by the image encoder of the model.
+          original_image_size (tuple(int, int)): The size of the image
+            before transformation, in (H, W) format.
+        """
+        self.reset_image()
+        self.original_size = original_image_size
+        self.input_size = self.transform.get_preprocess_shape(
+            original_image_size[0],
+            original_image_size[1],
+            self.transform.target_length,
+        )
+        self.features = torch.as_tensor(image_embedding, device=self.device)
+        self.is_image_set = True
+
     @torch.no_grad()
     def set_torch_image(
         self,
@@ -0,0 +1,438 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# Numpy port of amg.py for the ONNX automatic mask generator, which runs without torch
+
+import numpy as np
+
+import math
+from copy import deepcopy
+from itertools import product
+from typing import Any, Dict, Generator, ItemsView, List, Tuple
+
+
+class MaskData:
+    """
+    A structure for storing masks and their related data in batched format.
+    Implements basic filtering and concatenation.
+    """
+
+    def __init__(self, **kwargs) -> None:
+        for v in kwargs.values():
+            assert isinstance(
+                v, (list, np.ndarray)
+            ), "MaskData only supports list and numpy arrays."
+        self._stats = dict(**kwargs)
+
+    def __setitem__(self, key: str, item: Any) -> None:
+        assert isinstance(
+            item, (list, np.ndarray)
+        ), "MaskData only supports list and numpy arrays."
+        self._stats[key] = item
+
+    def __delitem__(self, key: str) -> None:
+        del self._stats[key]
+
+    def __getitem__(self, key: str) -> Any:
+        return self._stats[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._stats
+
+    def items(self) -> ItemsView[str, Any]:
+        return self._stats.items()
+
+    def filter(self, keep: np.ndarray) -> None:
+        keep = np.asarray(keep)
+        for k, v in self._stats.items():
+            if v is None:
+                self._stats[k] = None
+            elif isinstance(v, np.ndarray):
+                self._stats[k] = v[keep]
+            elif isinstance(v, list) and keep.dtype == bool:
+                self._stats[k] = [a for i, a in enumerate(v) if keep[i]]
+            elif isinstance(v, list):
+                self._stats[k] = [v[i] for i in keep]
+            else:
+                raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+
+    def cat(self, new_stats: "MaskData") -> None:
+        for k, v in new_stats.items():
+            if k not in self._stats or self._stats[k] is None:
+                self._stats[k] = deepcopy(v)
+            elif isinstance(v, np.ndarray):
+                self._stats[k] = np.concatenate([self._stats[k], v], axis=0)
+            elif isinstance(v, list):
+                self._stats[k] = self._stats[k] + deepcopy(v)
+            else:
+                raise TypeError(f"MaskData key {k} has an unsupported type {type(v)}.")
+
+    def to_numpy(self) -> None:
+        # Kept for compatibility with the torch MaskData, the stats are already numpy arrays
+        pass
+
+
+def is_box_near_crop_edge(
+    boxes: np.ndarray, crop_box: List[int], orig_box: List[int], atol: float = 20.0
+) -> np.ndarray:
+    """Filter masks at the edge of a crop, but not at the edge of the original image."""
+    crop_box_np = np.asarray(crop_box, dtype=np.float32)
+    orig_box_np = np.asarray(orig_box, dtype=np.float32)
+    boxes = uncrop_boxes_xyxy(boxes, crop_box).astype(np.float32)
+    near_crop_edge = np.isclose(boxes, crop_box_np[None, :], atol=atol, rtol=0)
+    near_image_edge = np.isclose(boxes, orig_box_np[None, :], atol=atol, rtol=0)
+    near_crop_edge = np.logical_and(near_crop_edge, ~near_image_edge)
+    return np.any(near_crop_edge, axis=1)
+
+
+def box_xyxy_to_xywh(box_xyxy: np.ndarray) -> np.ndarray:
+    box_xywh = deepcopy(box_xyxy)
+    box_xywh[2] = box_xywh[2] - box_xywh[0]
+    box_xywh[3] = box_xywh[3] - box_xywh[1]
+    return box_xywh
+
+
+def batch_iterator(batch_size: int, *args) -> Generator[List[Any], None, None]:
+    assert len(args) > 0 and all(
+        len(a) == len(args[0]) for a in args
+    ), "Batched iteration must have inputs of all the same size."
+    n_batches = len(args[0]) // batch_size + int(len(args[0]) % batch_size != 0)
+    for b in range(n_batches):
+        yield [arg[b * batch_size : (b + 1) * batch_size] for arg in args]
+
+
+def mask_to_rle_numpy(masks: np.ndarray) -> List[Dict[str, Any]]:
+    """
+    Encodes masks to an uncompressed RLE, in the format expected by
+    pycoco tools. Same output as mask_to_rle_pytorch.
+    """
+    # Put in fortran order and flatten h,w
+    b, h, w = masks.shape
+    masks = masks.transpose(0, 2, 1).reshape(b, h * w)
+
+    # Compute change indices
+    diff = masks[:, 1:] ^ masks[:, :-1]
+    change_indices = np.argwhere(diff)
+
+    # Encode run length
+    out = []
+    for i in range(b):
+        cur_idxs = change_indices[change_indices[:, 0] == i, 1]
+        cur_idxs = np.concatenate([[0], cur_idxs + 1, [h * w]])
+        btw_idxs = cur_idxs[1:] - cur_idxs[:-1]
+        counts = [] if masks[i, 0] == 0 else [0]
+        counts.extend(btw_idxs.tolist())
+        out.append({"size": [h, w], "counts": counts})
+    return out
+
+
+def rle_to_mask(rle: Dict[str, Any]) -> np.ndarray:
+    """Compute a binary mask from an uncompressed RLE."""
+    h, w = rle["size"]
+    mask = np.empty(h * w, dtype=bool)
+    idx = 0
+    parity = False
+    for count in rle["counts"]:
+        mask[idx : idx + count] = parity
+        idx += count
+        parity ^= True
+    mask = mask.reshape(w, h)
+    return mask.transpose()  # Put in C order
+
+
+def area_from_rle(rle: Dict[str, Any]) -> int:
+    return sum(rle["counts"][1::2])
+
+
+def calculate_stability_score(
+    masks: np.ndarray, mask_threshold: float, threshold_offset: float
+) -> np.ndarray:
+    """
+    Computes the stability score for a batch of masks. The stability
+    score is the IoU between the binary masks obtained by thresholding
+    the predicted mask logits at high and low values.
+    """
+    # One mask is always contained inside the other
+    intersections = np.count_nonzero(
+        masks > (mask_threshold + threshold_offset), axis=(-2, -1)
+    )
+    unions = np.count_nonzero(
+        masks > (mask_threshold - threshold_offset), axis=(-2, -1)
+    )
+    # Same as torch, the counts are divided in float32
+    return intersections.astype(np.float32) / unions.astype(np.float32)
+
+
+def build_point_grid(n_per_side: int) -> np.ndarray:
+    """Generates a 2D grid of points evenly spaced in [0,1]x[0,1]."""
+    offset = 1 / (2 * n_per_side)
+    points_one_side = np.linspace(offset, 1 - offset, n_per_side)
+    points_x = np.tile(points_one_side[None, :], (n_per_side, 1))
+    points_y = np.tile(points_one_side[:, None], (1, n_per_side))
+    points = np.stack([points_x, points_y], axis=-1).reshape(-1, 2)
+    return points
+
+
+def build_all_layer_point_grids(
+    n_per_side: int, n_layers: int, scale_per_layer: int
+) -> List[np.ndarray]:
+    """Generates point grids for all crop layers."""
+    points_by_layer = []
+    for i in range(n_layers + 1):
+        n_points = int(n_per_side / (scale_per_layer**i))
+        points_by_layer.append(build_point_grid(n_points))
+    return points_by_layer
+
+
+def generate_crop_boxes(
+    im_size: Tuple[int, ...], n_layers: int, overlap_ratio: float
+) -> Tuple[List[List[int]], List[int]]:
+    """
+    Generates a list of crop boxes of different sizes. Each layer
+    has (2**i)**2 boxes for the ith layer.
+    """
+    crop_boxes, layer_idxs = [], []
+    im_h, im_w = im_size
+    short_side = min(im_h, im_w)
+
+    # Original image
+    crop_boxes.append([0, 0, im_w, im_h])
+    layer_idxs.append(0)
+
+    def crop_len(orig_len, n_crops, overlap):
+        return int(math.ceil((overlap * (n_crops - 1) + orig_len) / n_crops))
+
+    for i_layer in range(n_layers):
+        n_crops_per_side = 2 ** (i_layer + 1)
+        overlap = int(overlap_ratio * short_side * (2 / n_crops_per_side))
+
+        crop_w = crop_len(im_w, n_crops_per_side, overlap)
+        crop_h = crop_len(im_h, n_crops_per_side, overlap)
+
+        crop_box_x0 = [int((crop_w - overlap) * i) for i in range(n_crops_per_side)]
+        crop_box_y0 = [int((crop_h - overlap) * i) for i in range(n_crops_per_side)]
+
+        # Crops in XYWH format
+        for x0, y0 in product(crop_box_x0, crop_box_y0):
+            box = [x0, y0, min(x0 + crop_w, im_w), min(y0 + crop_h, im_h)]
+            crop_boxes.append(box)
+            layer_idxs.append(i_layer + 1)
+
+    return crop_boxes, layer_idxs
+
+
+def uncrop_boxes_xyxy(boxes: np.ndarray, crop_box: List[int]) -> np.ndarray:
+    x0, y0, _, _ = crop_box
+    offset = np.array([[x0, y0, x0, y0]])
+    # Check if boxes has a channel dimension
+    if len(boxes.shape) == 3:
+        offset = offset[:, None, :]
+    return boxes + offset
+
+
+def uncrop_points(points: np.ndarray, crop_box: List[int]) -> np.ndarray:
+    x0, y0, _, _ = crop_box
+    offset = np.array([[x0, y0]])
+    # Check if points has a channel dimension
+    if len(points.shape) == 3:
+        offset = offset[:, None, :]
+    return points + offset
+
+
+def uncrop_masks(
+    masks: np.ndarray, crop_box: List[int], orig_h: int, orig_w: int
+) -> np.ndarray:
+    x0, y0, x1, y1 = crop_box
+    if x0 == 0 and y0 == 0 and x1 == orig_w and y1 == orig_h:
+        return masks
+    # Coordinate transform masks
+    pad_x, pad_y = orig_w - (x1 - x0), orig_h - (y1 - y0)
+    pad = [(0, 0)] * (masks.ndim - 2) + [(y0, pad_y - y0), (x0, pad_x - x0)]
+    return np.pad(masks, pad, constant_values=0)
+
+
+def remove_small_regions(
+    mask: np.ndarray, area_thresh: float, mode: str
+) -> Tuple[np.ndarray, bool]:
+    """
+    Removes small disconnected regions and holes in a mask. Returns the
+    mask and an indicator of if the mask has been modified.
+    """
+    import cv2  # type: ignore
+
+    assert mode in ["holes", "islands"]
+    correct_holes = mode == "holes"
+    working_mask = (correct_holes ^ mask).astype(np.uint8)
+    n_labels, regions, stats, _ = cv2.connectedComponentsWithStats(working_mask, 8)
+    sizes = stats[:, -1][1:]  # Row 0 is background label
+    small_regions = [i + 1 for i, s in enumerate(sizes) if s < area_thresh]
+    if len(small_regions) == 0:
+        return mask, False
+    fill_labels = [0] + small_regions
+    if not correct_holes:
+        fill_labels = [i for i in range(n_labels) if i not in fill_labels]
+        # If every region is below threshold, keep largest
+        if len(fill_labels) == 0:
+            fill_labels = [int(np.argmax(sizes)) + 1]
+    mask = np.isin(regions, fill_labels)
+    return mask, True
+
+
+def rle_to_cropped_mask(rle: Dict[str, Any]) -> Tuple[np.ndarray, int, int]:
+    """
+    Decode an uncompressed RLE within the bounding box of the mask, without
+    decoding the full-resolution mask. Returns the mask and the (x0, y0) corner
+    of its box, the mask of an empty RLE is empty.
+    """
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    ends = np.cumsum(counts)
+    # The odd runs are the foreground, in column-major order
+    starts = (ends - counts)[1::2]
+    ends = ends[1::2]
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+    if len(starts) == 0:
+        return np.zeros((0, 0), dtype=bool), 0, 0
+
+    # Only the columns of the box are decoded, the runs are separated by
+    # background so their starts and ends never coincide
+    x0 = int(starts[0] // h)
+    x1 = int((ends[-1] - 1) // h + 1)
+    changes = np.zeros((x1 - x0) * h + 1, dtype=np.int8)
+    changes[starts - x0 * h] = 1
+    changes[ends - x0 * h] = -1
+    mask = np.cumsum(changes[:-1], dtype=np.int8).astype(bool)
+    mask = mask.reshape(x1 - x0, h).transpose()
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    y0, y1 = int(rows[0]), int(rows[-1]) + 1
+    return np.ascontiguousarray(mask[y0:y1]), x0, y0
+
+
+def remove_small_regions_rle(
+    rle: Dict[str, Any], area_thresh: float
+) -> Tuple[np.ndarray, int, int, bool]:
+    """
+    Removes small holes then small disconnected regions in the mask of an
+    uncompressed RLE, same as remove_small_regions with the "holes" then the
+    "islands" mode, but only within the bounding box of the mask.
+    Returns the mask within its box, the (x0, y0) corner of the box
+    and an indicator of if the mask has been modified.
+
+    The image around the box is background, so a hole connected to it belongs to
+    a background region at least as large as the smallest strip of the image around
+    the box. If a strip is smaller than area_thresh, or the largest of the small
+    regions is ambiguous, the full-resolution mask is processed instead.
+    """
+    import cv2  # type: ignore
+
+    height, width = rle["size"]
+    mask, x0, y0 = rle_to_cropped_mask(rle)
+    box_h, box_w = mask.shape
+    strips = [
+        y0 * width,
+        (height - y0 - box_h) * width,
+        x0 * box_h,
+        (width - x0 - box_w) * box_h,
+    ]
+    if mask.size == 0 or any(0 < area < area_thresh for area in strips):
+        return _remove_small_regions_full(rle, area_thresh)
+
+    # Holes, with one pixel of the surrounding background on the sides of the box
+    # which are not on the image border
+    top, bottom = int(y0 > 0), int(y0 + box_h < height)
+    left, right = int(x0 > 0), int(x0 + box_w < width)
+    working_mask = np.pad(
+        ~mask, ((top, bottom), (left, right)), constant_values=True
+    ).astype(np.uint8)
+    _, regions, stats, _ = cv2.connectedComponentsWithStats(working_mask, 8)
+    small = stats[:, -1] < area_thresh
+    # Label 0 is the mask, and the holes connected to the surrounding background are large
+    small[0] = False
+    border = [
+        regions[0] if top else [],
+        regions[-1] if bottom else [],
+        regions[:, 0] if left else [],
+        regions[:, -1] if right else [],
+    ]
+    small[np.concatenate(border).astype(np.int64)] = False
+    holes_changed = bool(small.any())
+    if holes_changed:
+        mask = mask | small[regions[top : top + box_h, left : left + box_w]]
+
+    # Islands, which are all within the box
+    _, regions, stats, _ = cv2.connectedComponentsWithStats(mask.astype(np.uint8), 8)
+    sizes = stats[:, -1][1:]  # Row 0 is background label
+    small = sizes < area_thresh
+    if not small.any():
+        return mask, x0, y0, holes_changed
+    keep = ~small
+    if not keep.any():
+        # If every region is below threshold, keep largest, which is the first
+        # label of the full-resolution mask in case of a tie
+        keep = sizes == sizes.max()
+        if keep.sum() > 1:
+            return _remove_small_regions_full(rle, area_thresh)
+    mask = np.concatenate(([False], keep))[regions]
+    return mask, x0, y0, True
+
+
+def _remove_small_regions_full(
+    rle: Dict[str, Any], area_thresh: float
+) -> Tuple[np.ndarray, int, int, bool]:
+    mask, holes_changed = remove_small_regions(
+        rle_to_mask(rle), area_thresh, mode="holes"
+    )
+    mask, islands_changed = remove_small_regions(mask, area_thresh, mode="islands")
+    return mask, 0, 0, holes_changed or islands_changed
+
+
+def coco_encode_rle(uncompressed_rle: Dict[str, Any]) -> Dict[str, Any]:
+    from pycocotools import mask as mask_utils  # type: ignore
+
+    h, w = uncompressed_rle["size"]
+    rle = mask_utils.frPyObjects(uncompressed_rle, h, w)
+    rle["counts"] = rle["counts"].decode("utf-8")  # Necessary to serialize with json
+    return rle
+
+
+def batched_mask_to_box(masks: np.ndarray) -> np.ndarray:
+    """
+    Calculates boxes in XYXY format around masks. Return [0,0,0,0] for
+    an empty mask. For input shape C1xC2x...xHxW, the output shape is C1xC2x...x4.
+    """
+    # np.max below raises an error on empty inputs, just skip in this case
+    if masks.size == 0:
+        return np.zeros((*masks.shape[:-2], 4), dtype=np.int64)
+
+    # Normalize shape to CxHxW
+    shape = masks.shape
+    h, w = shape[-2:]
+    masks = masks.reshape(-1, h, w)
+
+    # Get top and bottom edges
+    in_height = np.max(masks, axis=-1)
+    in_height_coords = in_height * np.arange(h)[None, :]
+    bottom_edges = np.max(in_height_coords, axis=-1)
+    in_height_coords = in_height_coords + h * (~in_height)
+    top_edges = np.min(in_height_coords, axis=-1)
+
+    # Get left and right edges
+    in_width = np.max(masks, axis=-2)
+    in_width_coords = in_width * np.arange(w)[None, :]
+    right_edges = np.max(in_width_coords, axis=-1)
+    in_width_coords = in_width_coords + w * (~in_width)
+    left_edges = np.min(in_width_coords, axis=-1)
+
+    # If the mask is empty the right edge will be to the left of the left edge.
+    # Replace these boxes with [0, 0, 0, 0]
+    empty_filter = (right_edges < left_edges) | (bottom_edges < top_edges)
+    out = np.stack([left_edges, top_edges, right_edges, bottom_edges], axis=-1)
+    out = out * (~empty_filter)[:, None]
+
+    # Return to original shape
+    return out.reshape(*shape[:-2], 4)
@@ -28,7 +28,13 @@ class SamOnnxModel(nn.Module):
         return_single_mask: bool,
         use_stability_score: bool = False,
         return_extra_metrics: bool = False,
+        single_mask_output: bool = False,
     ) -> None:
+        """
+        If single_mask_output is set, the single mask returned is always the mask of the
+        single-mask output token, same as SamPredictor with multimask_output=False,
+        instead of being selected by the number of points.
+        """
         super().__init__()
         self.mask_decoder = model.mask_decoder
         self.model = model
@@ -37,6 +43,7 @@ class SamOnnxModel(nn.Module):
         self.use_stability_score = use_stability_score
         self.stability_score_offset = 1.0
         self.return_extra_metrics = return_extra_metrics
+        self.single_mask_output = single_mask_output
 
     @staticmethod
     def resize_longest_image_size(
@@ -134,7 +141,12 @@ class SamOnnxModel(nn.Module):
                 masks, self.model.mask_threshold, self.stability_score_offset
             )
 
-        if self.return_single_mask:
+        if self.return_single_mask and self.single_mask_output:
+            masks = masks[:, :1]
+            scores = scores[:, :1]
+            cate_pred = cate_pred[:, :1]
+            fc_features = fc_features[:, :1]
+        elif self.return_single_mask:
             masks, scores, cate_pred, fc_features = self.select_masks(masks, scores, point_coords.shape[1], cate_pred, fc_features)
 
         upscaled_masks = self.mask_postprocessing(masks, orig_im_size)
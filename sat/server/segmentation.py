@@ -2,10 +2,14 @@ import io
 import logging
 import time
 import numpy as np
-import torch
-
-from .segment_anything import SamAutomaticMaskGenerator, sam_model_registry
-from .util.coco import numpy_mask_to_rle_mask, decode_rle_mask
+import onnxruntime as ort
+
+from .segment_anything.automatic_mask_generator_onnx import (
+    SamAutomaticMaskGeneratorOnnx,
+)
+from .util.coco import rle_mask_areas, rle_mask_ious
+from .embeddingCache import EmbeddingCache
+from .detectionCache import DetectionCache
 from multiprocessing import Pool
 
 from typing import List, Dict, Set
@@ -25,6 +29,10 @@ def compute_iou(mask1: np.ndarray, mask2: np.ndarray) -> float:
 
 
 class CoralSegmentation:
+    TORCH_BACKEND = "torch"
+    ONNX_BACKEND = "onnx"
+    BACKENDS = [TORCH_BACKEND, ONNX_BACKEND]
+
     def __init__(
         self,
         model_path,
@@ -32,9 +40,85 @@ class CoralSegmentation:
         point_number=32,
         iou_threshold=0.62,
         sta_threshold=0.62,
+        num_threads: int = None,
+        embedding_cache: EmbeddingCache = None,
+        backend: str = TORCH_BACKEND,
+        decoder_model_path: str = None,
+        detection_cache: DetectionCache = None,
+        crop_workers: int = 1,
     ):
+        """
+        The torch backend loads the CoralSCOP checkpoint model_path of the model_type.
+        The onnx backend runs the encoder model_path and the decoder decoder_model_path
+        exported by gen_coral_onnx.py with ONNX Runtime, without importing torch,
+        and model_type is not used.
+
+        num_threads limits the intra-op threads of the backend in this process,
+        all the cores are used by default.
+        If the embedding cache is given, it is consulted before encoding the whole image,
+        the other crops are not cached.
+        crop_workers is the number of image crops processed concurrently.
+        If the detection cache is given, the candidate masks of each image are cached
+        before filtering, so that the image is only detected once.
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.info(f"Initializing {self.__class__.__name__} ...")
+        assert (
+            backend in CoralSegmentation.BACKENDS
+        ), f"Unknown backend {backend}, should be one of {CoralSegmentation.BACKENDS}"
+        self.logger.info(f"Using {backend} backend")
+
+        generator_kwargs = {
+            "points_per_side": point_number,
+            "pred_iou_thresh": iou_threshold,
+            "stability_score_thresh": sta_threshold,
+            "crop_n_layers": 1,
+            "crop_n_points_downscale_factor": 2,
+            "min_mask_region_area": 100,
+            # The masks are encoded by the generator, so that no full-resolution mask is kept
+            "output_mode": "coco_rle",
+            # Only the fields of the annotations, so that the features of the masks
+            # and their similarity are never computed
+            "output_fields": ["segmentation", "area", "bbox", "predicted_iou"],
+        }
+        # The parallelism does not change the masks, so it is not part of the detector identity
+        detector_config = {"backend": backend, **generator_kwargs}
+        generator_kwargs["crop_workers"] = crop_workers
+        if backend == CoralSegmentation.ONNX_BACKEND:
+            assert (
+                decoder_model_path is not None
+            ), "The decoder model path is required by the onnx backend"
+            self.mask_generator = self.create_onnx_mask_generator(
+                model_path, decoder_model_path, num_threads, generator_kwargs
+            )
+        else:
+            self.mask_generator = self.create_torch_mask_generator(
+                model_path, model_type, num_threads, generator_kwargs
+            )
+
+        model_identity = EmbeddingCache.get_model_identity(model_path)
+        if embedding_cache is not None:
+            self.mask_generator.set_embedding_cache(embedding_cache, model_identity)
+
+        # Identifies the models, the backend and the generator configuration,
+        # e.g. to key the cached masks and the checkpoints of a project creation
+        if decoder_model_path is not None:
+            model_identity += EmbeddingCache.get_model_identity(decoder_model_path)
+        self.detector_identity = DetectionCache.get_detector_identity(
+            model_identity, detector_config
+        )
+        self.detection_cache = detection_cache
+
+    def create_torch_mask_generator(
+        self, model_path, model_type, num_threads: int, generator_kwargs: Dict
+    ):
+        # torch is only imported by the torch backend
+        import torch
+        from .segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+
+        if num_threads is not None:
+            self.logger.info(f"Using {num_threads} threads")
+            torch.set_num_threads(num_threads)
 
         sam = sam_model_registry[model_type](checkpoint=model_path)
         device = ""
@@ -50,35 +134,68 @@ class CoralSegmentation:
         self.logger.info(f"Using device: {device}")
         sam.to(device=device)
 
-        self.mask_generator = SamAutomaticMaskGenerator(
-            model=sam,
-            points_per_side=point_number,
-            pred_iou_thresh=iou_threshold,
-            stability_score_thresh=sta_threshold,
-            crop_n_layers=1,
-            crop_n_points_downscale_factor=2,
-            min_mask_region_area=100,
+        return SamAutomaticMaskGenerator(model=sam, **generator_kwargs)
+
+    def create_onnx_mask_generator(
+        self,
+        encoder_model_path,
+        decoder_model_path,
+        num_threads: int,
+        generator_kwargs: Dict,
+    ):
+        session_options = ort.SessionOptions()
+        if num_threads is not None:
+            self.logger.info(f"Using {num_threads} threads")
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = 1
+
+        execution_providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+        self.logger.info(f"Loading encoder from {encoder_model_path}")
+        encoder = ort.InferenceSession(
+            encoder_model_path,
+            sess_options=session_options,
+            providers=execution_providers,
+        )
+        self.logger.info(f"Loading decoder from {decoder_model_path}")
+        decoder = ort.InferenceSession(
+            decoder_model_path,
+            sess_options=session_options,
+            providers=execution_providers,
         )
 
-    def generate_masks_json(self, image: np.ndarray) -> List[Dict]:
+        return SamAutomaticMaskGeneratorOnnx(encoder, decoder, **generator_kwargs)
+
+    def generate_masks_json(
+        self, image: np.ndarray, embedding: np.ndarray = None
+    ) -> List[Dict]:
+        """
+        If the embedding of the whole image is given, it is used for the uncropped
+        layer in place of encoding the image, and it must be computed by the same
+        encoder as the segmentation model.
+        """
         start_time = time.time()
-        masks = self.mask_generator.generate(image)
+        key = None
+        if self.detection_cache is not None:
+            key = DetectionCache.get_key(image, self.detector_identity, embedding)
+            masks = self.detection_cache.get(key)
+            if masks is not None:
+                self.logger.info(
+                    f"Loaded {len(masks)} cached masks in {time.time() - start_time:.2f} seconds"
+                )
+                return masks
+
+        masks = self.mask_generator.generate(image, embedding)
         for idx, mask in enumerate(masks):
-            mask["segmentation"] = numpy_mask_to_rle_mask(mask["segmentation"] > 0)
             mask["id"] = idx
             mask["iscrowd"] = 0
             mask["category_id"] = -1
-            del mask["cate_preds"]
-            del mask["fc_features"]
-            del mask["point_coords"]
-            del mask["stability_score"]
-            del mask["crop_box"]
-            del mask["similarity"]
 
         self.logger.info(f"Generate masks time: {time.time() - start_time:.2f} seconds")
         # Filter out the masks that the predicted_iou is null
         masks = [mask for mask in masks if mask["predicted_iou"] is not None]
 
+        if key is not None:
+            self.detection_cache.put(key, masks)
         return masks
 
     def filter(
@@ -132,29 +249,27 @@ class CoralSegmentation:
 
     def filter_by_area(self, annotations: List[Dict], area_limit: float) -> Set:
         """
-        Filter out the masks which exceed the area limit
+        Filter out the masks which exceed the area limit.
+        The areas are computed on the RLEs without decoding the masks.
         """
 
         if len(annotations) == 0:
             return set()
 
-        def decode_and_compute_area(annotation):
-            mask = decode_rle_mask(annotation["segmentation"])
-            area = np.sum(mask)
-            return area
-
         image_size = annotations[0]["segmentation"]["size"]
         image_height = int(image_size[0])
         image_width = int(image_size[1])
         total_area = image_height * image_width
         min_area = total_area * area_limit
 
+        areas = rle_mask_areas(
+            [annotation["segmentation"] for annotation in annotations]
+        )
+
         filtered_index = set()
-        for annotation in annotations:
-            idx = annotation["id"]
-            area = decode_and_compute_area(annotation)
+        for annotation, area in zip(annotations, areas):
             if area >= min_area:
-                filtered_index.add(idx)
+                filtered_index.add(annotation["id"])
 
         return filtered_index
 
@@ -173,65 +288,33 @@ class CoralSegmentation:
 
     def filter_by_iou(self, annotations: List[Dict], iou_limit: float) -> Set:
         """
-        Filter out the masks which have iou lower than the iou limit
+        Filter out the masks which have iou lower than the iou limit.
+        The areas and the pairwise IoU are computed on the RLEs without decoding the masks.
         """
-        masks = [
-            decode_rle_mask(annotation["segmentation"]) for annotation in annotations
-        ]
-        return set(self.filter_by_iou_(masks, iou_limit))
+        if len(annotations) == 0:
+            return set()
+
+        rles = [annotation["segmentation"] for annotation in annotations]
+        areas = rle_mask_areas(rles).astype(np.float64)
+        iou_matrix = rle_mask_ious(rles)
+        return set(self.suppress_overlapping_masks(areas, iou_matrix, iou_limit))
 
-    def filter_by_iou_(
-        self, masks: List[np.ndarray], iou_threshold: float = 0.5
+    def suppress_overlapping_masks(
+        self, areas: np.ndarray, iou_matrix: np.ndarray, iou_threshold: float
     ) -> List[int]:
         """
-        Given a list of 2D binary masks and an IoU threshold, filter out masks that overlap
-        too much with already-kept masks (IoU > iou_threshold). In case of overlap, the
-        mask with the smaller area is removed. We always keep the bigger mask.
+        Greedily keep the masks from the largest to the smallest, suppressing the
+        masks whose IoU with a kept mask is at least the threshold.
 
         Args:
-        masks (list of np.ndarray): A list of 2D binary arrays with shape (H, W).
-        iou_threshold (float): The IoU threshold above which we consider two masks
-                                overlapping "too much."
+        areas (np.ndarray): The area of each mask, with shape (N,).
+        iou_matrix (np.ndarray): The pairwise IoU of the masks, with shape (N, N).
+        iou_threshold (float): The IoU threshold.
 
         Returns:
-        A list of indices (relative to the input list) for the masks that are kept.
+        The sorted indices of the masks that are kept.
         """
-
-        if len(masks) == 0:
-            return []
-
-        # Convert each 2D mask into a flattened 1D boolean array.
-        # This shape will be (N, mask_height * mask_width)
-        # Use dtype=bool or uint8 to reduce memory overhead and speed up calculations.
-        N = len(masks)
-        flattened_masks = []
-        areas = np.zeros(N, dtype=np.float64)
-
-        for i, mask in enumerate(masks):
-            # Ensure mask is boolean for efficient bitwise ops and multiplication
-            mask_bool = mask > 0
-            flattened_masks.append(mask_bool.ravel())
-            areas[i] = mask_bool.sum()
-
-        # Stack into a single 2D array of shape (N, -1)
-        # This operation can take time for large H*W, but it's done once.
-        M = np.stack(flattened_masks, axis=0).astype(np.float32)  # shape: (N, H*W)
-
-        # Compute intersection for every pair via matrix multiplication:
-        # intersection[i, j] = sum(M[i, :] * M[j, :])
-        # Because M is 0/1, multiplication is effectively a bitwise AND.
-        # shape of intersection_matrix: (N, N)
-        intersection_matrix = M @ M.T
-
-        # For each mask i, area[i] is the total 1's in mask i.
-        # union[i, j] = area[i] + area[j] - intersection[i, j]
-        area_col = areas.reshape(-1, 1)  # shape: (N, 1)
-        area_row = areas.reshape(1, -1)  # shape: (1, N)
-        union_matrix = area_col + area_row - intersection_matrix
-
-        # Compute the IoU matrix
-        # Avoid division by zero -> only relevant if union=0 for some degenerate masks
-        iou_matrix = intersection_matrix / np.clip(union_matrix, a_min=1, a_max=None)
+        N = len(areas)
 
         # Sort masks by area DESC (largest first)
         sorted_indices = np.argsort(areas)[::-1]
@@ -1,9 +1,9 @@
+import base64
 import logging
 import time
 import os
 import numpy as np
 import copy
-import shutil
 
 from tkinter import Tk, filedialog, messagebox
 from .embedding import EmbeddingGenerator
@@ -20,10 +20,16 @@ from .project import (
 )
 from .jsonFormat import AnnotationJson
 from .dataset import Dataset, Data
-from .util.coco import to_coco_annotation, rle_mask_to_rle_vis_encoding
+from .embeddingStore import EmbeddingStore
+from .embeddingCache import EmbeddingCache
+from .detectionCache import DetectionCache
+from .dataPrefetcher import DataPrefetcher
+from .util.coco import (
+    cropped_mask_to_rle_mask,
+    rle_mask_to_coco_annotation,
+    rle_mask_to_rle_vis_encoding,
+)
 from .util.requests import FileDialogRequest, ProjectCreateRequest
-from .util.data import unzip_file
-from PIL import Image
 from typing import Dict, List, Tuple
 
 from functools import wraps
@@ -55,9 +61,55 @@ class Server:
     # CoralSCOP
     CORALSCOP_PATH = "models/vit_b_coralscop.pth"
     CORALSCOP_MODEL_TYPE = "vit_b"
+    # CoralSCOP exported by gen_coral_onnx.py, used by the onnx backend
+    CORALSCOP_ENCODER_PATH = "models/coralscop_encoder.onnx"
+    CORALSCOP_DECODER_PATH = "models/coralscop_decoder.onnx"
+
+    def __init__(
+        self,
+        model_type: str = "vit_b",
+        embedding_cache_bytes: int = EmbeddingStore.DEFAULT_MAX_BYTES,
+        embedding_disk_cache_dir: str = EmbeddingCache.DEFAULT_CACHE_DIR,
+        embedding_disk_cache_bytes: int = EmbeddingCache.DEFAULT_MAX_BYTES,
+        coralscop_backend: str = CoralSegmentation.TORCH_BACKEND,
+        coralscop_reuse_embedding: bool = False,
+        detection_disk_cache_dir: str = DetectionCache.DEFAULT_CACHE_DIR,
+        detection_disk_cache_bytes: int = DetectionCache.DEFAULT_MAX_BYTES,
+        base64_rle: bool = True,
+        prefetch_radius: int = DataPrefetcher.DEFAULT_RADIUS,
+    ):
+        """
+        If coralscop_reuse_embedding is set, the coral detection of a project image
+        reuses its embedding for the uncropped layer instead of encoding the image
+        again, which requires the embeddings of the projects to be computed by an
+        encoder compatible with CoralSCOP.
+
+        The candidate masks of the coral detection are cached on disk before they
+        are filtered, so detecting corals again with other thresholds only filters them.
 
-    def __init__(self, model_type: str = "vit_b"):
+        If base64_rle is set, the masks are sent to the front end as base64 strings
+        of their run lengths rather than lists.
+
+        After an image is served, the prefetch_radius images before and after it
+        are warmed in the background, 0 disables the prefetch.
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.coralscop_reuse_embedding = coralscop_reuse_embedding
+        self.base64_rle = base64_rle
+
+        # Embeddings shared across projects, so that an image is encoded only once
+        self.embedding_cache = None
+        if embedding_disk_cache_bytes > 0:
+            self.embedding_cache = EmbeddingCache(
+                embedding_disk_cache_dir, embedding_disk_cache_bytes
+            )
+
+        # Unfiltered coral detection results, so that re-detection is a filter pass
+        self.detection_cache = None
+        if detection_disk_cache_bytes > 0:
+            self.detection_cache = DetectionCache(
+                detection_disk_cache_dir, detection_disk_cache_bytes
+            )
 
         self.model_type = model_type
         # Embedding Encoder Model
@@ -84,7 +136,9 @@ class Server:
 
         model_path = get_resource_path(self.encoder_model_path)
         # model_path = get_resource_path(Server.CORALSCOP_PATH)
-        self.embeddings_generator = EmbeddingGenerator(model_path)
+        self.embeddings_generator = EmbeddingGenerator(
+            model_path, embedding_cache=self.embedding_cache
+        )
         self.logger.info(
             f"Embedding model loaded in {time.time() - start_time} seconds"
         )
@@ -92,10 +146,23 @@ class Server:
         # Coral Segmentation Model
         self.logger.info("Loading segmentation model ...")
         start_time = time.time()
-        model_path = get_resource_path(Server.CORALSCOP_PATH)
-        self.coral_segmentation = CoralSegmentation(
-            model_path, Server.CORALSCOP_MODEL_TYPE
-        )
+        if coralscop_backend == CoralSegmentation.ONNX_BACKEND:
+            self.coral_segmentation = CoralSegmentation(
+                get_resource_path(Server.CORALSCOP_ENCODER_PATH),
+                Server.CORALSCOP_MODEL_TYPE,
+                embedding_cache=self.embedding_cache,
+                backend=coralscop_backend,
+                decoder_model_path=get_resource_path(Server.CORALSCOP_DECODER_PATH),
+                detection_cache=self.detection_cache,
+            )
+        else:
+            self.coral_segmentation = CoralSegmentation(
+                get_resource_path(Server.CORALSCOP_PATH),
+                Server.CORALSCOP_MODEL_TYPE,
+                embedding_cache=self.embedding_cache,
+                backend=coralscop_backend,
+                detection_cache=self.detection_cache,
+            )
         self.logger.info(f"CoralSCOP loaded in {time.time() - start_time} seconds")
 
         # Mask Editor
@@ -117,6 +184,11 @@ class Server:
         self.dataset: Dataset = None
         self.current_image_idx: int = 0
         self.project_path: str = None
+        # Embeddings of the loaded project are kept within the memory budget
+        self.project_loader = ProjectLoader(embedding_cache_bytes)
+        self.data_prefetcher = DataPrefetcher(
+            self.project_loader, prefetch_radius, base64_rle
+        )
 
     def select_folder(self, file_dialog_request: FileDialogRequest):
         """
@@ -234,9 +306,8 @@ class Server:
             project_path = ProjectCreator.TEMP_PROJECT_FILE
 
         self.logger.info(f"Loading project from {project_path} ...")
-        project_loader = ProjectLoader()
-
-        dataset, last_image_idx = project_loader.load(project_path)
+        self.data_prefetcher.cancel()
+        dataset, last_image_idx = self.project_loader.load_lazy(project_path)
         self.logger.info(f"Project loaded with last image idx: {last_image_idx}")
 
         self.set_dataset(dataset)
@@ -251,11 +322,23 @@ class Server:
     @time_it
     def get_gallery_data_list(self) -> List[Dict]:
         """
-        Get the list of data for the gallery view
+        Get the list of data for the gallery view. The images are not read,
+        the gallery requests the thumbnail of each image with get_gallery_image.
         """
         data_list = self.dataset.get_data_list()
         return [data.to_image_json() for data in data_list]
 
+    def get_gallery_image(self, image_idx: int) -> str:
+        """
+        Get the thumbnail of an image for the gallery view, as a data URL
+        """
+        data = self.get_data(image_idx)
+        if data is None:
+            return None
+
+        thumbnail = self.project_loader.load_data_thumbnail(data)
+        return "data:image/jpeg;base64," + base64.b64encode(thumbnail).decode("ascii")
+
     @time_it
     def get_data_dict(self, image_idx: int) -> Dict:
         """
@@ -271,6 +354,7 @@ class Server:
         """
 
         data = self.get_data(image_idx)
+        self.project_loader.store_data_image(data)
 
         category_info = self.dataset.get_category_info()
         if category_info is None:
@@ -282,10 +366,12 @@ class Server:
             self.logger.error(f"Status info not found")
             return None
 
-        response = data.to_json()
+        response = data.to_json(self.base64_rle)
         response["category_info"] = category_info
         response["status_info"] = status_info
 
+        self.data_prefetcher.prefetch(self.dataset, image_idx)
+
         return response
 
     def get_data(self, image_idx: int) -> Data:
@@ -308,8 +394,15 @@ class Server:
 
     @time_it
     def get_data_list(self) -> List[Data]:
+        """
+        Get all the data, with their images stored in the asset folder, since
+        the annotated images are exported from the image path of each data
+        """
         self.logger.info(f"Getting data list ...")
-        return self.dataset.get_data_list()
+        data_list = self.dataset.get_data_list()
+        for data in data_list:
+            self.project_loader.store_data_image(data)
+        return data_list
 
     def to_next_data(self) -> None:
         """
@@ -358,6 +451,7 @@ class Server:
         self.current_image_idx = image_idx
 
         data = self.get_data(image_idx)
+        self.project_loader.store_data_image(data)
         self.mask_creator.set_image(
             data.get_embedding(),
             [
@@ -396,8 +490,20 @@ class Server:
 
         self.logger.info(f"Saving the dataset to {output_path} ...")
 
+        # Release the project file so that it can be replaced. It is re-opened
+        # on the next read of a lazily loaded member.
+        self.data_prefetcher.cancel()
+        self.project_loader.close()
+
+        # Only the updated annotations are rewritten, the other members of the
+        # project are copied from the current project file
         project_saver = ProjectSaver()
-        project_saver.save_dataset(self.dataset, self.get_project_path(), output_path)
+        project_saver.save_dataset_incremental(
+            self.dataset, self.get_project_path(), output_path
+        )
+
+        if os.path.abspath(output_path) == os.path.abspath(self.get_project_path()):
+            self.dataset.clear_dirty_data_ids()
 
     def get_project_path(self) -> str:
         return self.project_path
@@ -433,12 +539,40 @@ class Server:
         self.logger.info(f"Creating mask ...")
 
         prompts = [Prompt(prompt) for prompt in prompts]
-        mask = self.mask_creator.create_mask(prompts)
-        annotation = to_coco_annotation(mask)
+        # Only the box of the mask is upscaled to the image size and encoded
+        mask, x0, y0, _ = self.mask_creator.create_cropped_mask(prompts)
+        return self.to_prompted_annotation(mask, x0, y0)
+
+    def create_masks(self, objects: List[List[Dict]]) -> List[Dict]:
+        """
+        Create the masks of independent objects, e.g. the prompts imported from
+        a prior survey, decoded in batches instead of one request per object
+
+        Args:
+            objects: List of the prompts of each object
+
+        Returns:
+            The mask annotation of each object, see create_mask
+        """
+        self.logger.info(f"Creating masks of {len(objects)} objects ...")
+
+        objects = [[Prompt(prompt) for prompt in prompts] for prompts in objects]
+        masks = self.mask_creator.create_cropped_masks(objects)
+        return [self.to_prompted_annotation(mask, x0, y0) for mask, x0, y0 in masks]
+
+    def to_prompted_annotation(self, mask: np.ndarray, x0: int, y0: int) -> Dict:
+        """
+        Convert the mask cropped to its box, whose top left corner is (x0, y0),
+        into the annotation of a prompted mask
+        """
+        height, width = self.mask_creator.image_size
+        rle = cropped_mask_to_rle_mask(mask, x0, y0, height, width)
+        annotation = rle_mask_to_coco_annotation(rle)
         annotation["category_id"] = -2  # Category id for prompted mask
-        annotation["rle"] = rle_mask_to_rle_vis_encoding(annotation["segmentation"])
+        annotation["rle"] = rle_mask_to_rle_vis_encoding(
+            annotation["segmentation"], self.base64_rle
+        )
         annotation["predicted_iou"] = 1.0
-
         return annotation
 
     @time_it
@@ -480,28 +614,14 @@ class Server:
 
         data = self.get_data(self.get_current_image_idx())
 
-        # Unzip the project folder to get the image
-        temp_folder = os.path.join(os.path.dirname(self.project_path), "temp")
-        if os.path.exists(temp_folder):
-            shutil.rmtree(temp_folder)
-        os.makedirs(temp_folder, exist_ok=True)
-        unzip_file(self.project_path, temp_folder)
-
-        image_folder = os.path.join(temp_folder, "images")
-        image_paths = []
-        for file in os.listdir(image_folder):
-            image_paths.append(os.path.join(image_folder, file))
-
-        assert len(image_paths) == 1, "Only one image is expected"
-        image_path = image_paths[0]
-
-        image = Image.open(image_path)
-        image = np.array(image)
+        # Read the image of the current data, without unzipping the project
+        image = self.project_loader.load_data_image(data)
 
-        # Remove the temporary folder
-        shutil.rmtree(temp_folder)
+        embedding = None
+        if self.coralscop_reuse_embedding:
+            embedding = data.get_embedding()
 
-        masks = self.coral_segmentation.generate_masks_json(image)
+        masks = self.coral_segmentation.generate_masks_json(image, embedding)
         if len(masks) == 0:
             self.logger.info(f"No coral detected")
             return
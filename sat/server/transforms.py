@@ -4,10 +4,17 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from __future__ import annotations
+
 import numpy as np
-import torch
-from torch.nn import functional as F
-from torchvision.transforms.functional import resize, to_pil_image  # type: ignore
+
+try:
+    import torch
+    from torch.nn import functional as F
+    from torchvision.transforms.functional import resize, to_pil_image  # type: ignore
+except ImportError:
+    # Only the numpy coordinate transforms are available without torch
+    torch = None
 
 from copy import deepcopy
 from typing import Tuple
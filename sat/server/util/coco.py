@@ -1,8 +1,12 @@
+import base64
 from pycocotools import mask as coco_mask
 import numpy as np
-from typing import Dict, List
+from typing import Dict, List, Union
 import cv2
 
+# Largest number of masks passed to a single pycocotools call, see rle_mask_areas
+COCO_MASK_CHUNK_SIZE = 255
+
 
 def is_rel_encoding(segmentation: Dict) -> bool:
     return "counts" in segmentation and "size" in segmentation
@@ -12,28 +16,111 @@ def is_polygon_encoding(segmentation: List) -> bool:
     return type(segmentation) == list
 
 
-def rle_mask_to_rle_vis_encoding(segmentation: Dict) -> List[int]:
-    arr = coco_mask.decode(segmentation)
-
-    # Flatten the 2D array to a 1D array
-    flat = arr.flatten()
-
-    # Find the indices where the value changes
-    diffs = np.diff(flat)
-    change_indices = np.where(diffs != 0)[0] + 1
+def decode_rle_counts(counts: str) -> np.ndarray:
+    """
+    Decode the compressed counts string of a COCO RLE into the run lengths,
+    same as rleFrString of pycocotools. Each run length is written as groups
+    of 5 bits, whose 0x20 bit means that more groups follow, and from the
+    third run length on, it is the difference with the run length two before.
+    """
+    if isinstance(counts, str):
+        counts = counts.encode("utf-8")
+    chars = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    if len(chars) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    is_last = (chars & 0x20) == 0
+    ends = np.flatnonzero(is_last) + 1
+    starts = np.concatenate(([0], ends[:-1]))
+    lengths = ends - starts
+
+    # Position of each character within its run length
+    shifts = 5 * (np.arange(len(chars)) - np.repeat(starts, lengths))
+    values = np.add.reduceat((chars & 0x1F) << shifts, starts)
+    # The 0x10 bit of the last group is the sign
+    negative = (chars[ends - 1] & 0x10) != 0
+    values[negative] |= np.left_shift(-1, 5 * lengths[negative])
+
+    values[1::2] = np.cumsum(values[1::2])
+    values[2::2] = np.cumsum(values[2::2])
+    return values
+
+
+def rle_mask_to_vis_run_lengths(segmentation: Dict) -> np.ndarray:
+    """
+    Transcode a COCO RLE, whose runs are in column-major order, into the run lengths
+    of the mask in row-major order starting with a run of zeros, without decoding the mask.
 
-    # Include the start and end indices
-    indices = np.concatenate(([0], change_indices, [len(flat)]))
+    A pixel starts a row-major run if it differs from the previous pixel in its row,
+    or from the last pixel of the previous row for the first column. The rows of
+    each column where it differs from the previous column are found from the
+    boundaries of the foreground intervals of both columns.
+    """
+    height, width = segmentation["size"]
+    counts = segmentation["counts"]
+    if isinstance(counts, list):
+        counts = np.asarray(counts, dtype=np.int64)
+    else:
+        counts = decode_rle_counts(counts)
+
+    # The odd runs are the foreground
+    ends = np.cumsum(counts)
+    starts = (ends - counts)[1::2]
+    ends = ends[1::2]
+    nonempty = ends > starts
+    starts, ends = starts[nonempty], ends[nonempty]
+
+    # Split the runs into the foreground rows of each column
+    first_cols = starts // height
+    pieces = (ends - 1) // height - first_cols + 1
+    run_idxs = np.repeat(np.arange(len(starts)), pieces)
+    cols = first_cols[run_idxs] + (
+        np.arange(len(run_idxs)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    )
+    row_starts = np.maximum(starts[run_idxs], cols * height) - cols * height
+    row_ends = np.minimum(ends[run_idxs], (cols + 1) * height) - cols * height
+
+    # Each interval toggles the difference with the previous column at its
+    # boundaries, in its column and in the next column. The next column of the
+    # last column is the first column of the next row.
+    toggle_cols = np.concatenate((cols, cols, cols + 1, cols + 1))
+    toggle_rows = np.concatenate((row_starts, row_ends, row_starts, row_ends))
+    wrapped = toggle_cols == width
+    toggle_cols[wrapped] = 0
+    toggle_rows[wrapped] += 1
+
+    # Toggles at the same pixel cancel each other
+    keys, toggles = np.unique(
+        toggle_cols * (height + 2) + toggle_rows, return_counts=True
+    )
+    keys = keys[toggles % 2 == 1]
+    diff_cols = keys[0::2] // (height + 2)
+    diff_starts = keys[0::2] % (height + 2)
+    diff_ends = np.minimum(keys[1::2] % (height + 2), height)
+    diff_lengths = np.maximum(diff_ends - diff_starts, 0)
+
+    # Row-major index of the pixels which start a run
+    diff_rows = np.repeat(diff_starts, diff_lengths) + (
+        np.arange(diff_lengths.sum())
+        - np.repeat(np.cumsum(diff_lengths) - diff_lengths, diff_lengths)
+    )
+    changes = np.sort(diff_rows * width + np.repeat(diff_cols, diff_lengths))
+    return np.diff(np.concatenate(([0], changes, [height * width])))
 
-    # Compute the run lengths
-    run_lengths = np.diff(indices)
 
-    # Ensure the encoding starts with zero
-    if flat[0] == 0:
-        return run_lengths.tolist()
-    else:
-        # Insert a zero at the beginning to start with zero
-        return np.insert(run_lengths, 0, 0).tolist()
+def rle_mask_to_rle_vis_encoding(
+    segmentation: Dict, base64_encoded: bool = False
+) -> Union[List[int], str]:
+    """
+    Encode the mask into the row-major run lengths of the front end visualization,
+    starting with a run of zeros. If base64_encoded is set, the run lengths are
+    returned as a base64 string of little-endian uint32, decoded into an Uint32Array
+    by the front end, otherwise as a list.
+    """
+    run_lengths = rle_mask_to_vis_run_lengths(segmentation)
+    if base64_encoded:
+        return base64.b64encode(run_lengths.astype("<u4").tobytes()).decode("ascii")
+    return run_lengths.tolist()
 
 
 def numpy_mask_to_rle_mask(mask: np.ndarray) -> Dict:
@@ -46,11 +133,75 @@ def numpy_mask_to_rle_mask(mask: np.ndarray) -> Dict:
     return rle
 
 
+def cropped_mask_to_rle_mask(
+    mask: np.ndarray, x0: int, y0: int, height: int, width: int
+) -> Dict:
+    """
+    Encode the crop of a mask of the given image size, whose top left corner is
+    (x0, y0), knowing that the mask is empty outside of the crop. Only the columns
+    of the crop are scanned, instead of the whole image.
+    """
+    crop_height, crop_width = mask.shape
+    if crop_height == 0 or crop_width == 0:
+        counts = np.array([height * width])
+    else:
+        # Column-major pixels of the columns of the crop
+        columns = np.zeros((crop_width, height), dtype=bool)
+        columns[:, y0 : y0 + crop_height] = mask.T > 0
+        columns = columns.ravel()
+
+        changes = np.flatnonzero(columns[1:] != columns[:-1]) + 1
+        counts = np.diff(np.concatenate(([0], changes, [columns.size])))
+        if columns[0]:
+            counts = np.concatenate(([0], counts))
+
+        # The columns before and after the crop are empty
+        counts[0] += x0 * height
+        tail = (width - x0 - crop_width) * height
+        if len(counts) % 2 == 1:
+            counts[-1] += tail
+        elif tail > 0:
+            counts = np.concatenate((counts, [tail]))
+
+    rle = coco_mask.frPyObjects(
+        {"size": [height, width], "counts": counts.tolist()}, height, width
+    )
+    rle["counts"] = rle["counts"].decode("utf-8")
+    return rle
+
+
 def decode_rle_mask(segmentation: Dict) -> np.ndarray:
     mask = coco_mask.decode(segmentation)
     return mask
 
 
+def rle_mask_areas(segmentations: List[Dict]) -> np.ndarray:
+    """
+    Compute the area of each RLE mask without decoding it
+    """
+    if len(segmentations) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # pycocotools builds a uint8 array of the mask count, which overflows
+    # with numpy 2 for 256 masks or more, so the areas are computed in chunks
+    areas = [
+        coco_mask.area(segmentations[i : i + COCO_MASK_CHUNK_SIZE])
+        for i in range(0, len(segmentations), COCO_MASK_CHUNK_SIZE)
+    ]
+    return np.concatenate(areas).astype(np.int64)
+
+
+def rle_mask_ious(segmentations: List[Dict]) -> np.ndarray:
+    """
+    Compute the pairwise IoU of the RLE masks without decoding them.
+    Returns a (N, N) matrix, where the IoU of two empty masks is 0.
+    """
+    if len(segmentations) == 0:
+        return np.zeros((0, 0), dtype=np.float64)
+    iscrowd = [0] * len(segmentations)
+    return np.asarray(coco_mask.iou(segmentations, segmentations, iscrowd))
+
+
 def to_coco_annotation(mask: np.ndarray) -> Dict:
     """
     Convert the given mask into COCO annotation format
@@ -73,7 +224,13 @@ def to_coco_annotation(mask: np.ndarray) -> Dict:
 
     rle = coco_mask.encode(np.asfortranarray(mask.astype(np.uint8)))
     rle["counts"] = rle["counts"].decode("utf-8")
+    return rle_mask_to_coco_annotation(rle)
+
 
+def rle_mask_to_coco_annotation(rle: Dict) -> Dict:
+    """
+    Convert the given RLE mask into COCO annotation format, see to_coco_annotation
+    """
     bbox = coco_mask.toBbox(rle)
     bbox = bbox.tolist()
     bbox = [int(coord) for coord in bbox]
@@ -1,5 +1,30 @@
 import zipfile
 import os
+import copy
+import shutil
+import struct
+
+from typing import BinaryIO, List, Optional, Set
+
+# Layout of the zip local file header, see zipfile.structFileHeader
+ZIP_LOCAL_HEADER_FORMAT = "<4s2B4HL2L2H"
+ZIP_LOCAL_HEADER_SIZE = struct.calcsize(ZIP_LOCAL_HEADER_FORMAT)
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+# Header of an extra field of a zip member, and the id of the zip64 field
+ZIP_EXTRA_HEADER_FORMAT = "<2H"
+ZIP_EXTRA_HEADER_SIZE = struct.calcsize(ZIP_EXTRA_HEADER_FORMAT)
+ZIP64_EXTRA_ID = 0x0001
+# Attributes of zipfile.ZipFile used to write the compressed bytes of a member
+ZIP_WRITER_INTERNALS = (
+    "fp",
+    "start_dir",
+    "filelist",
+    "NameToInfo",
+    "_lock",
+    "_writing",
+    "_writecheck",
+    "_didModify",
+)
 
 
 def zip_file(folder_path: str, output_file: str):
@@ -15,3 +40,120 @@ def zip_file(folder_path: str, output_file: str):
 def unzip_file(zip_file: str, output_folder: str):
     with zipfile.ZipFile(zip_file, "r") as zipf:
         zipf.extractall(output_folder)
+
+
+def seek_zip_member_data(f: BinaryIO, info: zipfile.ZipInfo):
+    """
+    Move the file of the zip archive to the data of the member, after its local header
+    """
+    f.seek(info.header_offset)
+    header = struct.unpack(ZIP_LOCAL_HEADER_FORMAT, f.read(ZIP_LOCAL_HEADER_SIZE))
+    filename_length, extra_length = header[-2:]
+    f.seek(filename_length + extra_length, os.SEEK_CUR)
+
+
+def strip_zip64_extra(extra: bytes) -> bytes:
+    """
+    Remove the zip64 field from the extra fields of a zip member, and keep the others
+    """
+    fields = []
+    offset = 0
+    while offset + ZIP_EXTRA_HEADER_SIZE <= len(extra):
+        field_id, field_size = struct.unpack(
+            ZIP_EXTRA_HEADER_FORMAT,
+            extra[offset : offset + ZIP_EXTRA_HEADER_SIZE],
+        )
+        end = offset + ZIP_EXTRA_HEADER_SIZE + field_size
+        if field_id != ZIP64_EXTRA_ID:
+            fields.append(extra[offset:end])
+        offset = end
+    return b"".join(fields)
+
+
+def write_raw_zip_member(
+    target: zipfile.ZipFile, info: zipfile.ZipInfo, f: BinaryIO
+) -> zipfile.ZipInfo:
+    """
+    Write the member info followed by its compressed bytes, read from f, to the target
+    zip file. zipfile has no public API to write the compressed bytes of a member,
+    so this is the only place which touches the internals of the target.
+    """
+    for attribute in ZIP_WRITER_INTERNALS:
+        if not hasattr(target, attribute):
+            raise RuntimeError(
+                f"zipfile.ZipFile has no {attribute}, the raw member copy is not "
+                f"supported by this Python version"
+            )
+
+    target_info = copy.copy(info)
+    # The zip64 sizes and offsets are regenerated for the target archive
+    target_info.extra = strip_zip64_extra(info.extra)
+    zip64 = (
+        info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+    )
+
+    with target._lock:
+        if target._writing:
+            raise ValueError(
+                "Can't write to the ZIP archive while an open writing handle exists"
+            )
+        target._writecheck(target_info)
+
+        target.fp.seek(target.start_dir)
+        target_info.header_offset = target.start_dir
+        target.fp.write(target_info.FileHeader(zip64))
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise EOFError(f"Unexpected end of member {info.filename}")
+            target.fp.write(chunk)
+            remaining -= len(chunk)
+
+        target.filelist.append(target_info)
+        target.NameToInfo[target_info.filename] = target_info
+        target.start_dir = target.fp.tell()
+        target._didModify = True
+
+    return target_info
+
+
+def copy_zip_members(
+    source_file: str,
+    target: zipfile.ZipFile,
+    skip_members: Optional[Set[str]] = None,
+) -> List[str]:
+    """
+    Copy the members of the source zip file into the target zip file, except
+    the skipped members. The compressed bytes of each member are copied as they
+    are, without decompressing the member or extracting it to disk.
+
+    Returns:
+    - List[str]: The names of the copied members
+    """
+    if skip_members is None:
+        skip_members = set()
+
+    copied_members = []
+    with zipfile.ZipFile(source_file, "r") as source, open(source_file, "rb") as f:
+        for info in source.infolist():
+            if info.filename in skip_members:
+                continue
+
+            if info.flag_bits & ZIP_DATA_DESCRIPTOR_FLAG:
+                # The sizes follow the member data, stream it through zipfile instead
+                target_info = zipfile.ZipInfo(info.filename, info.date_time)
+                target_info.compress_type = info.compress_type
+                target_info.external_attr = info.external_attr
+                target_info.comment = info.comment
+                target_info.file_size = info.file_size
+                with source.open(info) as src, target.open(target_info, "w") as dst:
+                    shutil.copyfileobj(src, dst)
+                copied_members.append(info.filename)
+                continue
+
+            seek_zip_member_data(f, info)
+            write_raw_zip_member(target, info, f)
+            copied_members.append(info.filename)
+
+    return copied_members
@@ -37,6 +37,57 @@ def preprocess_image(image: Image) -> np.ndarray:
     
     return input_tensor
 
+class ImagePreprocessor:
+    """
+    Preprocess images into a preallocated float32 (N, 3, 1024, 1024) buffer, which
+    is reused across calls. The resized image is normalized channel by channel
+    straight into the buffer, and only the padding is zeroed, so no full-size
+    intermediate array is allocated.
+
+    The returned tensor is a view of the buffer, it is overwritten by the next call.
+    """
+
+    INPUT_SIZE = 1024
+    MEAN = np.array([123.675, 116.28, 103.53])
+    STD = np.array([58.395, 57.12, 57.375])
+
+    def __init__(self, batch_size: int = 1):
+        self.buffer = np.zeros((batch_size, 3, self.INPUT_SIZE, self.INPUT_SIZE), dtype=np.float32)
+        # (x - mean) / std is computed as x * scale + offset
+        self.scale = (1 / ImagePreprocessor.STD).astype(np.float32)
+        self.offset = (-ImagePreprocessor.MEAN / ImagePreprocessor.STD).astype(np.float32)
+
+    def preprocess(self, image: Image) -> np.ndarray:
+        """
+        Same output as preprocess_image, with shape (1, 3, 1024, 1024)
+        """
+        return self.preprocess_batch([image])
+
+    def preprocess_batch(self, images: List[Image]) -> np.ndarray:
+        """
+        Preprocess the images into one contiguous (N, 3, 1024, 1024) input tensor
+        """
+        if len(images) > self.buffer.shape[0]:
+            self.buffer = np.zeros((len(images), 3, self.INPUT_SIZE, self.INPUT_SIZE), dtype=np.float32)
+
+        for i, image in enumerate(images):
+            self.fill(i, image)
+        return self.buffer[:len(images)]
+
+    def fill(self, i: int, image: Image):
+        resized_width, resized_height = determine_sam_input_shape(image)
+        image = image.resize((resized_width, resized_height), Image.Resampling.BILINEAR)
+        pixels = np.asarray(image)
+
+        for c in range(3):
+            channel = self.buffer[i, c, :resized_height, :resized_width]
+            np.multiply(pixels[:, :, c], self.scale[c], out=channel, casting="unsafe")
+            channel += self.offset[c]
+
+        # Zero the padding, which may hold the pixels of a previous image
+        self.buffer[i, :, resized_height:, :] = 0
+        self.buffer[i, :, :resized_height, resized_width:] = 0
+
 def preprocess_point(input_point: Union[np.ndarray, List[List[int]]], ori_width: int, ori_height: int, resized_width: int, resized_height: int) -> np.ndarray:
     """
     input_point: (N, 2)
@@ -2,6 +2,10 @@ from typing import Dict, List
 
 
 class ProjectCreateRequest:
+
+    EMBEDDING_LAYOUT_FILES = "files"
+    EMBEDDING_LAYOUT_PACKED = "packed"
+
     def __init__(self, request: Dict):
         """
         Request should have the following structure:
@@ -19,10 +23,17 @@ class ProjectCreateRequest:
                 "maxIOU": 0.5
             },
             "output_file": "/path/to/output"
-            "need_segmentation": true
+            "need_segmentation": true,
+            "embedding_layout": "files",
+            "resume": false
         }
 
         If the image_path is provided, the image_url will be ignored.
+        The embedding_layout is either "files", which stores one .npy file per
+        image, or "packed", which stacks all the embeddings into a single
+        memory-mappable file. It is "files" by default.
+        If resume is true, the outputs of each image are checkpointed, and the images
+        already processed by a previous run of the same request are skipped.
         """
         self.request = request
         assert "inputs" in request, "Missing 'inputs' in request"
@@ -33,6 +44,14 @@ class ProjectCreateRequest:
         self.output_file = request["output_file"]
 
         self.need_segmentation_ = request.get("need_segmentation", True)
+        self.need_resume_ = request.get("resume", False)
+        self.embedding_layout = request.get(
+            "embedding_layout", ProjectCreateRequest.EMBEDDING_LAYOUT_FILES
+        )
+        assert self.embedding_layout in [
+            ProjectCreateRequest.EMBEDDING_LAYOUT_FILES,
+            ProjectCreateRequest.EMBEDDING_LAYOUT_PACKED,
+        ], f"Unknown embedding layout {self.embedding_layout}"
 
     def get_inputs(self) -> List[Dict]:
         return self.inputs
@@ -52,6 +71,12 @@ class ProjectCreateRequest:
     def need_segmentation(self) -> bool:
         return self.need_segmentation_
 
+    def need_resume(self) -> bool:
+        return self.need_resume_
+
+    def get_embedding_layout(self) -> str:
+        return self.embedding_layout
+
 
 class FileDialogRequest:
 
@@ -75,6 +75,9 @@ export class Mask {
     }
 
     decodeRleMask(rle_mask) {
+        if (typeof rle_mask === "string") {
+            rle_mask = this.decodeBase64RunLengths(rle_mask);
+        }
         const totalLength = rle_mask.reduce((sum, len) => sum + len, 0);
         const mask = new Uint8Array(totalLength); // Use Uint8Array for better performance
 
@@ -91,6 +94,16 @@ export class Mask {
         return mask;
     }
 
+    decodeBase64RunLengths(encoded) {
+        // Run lengths sent as a base64 string of little-endian uint32
+        const binary = atob(encoded);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return new Uint32Array(bytes.buffer);
+    }
+
     getMiddlePoint() {
         if (this.middlePoint) {
             return this.middlePoint;
@@ -16,7 +16,7 @@ export class GalleryPageLabel extends GalleryPage {
 
         // Show image
         const imageElement = item.querySelector("img");
-        imageElement.src = encodeURIComponent(galleryData.image_path);
+        this.observeImage(imageElement, galleryData.idx);
 
         // Show filename
         const idx = galleryData.idx;
@@ -11,6 +11,12 @@ export class GalleryPage extends Page {
         this.galleryItemTemplate = this.dom.querySelector(
             "#gallery-item-template"
         );
+
+        // The thumbnail of an item is only requested once the item is visible
+        this.imageObserver = new IntersectionObserver(
+            (entries) => this.loadVisibleImages(entries),
+            { rootMargin: "200px" }
+        );
     }
 
     init() {}
@@ -41,7 +47,7 @@ export class GalleryPage extends Page {
 
         // Show image
         const imageElement = item.querySelector("img");
-        imageElement.src = encodeURIComponent(galleryData.image_path);
+        this.observeImage(imageElement, galleryData.idx);
 
         // Show filename
         const idx = galleryData.idx;
@@ -52,7 +58,38 @@ export class GalleryPage extends Page {
         return galleryItem;
     }
 
+    /**
+     * Load the thumbnail of the image once the image element is visible
+     * @param {HTMLImageElement} imageElement - Image element of a gallery item
+     * @param {number} idx - Index of the data
+     */
+    observeImage(imageElement, idx) {
+        imageElement.dataset.idx = idx;
+        this.imageObserver.observe(imageElement);
+    }
+
+    loadVisibleImages(entries) {
+        for (const entry of entries) {
+            if (!entry.isIntersecting) {
+                continue;
+            }
+
+            const imageElement = entry.target;
+            this.imageObserver.unobserve(imageElement);
+            eel.get_gallery_image(Number(imageElement.dataset.idx))()
+                .then((thumbnail) => {
+                    if (thumbnail !== null) {
+                        imageElement.src = thumbnail;
+                    }
+                })
+                .catch((error) => {
+                    console.error("Failed to load the gallery image: ", error);
+                });
+        }
+    }
+
     clearGallery() {
+        this.imageObserver.disconnect();
         this.galleryContainer.innerHTML = "";
     }
 
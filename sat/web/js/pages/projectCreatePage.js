@@ -200,6 +200,9 @@ export class ProjectCreatePage extends Page {
                  */
                 const createProjectRequest = new CreateProjectRequest();
                 createProjectRequest.setOutputPath(projectPath);
+                // The images processed before a termination or a crash are
+                // reused when the project is created again at the same path
+                createProjectRequest.setResume(true);
                 const selectedImageNames =
                     this.imageSelector.getSelectedImageNames();
                 selectedImageNames.sort((a, b) => a.localeCompare(b));
@@ -252,7 +255,9 @@ export class ProjectCreatePage extends Page {
             });
         } else {
             generalPopup.updateLargeText("Terminated.");
-            generalPopup.updateText("Project creation is terminated.");
+            generalPopup.updateText(
+                "Project creation is terminated. The processed images are reused if the project is created again at the same path."
+            );
             generalPopup.addButton("back-button", "Back", () => {
                 generalPopup.hide();
             });
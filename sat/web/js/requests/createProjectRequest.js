@@ -6,6 +6,7 @@ import { Request } from "./request.js";
  * 1. List of input images
  * 2. Path to the output directory
  * 3. Coral segmentation configuration
+ * 4. Whether to resume from the checkpoint of a terminated creation of the same output file
  */
 export class CreateProjectRequest extends Request {
     static INPUTS = "inputs";
@@ -16,6 +17,7 @@ export class CreateProjectRequest extends Request {
     static IMAGE_FILE_NAME = "image_file_name";
 
     static NEED_SEGMENTATION = "need_segmentation";
+    static RESUME = "resume";
 
     constructor() {
         super();
@@ -24,6 +26,7 @@ export class CreateProjectRequest extends Request {
         this.request[CreateProjectRequest.OUTPUT_FILE] = "";
         this.request[CreateProjectRequest.CONFIG] = "";
         this.request[CreateProjectRequest.NEED_SEGMENTATION] = true;
+        this.request[CreateProjectRequest.RESUME] = false;
     }
 
     addInput(imageUrl, imageFileName) {
@@ -45,6 +48,10 @@ export class CreateProjectRequest extends Request {
         this.request[CreateProjectRequest.NEED_SEGMENTATION] = needSegmentation;
     }
 
+    setResume(resume) {
+        this.request[CreateProjectRequest.RESUME] = resume;
+    }
+
     toJson() {
         return this.request;
     }